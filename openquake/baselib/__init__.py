@@ -114,7 +114,8 @@ def positiveint(flag):
 
 config.read(soft_mem_limit=int, hard_mem_limit=int, port=int,
             multi_user=positiveint, serialize_jobs=positiveint,
-            strict=positiveint, code=exec)
+            strict=positiveint, shared_results=positiveint,
+            split_cache_size=int, code=exec)
 
 if config.directory.custom_tmp:
     os.environ['TMPDIR'] = config.directory.custom_tmp
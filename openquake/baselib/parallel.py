@@ -180,6 +180,7 @@ a great deal of work trying to split slow sources in more manageable
 fast sources.
 
 """
+import io
 import os
 import re
 import ast
@@ -188,9 +189,12 @@ import time
 import socket
 import signal
 import pickle
+import heapq
+import shutil
 import inspect
 import logging
 import operator
+import tempfile
 import traceback
 import collections
 from unittest import mock
@@ -206,10 +210,11 @@ except ImportError:
 from openquake.baselib import config, hdf5, workerpool, __version__
 from openquake.baselib.zeromq import zmq, Socket
 from openquake.baselib.performance import (
-    Monitor, memory_rss, init_performance)
+    Monitor, memory_rss, init_performance, task_cost_dt)
+from openquake.baselib.python3compat import decode
 from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize, CallableDict,
-    gettemp)
+    gettemp, WeightedSequence)
 
 sys.setrecursionlimit(1200)  # raised a bit to make pickle happier
 # see https://github.com/gem/oq-engine/issues/5230
@@ -221,6 +226,8 @@ try:
     CT = len(psutil.Process().cpu_affinity()) * 2
 except AttributeError:
     CT = psutil.cpu_count() * 2
+# arrays smaller than that are sent inline even when shared_results is set
+SHARED_MIN_BYTES = 1E5
 
 
 @submit.add('no')
@@ -271,6 +278,35 @@ def oq_distribute(task=None):
     return dist
 
 
+class _SharedPickler(pickle.Pickler):
+    # a pickler storing the big numpy arrays in scratch files
+    def __init__(self, file, scratch_dir):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.scratch_dir = scratch_dir
+        self.nbytes = 0
+
+    def persistent_id(self, obj):
+        if (isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject
+                and obj.nbytes >= SHARED_MIN_BYTES):
+            fd, fname = tempfile.mkstemp(dir=self.scratch_dir, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, obj)
+            self.nbytes += obj.nbytes
+            return fname
+
+
+class _SharedUnpickler(pickle.Unpickler):
+    # an unpickler memory-mapping the arrays stored by _SharedPickler
+    def persistent_load(self, fname):
+        # copy-on-write mapping, so that the array can be modified in-place
+        arr = numpy.load(fname, mmap_mode='c')
+        try:
+            os.remove(fname)  # the mapping survives the removal
+        except OSError:  # on Windows; the file is removed in Starmap._loop
+            pass
+        return arr
+
+
 class Pickled(object):
     """
     An utility to manually pickling/unpickling objects.
@@ -280,12 +316,27 @@ class Pickled(object):
     of the pickled bytestring.
 
     :param obj: the object to pickle
+    :param scratch_dir:
+        if given, the big numpy arrays inside `obj` are not pickled but
+        saved in scratch files in that directory and memory-mapped when
+        unpickling; only works when the unpickling process shares the
+        filesystem with the pickling process
     """
-    def __init__(self, obj):
+    shared = 0  # number of bytes stored in scratch files
+
+    def __init__(self, obj, scratch_dir=None):
         self.clsname = obj.__class__.__name__
         self.calc_id = str(getattr(obj, 'calc_id', ''))  # for monitors
+        self.scratch_dir = scratch_dir
         try:
-            self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            if scratch_dir:
+                f = io.BytesIO()
+                pickler = _SharedPickler(f, scratch_dir)
+                pickler.dump(obj)
+                self.pik = f.getvalue()
+                self.shared = pickler.nbytes
+            else:
+                self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
         except TypeError as exc:  # can't pickle, show the obj in the message
             raise TypeError('%s: %s' % (exc, obj))
 
@@ -300,6 +351,8 @@ class Pickled(object):
 
     def unpickle(self):
         """Unpickle the underlying object"""
+        if self.scratch_dir:
+            return _SharedUnpickler(io.BytesIO(self.pik)).load()
         return pickle.loads(self.pik)
 
 
@@ -368,11 +421,17 @@ class Result(object):
     func = None
 
     def __init__(self, val, mon, tb_str='', msg=''):
-        if isinstance(val, dict):
+        scratch_dir = getattr(mon, 'scratch_dir', None)
+        if isinstance(val, dict) and scratch_dir and not tb_str:
+            # send only the descriptors of the big arrays
+            self.pik = Pickled(val, scratch_dir)
+            self.nbytes = {'tot': len(self.pik), 'shared': self.pik.shared}
+        elif isinstance(val, dict):
             self.pik = Pickled(val)
             self.nbytes = {k: len(Pickled(v)) for k, v in val.items()}
         elif isinstance(val, tuple) and callable(val[0]):
             self.func = val[0]
+            self.weight = getattr(val[1], 'weight', 1.)  # used in Starmap
             self.pik = pickle_sequence(val[1:])
             self.nbytes = {'args': sum(len(p) for p in self.pik)}
         elif msg == 'TASK_ENDED':
@@ -463,9 +522,10 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
     :param mon: a monitor
     """
     isgenfunc = inspect.isgeneratorfunction(func)
-    if hasattr(args[0], 'unpickle'):
-        # args is a list of Pickled objects
-        args = [a.unpickle() for a in args]
+    if any(isinstance(a, Pickled) for a in args):
+        # args is a list of Pickled objects, possibly with a split first
+        # argument not pickled, see _split_in_two
+        args = [a.unpickle() if isinstance(a, Pickled) else a for a in args]
     if mon is dummy_mon:  # in the DbServer
         assert not isgenfunc, func
         return Result.new(func, args, mon)
@@ -606,6 +666,102 @@ class IterResult(object):
         return res
 
 
+class CostModel(object):
+    """
+    A model of the cost of the tasks, learned from the durations of the
+    completed tasks. The cost is measured as time per unit of weight and
+    it is kept separately for each task function and kind of task (for
+    instance the tectonic region type in classical calculations):
+
+    >>> cm = CostModel()
+    >>> cm.update('classical', 'Active Shallow Crust', 100, 2.)
+    >>> cm.update('classical', 'Active Shallow Crust', 300, 6.)
+    >>> cm.update('classical', 'Stable Shallow Crust', 100, 1.)
+    >>> cm.estimate('classical', 'Active Shallow Crust', 1000)
+    20.0
+    >>> cm.estimate('classical', 'Subduction Interface', 1000)  # by task
+    18.0
+
+    :param array: an array of dtype task_cost_dt from a previous run
+    """
+    def __init__(self, array=()):
+        # (taskname, kind) -> (weight, duration, counts)
+        self.acc = AccumDict(accum=numpy.zeros(3))
+        self.learned = AccumDict(accum=numpy.zeros(3))  # only this run
+        for rec in array:
+            key = decode(rec['taskname']), decode(rec['kind'])
+            self.acc[key] += [rec['weight'], rec['duration'], rec['counts']]
+
+    def update(self, taskname, kind, weight, duration):
+        """
+        Update the model with the information of a completed task
+        """
+        self.acc[taskname, kind] += [weight, duration, 1]
+        self.learned[taskname, kind] += [weight, duration, 1]
+
+    def _get(self, taskname, kind=None):
+        # total weight, duration and counts for the given task and kind;
+        # if kind is None, sum on all kinds
+        if kind is not None:
+            return self.acc.get((taskname, kind), numpy.zeros(3))
+        return sum((arr for (name, _), arr in self.acc.items()
+                    if name == taskname), numpy.zeros(3))
+
+    def time_per_weight(self, taskname, kind):
+        """
+        :returns:
+            the time per unit of weight for the given task and kind,
+            falling back on all kinds and then on all tasks, or None
+        """
+        for w, dt, _ in [self._get(taskname, kind), self._get(taskname),
+                         sum(self.acc.values(), numpy.zeros(3))]:
+            if w > 0 and dt > 0:
+                return dt / w
+
+    def estimate(self, taskname, kind, weight):
+        """
+        :returns: the estimated duration of a task, or None if unknown
+        """
+        tpw = self.time_per_weight(taskname, kind)
+        if tpw is not None:
+            return weight * tpw
+
+    def mean_duration(self, taskname):
+        """
+        :returns: the mean duration of the tasks learned in this run
+        """
+        w, dt, n = sum((arr for (name, _), arr in self.learned.items()
+                        if name == taskname), numpy.zeros(3))
+        if n:
+            return dt / n
+
+    def to_array(self):
+        """
+        :returns: the learned information as an array of dtype task_cost_dt
+        """
+        return numpy.array([(name, kind, w, dt, n) for (name, kind), (w, dt, n)
+                            in sorted(self.learned.items())], task_cost_dt)
+
+
+def _split_in_two(args):
+    # split the first argument in two halves of similar weight, if possible;
+    # the halves are not pickled here, but only once when submitted, and
+    # their weights are the ones already stored in the items
+    arg0 = args[0]
+    if isinstance(arg0, Pickled):
+        arg0 = arg0.unpickle()
+    if not isinstance(arg0, WeightedSequence) or len(arg0) < 2:
+        return []
+    items = list(arg0)  # usually sorted by decreasing weight
+    weights = numpy.array([getattr(item, 'weight', 1.) for item in items])
+    scale = arg0.weight / weights.sum() if weights.sum() else 0
+    out = []
+    for i in (0, 1):
+        blk = WeightedSequence(zip(items[i::2], weights[i::2] * scale))
+        out.append(((blk,) + tuple(args[1:]), blk.weight))
+    return out
+
+
 def init_workers():
     """Waiting function, used to wake up the process pool"""
     setproctitle('oq-worker')
@@ -636,6 +792,9 @@ class Starmap(object):
     # use only the "visible" cores, not the total system cores
     # if the underlying OS supports it (macOS does not)
     num_cores = None
+    # queued tasks expected to last more than that are split in two;
+    # if None, use twice the mean duration of the tasks completed so far
+    max_duration = None
 
     @classmethod
     def init(cls, poolsize=None, distribute=None):
@@ -720,15 +879,27 @@ class Starmap(object):
             self.calc_id = None
             h5 = hdf5.File(gettemp(suffix='.hdf5'), 'w')
             init_performance(h5)
+        # the cost model is updated as the results arrive
+        self.cost_model = CostModel(
+            h5['task_cost'][()] if 'task_cost' in h5 else ())
         self.monitor = Monitor(task_func.__name__)
         self.monitor.filename = h5.filename
         self.monitor.calc_id = self.calc_id
+        if (self.distribute == 'processpool' and
+                config.distribution.get('shared_results')):
+            # the workers save the big arrays here, see Result
+            self.monitor.scratch_dir = tempfile.mkdtemp(
+                prefix='calc_%s_' % self.calc_id)
+        else:
+            self.monitor.scratch_dir = None
         self.name = self.monitor.operation or task_func.__name__
         self.task_args = task_args
         self.progress = progress
         self.h5 = h5
         self.num_cores = num_cores
-        self.task_queue = []
+        self.task_queue = []  # heap of queued tasks by estimated cost
+        self.queued = AccumDict(accum=0)  # kind -> number of queued tasks
+        self.qno = 0  # number of tasks ever queued, to break the ties
         try:
             self.num_tasks = len(self.task_args)
         except TypeError:  # generators have no len
@@ -741,6 +912,7 @@ class Starmap(object):
             config.dbserver.listen, config.dbserver.receiver_ports)
         self.monitor.backurl = None  # overridden later
         self.tasks = []  # populated by .submit
+        self.running = AccumDict(accum=0)  # kind -> number of running tasks
         self.task_no = 0
         self.t0 = time.time()
         if self.distribute == 'zmq':  # add a check
@@ -765,9 +937,14 @@ class Starmap(object):
             self.prev_percent = percent
         return done
 
-    def submit(self, args, func=None, monitor=None):
+    def submit(self, args, func=None, monitor=None, kind=''):
         """
         Submit the given arguments to the underlying task
+
+        :param args: the arguments of the task
+        :param func: the task function (if None, use self.task_func)
+        :param monitor: the monitor (if None, use self.monitor)
+        :param kind: the kind of the task, used in the cost model
         """
         monitor = monitor or self.monitor
         func = func or self.task_func
@@ -778,6 +955,8 @@ class Starmap(object):
             monitor.backurl = 'tcp://%s:%s' % (
                 config.dbserver.host, self.socket.port)
             monitor.version = __version__
+        if kind:  # the subtasks inherit the kind from the monitor
+            monitor = monitor.new(monitor.operation, kind=kind)
         OQ_TASK_NO = os.environ.get('OQ_TASK_NO')
         if OQ_TASK_NO is not None and self.task_no != int(OQ_TASK_NO):
             self.task_no += 1
@@ -798,6 +977,7 @@ class Starmap(object):
         res = submit[dist](self, func, args, monitor)
         self.task_no += 1
         self.tasks.append(res)
+        self.running[kind] += 1
 
     def submit_all(self):
         """
@@ -807,8 +987,9 @@ class Starmap(object):
             for args in self.task_args:
                 self.submit(args)
         else:  # build a task queue in advance
-            self.task_queue = [(self.task_func, args)
-                               for args in self.task_args]
+            for args in self.task_args:
+                self._push_task(self.task_func, args,
+                                getattr(args[0], 'weight', 1.), '')
         return self.get_results()
 
     def get_results(self):
@@ -827,22 +1008,53 @@ class Starmap(object):
     def __iter__(self):
         return iter(self.submit_all())
 
+    def pending(self, kind=''):
+        """
+        :param kind: the kind of the tasks, as passed to .submit
+        :returns: the number of tasks of the given kind running or queued
+        """
+        return self.running[kind] + self.queued[kind]
+
+    def _push_task(self, func, args, weight, kind):
+        # add a task to the queue, with the cost estimated only once
+        cost = self.cost_model.estimate(func.__name__, kind, weight)
+        self.qno += 1
+        heapq.heappush(self.task_queue, (
+            -(weight if cost is None else cost), self.qno, func, args,
+            weight, kind))
+        self.queued[kind] += 1
+
+    def _pop_task(self):
+        # remove from the queue the task with the largest estimated cost,
+        # splitting it in two if it is expected to be too slow
+        model = self.cost_model
+        _, _, func, args, weight, kind = heapq.heappop(self.task_queue)
+        self.queued[kind] -= 1
+        max_duration = self.max_duration or 2 * (
+            model.mean_duration(func.__name__) or numpy.inf)
+        duration = model.estimate(func.__name__, kind, weight)
+        if duration is not None and duration > max_duration:
+            halves = _split_in_two(args)
+            if halves:
+                (args, weight), (args2, weight2) = halves
+                self._push_task(func, args2, weight2, kind)
+                logging.debug('Split a task of weight %d in two',
+                              weight + weight2)
+        return func, args, kind
+
     def _submit_many(self, howmany):
         for _ in range(howmany):
             if self.task_queue:
-                # remove in LIFO order
-                func, args = self.task_queue[0]
-                del self.task_queue[0]
-                self.submit(args, func=func)
+                func, args, kind = self._pop_task()
+                self.submit(args, func=func, kind=kind)
                 self.todo += 1
 
     def _loop(self):
         num_cores = self.num_cores or CT // 2
-        if self.task_queue:
-            first_args = self.task_queue[:num_cores]
-            self.task_queue[:] = self.task_queue[num_cores:]
-            for func, args in first_args:
-                self.submit(args, func=func)
+        for _ in range(num_cores):
+            if self.task_queue:  # submit the heaviest tasks first
+                func, args, kind = self._pop_task()
+                self.submit(args, func=func, kind=kind)
         if not hasattr(self, 'socket'):  # no submit was ever made
             return ()
 
@@ -861,12 +1073,17 @@ class Starmap(object):
                                 'is job %d', res.mon.calc_id, self.calc_id)
             elif res.msg == 'TASK_ENDED':
                 self.todo -= 1
+                self.running[getattr(res.mon, 'kind', '')] -= 1
+                self.cost_model.update(
+                    res.mon.operation[6:], getattr(res.mon, 'kind', ''),
+                    res.mon.weight, res.mon.duration)
                 self._submit_many(1)
                 logging.debug('%d tasks todo, %d in queue',
                               self.todo, len(self.task_queue))
                 yield res
             elif res.func:  # add subtask
-                self.task_queue.append((res.func, res.pik))
+                self._push_task(res.func, res.pik, res.weight,
+                                getattr(res.mon, 'kind', ''))
                 if self.num_cores is None:
                     self._submit_many(1)  # oversubmit
                 elif self.todo < self.num_cores:
@@ -876,6 +1093,11 @@ class Starmap(object):
         self.log_percent()
         self.socket.__exit__(None, None, None)
         self.tasks.clear()
+        if 'task_cost' in self.h5:  # store the learned cost model
+            hdf5.extend(self.h5['task_cost'], self.cost_model.to_array())
+        if self.monitor.scratch_dir:
+            # remove the files of the discarded results, if any
+            shutil.rmtree(self.monitor.scratch_dir, ignore_errors=True)
 
 
 def sequential_apply(task, args, concurrent_tasks=CT,
@@ -40,6 +40,9 @@ task_info_dt = numpy.dtype(
     [('taskname', '<S50'), ('task_no', numpy.uint32),
      ('weight', numpy.float32), ('duration', numpy.float32),
      ('received', numpy.int64), ('mem_gb', numpy.float32)])
+task_cost_dt = numpy.dtype(
+    [('taskname', '<S50'), ('kind', '<S100'), ('weight', numpy.float64),
+     ('duration', numpy.float64), ('counts', numpy.uint32)])
 
 
 def init_performance(hdf5file, swmr=False):
@@ -52,6 +55,8 @@ def init_performance(hdf5file, swmr=False):
         hdf5.create(h5, 'performance_data', perf_dt)
     if 'task_info' not in h5:
         hdf5.create(h5, 'task_info', task_info_dt)
+    if 'task_cost' not in h5:
+        hdf5.create(h5, 'task_cost', task_cost_dt)
     if 'task_sent' not in h5:
         h5['task_sent'] = '{}'
     if swmr:
@@ -36,6 +36,10 @@ def get_length(data, monitor):
     return {'n': len(data)}
 
 
+def get_array(n, monitor):
+    return {'arr': numpy.arange(n, dtype=float), 'n': n}
+
+
 def gfunc(text, monitor):
     for char in text:
         yield char * 3
@@ -148,6 +152,76 @@ class StarmapTestCase(unittest.TestCase):
         smap = parallel.Starmap(countletters, data)
         self.assertEqual(smap.reduce(), {'n': 19})
 
+    def test_cost_model(self):
+        blocks = [general.WeightedSequence([(c, 1) for c in 'ab']),
+                  general.WeightedSequence([(c, 1) for c in 'cdefgh'])]
+        smap = parallel.Starmap(get_length, [(blk,) for blk in blocks],
+                                distribute='no', num_cores=1)
+        smap.max_duration = 1E-9  # split the tasks as soon as possible
+        res = [dic['n'] for dic in smap]
+        # the heaviest task is run first, then the other one is split
+        self.assertEqual(res, [6, 1, 1])
+        [rec] = smap.h5['task_cost'][()]
+        self.assertEqual(rec['counts'], 3)
+        self.assertEqual(rec['weight'], 8)
+        model = parallel.CostModel(smap.h5['task_cost'][()])
+        self.assertGreater(model.time_per_weight('get_length', ''), 0)
+
+    def test_pending(self):
+        smap = parallel.Starmap(get_length, distribute='no')
+        for kind, data in [('a', 'xx'), ('b', 'yyy'), ('a', 'z')]:
+            smap.submit((data,), kind=kind)
+        self.assertEqual(smap.pending('a'), 2)
+        self.assertEqual(smap.pending('b'), 1)
+        res = smap.reduce(lambda acc, dic: acc + [dic['n']], [])
+        self.assertEqual(sorted(res), [1, 2, 3])
+        self.assertEqual(smap.pending('a'), 0)
+        self.assertEqual(smap.pending('b'), 0)
+
+    def test_task_queue(self):
+        # the queued tasks are popped by decreasing estimated cost
+        smap = parallel.Starmap(get_length, distribute='no')
+        for kind, weight in [('a', 1), ('b', 3), ('a', 2)]:
+            blk = general.WeightedSequence([('x', weight)])
+            smap._push_task(get_length, (blk,), weight, kind)
+        self.assertEqual(smap.pending('a'), 2)
+        weights = [smap._pop_task()[1][0].weight for _ in range(3)]
+        self.assertEqual(weights, [3, 2, 1])
+        self.assertEqual(smap.pending('a'), 0)
+
+        # a pickled argument is split in halves which are not pickled
+        blk = general.WeightedSequence([(c, 1) for c in 'abc'])
+        halves = parallel._split_in_two(
+            [parallel.Pickled(blk), parallel.Pickled(None)])
+        self.assertEqual([list(args[0]) for args, _ in halves],
+                         [['a', 'c'], ['b']])
+        self.assertEqual([w for _, w in halves], [2, 1])
+
+    def test_shared_results(self):
+        dist = dict(parallel.config.distribution, shared_results=1)
+        with mock.patch.dict(parallel.config, distribution=dist):
+            smap = parallel.Starmap(get_array, [(10,), (100000,)],
+                                    distribute='processpool')
+            scratch_dir = smap.monitor.scratch_dir
+            res = sorted(smap, key=lambda dic: dic['n'])
+        numpy.testing.assert_equal(res[0]['arr'], numpy.arange(10))
+        numpy.testing.assert_equal(res[1]['arr'], numpy.arange(100000))
+        res[1]['arr'] += 1  # the memory-mapped arrays are writable
+        self.assertFalse(os.path.exists(scratch_dir))
+
+    def test_pickled_shared(self):
+        tmpdir = tempfile.mkdtemp()
+        arr = numpy.arange(100000, dtype=numpy.float32)
+        pik = parallel.Pickled({'big': arr, 'small': arr[:10]}, tmpdir)
+        self.assertEqual(pik.shared, arr.nbytes)  # only the big one
+        self.assertLess(len(pik), 1000)
+        self.assertEqual(len(os.listdir(tmpdir)), 1)
+        dic = pik.unpickle()
+        numpy.testing.assert_equal(dic['big'], arr)
+        numpy.testing.assert_equal(dic['small'], arr[:10])
+        self.assertEqual(os.listdir(tmpdir), [])  # scratch file removed
+        shutil.rmtree(tmpdir)
+
     @classmethod
     def tearDownClass(cls):
         parallel.Starmap.shutdown()
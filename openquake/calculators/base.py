@@ -41,6 +41,7 @@ from openquake.hazardlib.source import rupture
 from openquake.hazardlib.shakemap import get_sitecol_shakemap, to_gmfs
 from openquake.risklib import riskinput, riskmodels
 from openquake.commonlib import readinput, logictree, util
+from openquake.commonlib.calc import convert_rupgeoms
 from openquake.calculators.ucerf_base import UcerfFilter
 from openquake.calculators.export import export as exp
 from openquake.calculators import getters
@@ -549,6 +550,9 @@ class HazardCalculator(BaseCalculator):
             parent = util.read(oq.hazard_calculation_id)
             self.check_precalc(parent['oqparam'].calculation_mode)
             self.datastore.parent = parent
+            if 'rupgeoms' in parent and len(parent['rupgeoms'].shape) == 1:
+                # ruptures stored by an engine using a row per geometry
+                convert_rupgeoms(parent, self.datastore.hdf5)
             # copy missing parameters from the parent
             if 'concurrent_tasks' not in vars(self.oqparam):
                 self.oqparam.concurrent_tasks = (
@@ -556,6 +560,8 @@ class HazardCalculator(BaseCalculator):
             params = {name: value for name, value in
                       vars(parent['oqparam']).items()
                       if name not in vars(self.oqparam)}
+            if oq.regenerate_gmfs:  # the parent may not have stored the GMFs
+                params.pop('ground_motion_fields', None)
             self.save_params(**params)
             with self.monitor('importing inputs', measuremem=True):
                 self.read_inputs()
@@ -759,6 +765,8 @@ class HazardCalculator(BaseCalculator):
                              len(self.assetcol), len(assetcol))
                 nsites = len(self.sitecol)
                 if (oq.spatial_correlation != 'no' and
+                        'taper_distance' not in
+                        oq.ground_motion_correlation_params and
                         nsites > MAXSITES):  # hard-coded, heuristic
                     raise ValueError(CORRELATION_MATRIX_TOO_LARGE % nsites)
             elif hasattr(self, 'sitecol') and general.not_equal(
@@ -990,15 +998,25 @@ class RiskCalculator(HazardCalculator):
         return riskinputs
 
     def _gen_riskinputs_gmf(self, dstore):
-        if 'gmf_data' not in dstore:  # needed for case_shakemap
-            dstore.close()
+        regenerate = self.oqparam.regenerate_gmfs
+        if 'gmf_data' not in dstore and not regenerate:
+            dstore.close()  # needed for case_shakemap
             dstore = self.datastore
-        if 'gmf_data' not in dstore:
-            raise InvalidFile('Did you forget gmfs_csv in %s?'
-                              % self.oqparam.inputs['job_ini'])
+        if 'gmf_data' not in dstore and not (
+                regenerate and 'ruptures' in dstore):
+            raise InvalidFile('Did you forget gmfs_csv (or regenerate_gmfs) '
+                              'in %s?' % self.oqparam.inputs['job_ini'])
         with self.monitor('reading GMFs'):
             rlzs = dstore['events']['rlz_id']
-            gmf_df = dstore.read_df('gmf_data', 'sid')
+            if 'gmf_data' in dstore:
+                gmf_df = dstore.read_df('gmf_data', 'sid')
+            else:  # regenerate the GMFs on the asset sites from the ruptures
+                regen = getters.GmfRegenerator(
+                    self.datastore, self.param['amplifier'],
+                    self.param['sec_perils'])
+                gmf_df = regen.get_gmf_df(
+                    sids=numpy.unique(self.assetcol['site_id']))
+                gmf_df.set_index('sid', inplace=True)
             by_sid = dict(list(gmf_df.groupby(gmf_df.index)))
         logging.info('Grouped the GMFs by site ID')
         for sid, assets in enumerate(self.assetcol.assets_by_site()):
@@ -1011,7 +1029,7 @@ class RiskCalculator(HazardCalculator):
             else:
                 df['rlzs'] = rlzs[df.eid.to_numpy()]
                 getter = getters.GmfDataGetter(sid, df, len(rlzs), self.R)
-            if len(dstore['gmf_data/gmv_0']) == 0:
+            if len(gmf_df) == 0:
                 raise RuntimeError(
                     'There are no GMFs available: perhaps you did set '
                     'ground_motion_fields=False or a large minimum_intensity')
@@ -33,8 +33,9 @@ from openquake.baselib import parallel, hdf5
 from openquake.baselib.python3compat import encode
 from openquake.baselib.general import (
     AccumDict, DictArray, block_splitter, groupby, humansize, get_array_nbytes)
-from openquake.hazardlib.contexts import ContextMaker, get_effect
-from openquake.hazardlib.calc.filters import split_sources
+from openquake.hazardlib.contexts import (
+    ContextMaker, GsimTables, get_effect, report_dt)
+from openquake.hazardlib.calc.filters import split_sources, SplitCache
 from openquake.hazardlib.calc.hazard_curve import classical
 from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.commonlib import calc, util, logs, readinput
@@ -73,9 +74,27 @@ def get_extreme_poe(array, imtls):
     return max(array[imtls(imt).stop - 1].max() for imt in imtls)
 
 
+def _read_tables(params, monitor):
+    # add the GSIM tables, if any, without changing the original params
+    if params.get('tabulated_gsims'):
+        return dict(params, gsim_tables=monitor.read('gsim_tables'))
+    return params
+
+
 def classical_(srcs, gsims, params, monitor):
     srcfilter = monitor.read('srcfilter')
-    return classical(srcs, srcfilter, gsims, params, monitor)
+    return classical(srcs, srcfilter, gsims, _read_tables(params, monitor),
+                     monitor)
+
+
+def _split_sources(srcs, monitor):
+    # split the sources by using the persistent cache, if configured
+    cache = SplitCache.from_config()
+    splits, stime = split_sources(srcs, cache)
+    if cache:  # the counts are visible with oq show performance
+        monitor('split cache hits', measuremem=False).counts = cache.hits
+        monitor('split cache misses', measuremem=False).counts = cache.misses
+    return splits, stime
 
 
 def classical_split_filter(srcs, gsims, params, monitor):
@@ -88,14 +107,15 @@ def classical_split_filter(srcs, gsims, params, monitor):
     # first check if we are sampling the sources
     ss = int(os.environ.get('OQ_SAMPLE_SOURCES', 0))
     if ss:
-        splits, stime = split_sources(srcs)
+        splits, stime = _split_sources(srcs, monitor)
         srcs = random_filtered_sources(splits, srcfilter, ss)
-        yield classical(srcs, srcfilter, gsims, params, monitor)
+        yield classical(srcs, srcfilter, gsims, _read_tables(params, monitor),
+                        monitor)
         return
     # NB: splitting all the sources improves the distribution significantly,
     # compared to splitting only the big sources
     with monitor("splitting/filtering sources"):
-        splits, _stime = split_sources(srcs)
+        splits, _stime = _split_sources(srcs, monitor)
         sources = list(srcfilter.filter(splits))
     if not sources:
         yield {'pmap': {}}
@@ -119,7 +139,8 @@ def classical_split_filter(srcs, gsims, params, monitor):
         except Exception:
             # a foreign key error in case of `oq run` is expected
             print(msg)
-    yield classical(blocks[-1], srcfilter, gsims, params, monitor)
+    yield classical(blocks[-1], srcfilter, gsims,
+                    _read_tables(params, monitor), monitor)
 
 
 def preclassical(srcs, gsims, params, monitor):
@@ -130,7 +151,7 @@ def preclassical(srcs, gsims, params, monitor):
     pmap = AccumDict(accum=0)
     with monitor("splitting/filtering sources"):
         srcfilter = monitor.read('srcfilter')
-        splits, _stime = split_sources(srcs)
+        splits, _stime = _split_sources(srcs, monitor)
     totrups = 0
     maxradius = 0
     for src in splits:
@@ -185,6 +206,7 @@ class ClassicalCalculator(base.HazardCalculator):
     """
     core_task = classical_split_filter
     accept_precalc = ['classical']
+    spill_pmaps = False  # set in acc0
 
     def agg_dicts(self, acc, dic):
         """
@@ -230,8 +252,97 @@ class ClassicalCalculator(base.HazardCalculator):
             # store rup_data if there are few sites
             for mag, c in dic['rup_data'].items():
                 store_ctxs(self.datastore, self.rdt, c)
+        if self.spill_pmaps:
+            self.spill(acc)
         return acc
 
+    def init_poes(self, gsims_by_trt, num_levels):
+        """
+        Set the tile size used when the probability maps are spilled to the
+        datastore during the calculation; the datasets poes/grp-XX are
+        created by `_spill` only for the groups actually spilled
+        """
+        gmax = max(len(gsims) for gsims in gsims_by_trt.values())
+        # each tile takes at most 10% of the memory budget
+        self.tile_size = int(
+            self.oqparam.pmap_maxsize / (10 * num_levels * gmax * 8))
+        self.tile_size = min(max(self.tile_size, 1), self.N)
+        self.spilled = set()
+
+    def spill(self, acc, final=False):
+        """
+        Compose the probability maps in the accumulator with the ones
+        in the datastore and remove them from memory. This is done for the
+        groups with all tasks completed and, if the others take more
+        memory than pmap_maxsize, for the largest ones until the remaining
+        maps fit in the budget (or for all of them if final is True).
+        """
+        grp_ids = [key for key in acc if not isinstance(key, str)]
+        if not final:
+            trt_by_grp = self.full_lt.trt_by_grp
+            pending = sorted(
+                (grp_id for grp_id in grp_ids
+                 if self.smap.pending(trt_by_grp[grp_id])),
+                key=lambda grp_id: acc[grp_id].nbytes, reverse=True)
+            grp_ids = [grp_id for grp_id in grp_ids if grp_id not in pending]
+            nbytes = sum(acc[grp_id].nbytes for grp_id in pending)
+            for grp_id in pending:
+                if nbytes <= self.oqparam.pmap_maxsize:
+                    break
+                grp_ids.append(grp_id)
+                nbytes -= acc[grp_id].nbytes
+        if not grp_ids:
+            return
+        with self.monitor('spilling pmaps'):
+            for grp_id in grp_ids:
+                pmap = acc.pop(grp_id)
+                if pmap:
+                    self._spill(grp_id, pmap)
+
+    def _spill(self, grp_id, pmap):
+        # compose the pmap with the stored PoEs, one tile of sites at the time
+        name = 'poes/grp-%02d' % grp_id
+        if grp_id not in self.spilled:  # first time, create the datasets
+            shape = (self.N, pmap.shape_y, pmap.shape_z)
+            dset = self.datastore.create_dset(name + '/array', F64, shape)
+            self.datastore[name + '/sids'] = numpy.arange(self.N, dtype=U32)
+            self.datastore.hdf5.save_attrs(
+                name, {}, __pyclass__=hdf5.cls2dotname(ProbabilityMap))
+            self.spilled.add(grp_id)
+        else:
+            dset = self.datastore[name + '/array']
+        sids = pmap.sids
+        if pmap.dense is not None:
+            rows = pmap.sidx[sids]
+        else:
+            array = pmap.array
+        for start in range(0, self.N, self.tile_size):
+            i0, i1 = numpy.searchsorted(sids, [start, start + self.tile_size])
+            if i0 == i1:  # no sites in the tile
+                continue
+            if pmap.dense is not None:
+                poes = pmap.dense[rows[i0:i1]]
+            else:
+                poes = array[i0:i1]
+            tile = dset[start:start + self.tile_size]
+            idx = sids[i0:i1] - start
+            tile[idx] = 1. - (1. - tile[idx]) * (1. - poes)
+            dset[start:start + self.tile_size] = tile
+
+    def _fix_poes(self, grp_id):
+        # replace the PoEs == 1 in the stored tiles and return the extreme PoE
+        dset = self.datastore['poes/grp-%02d/array' % grp_id]
+        imtls = self.oqparam.imtls
+        lastidx = [imtls(imt).stop - 1 for imt in imtls]
+        extreme = 0
+        for start in range(0, self.N, self.tile_size):
+            tile = dset[start:start + self.tile_size]
+            if (tile == 1.).any():
+                tile[tile == 1.] = .9999999999999999
+                dset[start:start + self.tile_size] = tile
+            extreme = max(extreme, tile[:, lastidx].max())
+        return extreme
+
     def acc0(self):
         """
         Initial accumulator, a dict grp_id -> ProbabilityMap(L, G)
@@ -273,6 +384,11 @@ class ClassicalCalculator(base.HazardCalculator):
         self.by_task = {}  # task_no => src_ids
         self.totrups = 0  # total number of ruptures before collapsing
         self.maxradius = 0
+        self.spill_pmaps = bool(
+            self.oqparam.pmap_maxsize and
+            self.oqparam.calculation_mode != 'preclassical')
+        if self.spill_pmaps:
+            self.init_poes(gsims_by_trt, num_levels)
 
         # estimate max memory per core
         max_num_gsims = max(len(gsims) for gsims in gsims_by_trt.values())
@@ -363,7 +479,15 @@ class ClassicalCalculator(base.HazardCalculator):
                 self.datastore['effect_by_mag_dst'] = aw
         smap = parallel.Starmap(classical, h5=self.datastore.hdf5,
                                 num_cores=oq.num_cores)
+        if self.datastore.parent and 'task_cost' in self.datastore.parent:
+            # reuse the cost model learned in the parent calculation
+            smap.cost_model = parallel.CostModel(
+                self.datastore.parent['task_cost'][()])
+        self.smap = smap
         smap.monitor.save('srcfilter', self.src_filter())
+        if oq.tabulated_gsims:
+            smap.monitor.save('gsim_tables', self.build_gsim_tables(
+                mags_by_trt, gsims_by_trt))
         self.submit_tasks(smap)
         acc0 = self.acc0()  # create the rup/ datasets BEFORE swmr_on()
         self.datastore.swmr_on()
@@ -406,6 +530,40 @@ class ClassicalCalculator(base.HazardCalculator):
         self.calc_times.clear()  # save a bit of memory
         return acc
 
+    def build_gsim_tables(self, mags_by_trt, gsims_by_trt):
+        """
+        Build the tables of means and stddevs for the point ruptures and
+        store a report with the interpolation errors in gsim_tables.
+
+        :returns: a dictionary trt -> GsimTables
+        """
+        oq = self.oqparam
+        depths = AccumDict(accum=set())  # trt -> hypocentral depths
+        for sg in self.csm.src_groups:
+            for src in sg:
+                hdd = getattr(src, 'hypocenter_distribution', None)
+                if hdd:  # same depth as in PointSource.point_ruptures
+                    weights, deps = zip(*hdd.data)
+                    depths[sg.trt].add(numpy.average(deps, weights=weights))
+        param = dict(imtls=oq.imtls, truncation_level=oq.truncation_level,
+                     maximum_distance=oq.maximum_distance)
+        tables = {}
+        report = []
+        with self.monitor('building gsim tables'):
+            for trt, gsims in gsims_by_trt.items():
+                if trt not in depths:  # no point sources
+                    continue
+                cmaker = ContextMaker(trt, gsims, param)
+                mags = [float(mag) for mag in mags_by_trt[trt]]
+                tables[trt] = tab = GsimTables(
+                    cmaker, self.sitecol, mags, depths[trt],
+                    oq.tabulation_tolerance)
+                report.extend(tab.report)
+                logging.info('Tabulated %d/%d GSIMs for %s', len(tab.tables),
+                             len(gsims), trt)
+        self.datastore['gsim_tables'] = numpy.array(report, report_dt)
+        return tables
+
     def submit_tasks(self, smap):
         """
         Submit tasks to the passed Starmap
@@ -450,6 +608,8 @@ class ClassicalCalculator(base.HazardCalculator):
             shift_hypo=oq.shift_hypo, max_weight=max_weight,
             collapse_level=oq.collapse_level,
             max_sites_disagg=oq.max_sites_disagg,
+            survival_function=oq.survival_function,
+            tabulated_gsims=oq.tabulated_gsims,
             af=self.af)
         for sg in src_groups:
             gsims = gsims_by_trt[sg.trt]
@@ -457,7 +617,7 @@ class ClassicalCalculator(base.HazardCalculator):
             if sg.atomic:
                 # do not split atomic groups
                 nb = 1
-                smap.submit((sg, gsims, param), f1)
+                smap.submit((sg, gsims, param), f1, kind=sg.trt)
             else:  # regroup the sources in blocks
                 blks = (groupby(sg, operator.attrgetter('source_id')).values()
                         if oq.disagg_by_src
@@ -469,7 +629,7 @@ class ClassicalCalculator(base.HazardCalculator):
                     logging.debug('Sending %d source(s) with weight %d',
                                   len(block),
                                   sum(srcweight(src) for src in block))
-                    smap.submit((block, gsims, param), f2)
+                    smap.submit((block, gsims, param), f2, kind=sg.trt)
 
             w = sum(srcweight(src) for src in sg)
             logging.info('TRT = %s', sg.trt)
@@ -524,6 +684,15 @@ class ClassicalCalculator(base.HazardCalculator):
         pgetter = getters.PmapGetter(
             self.datastore, weights, self.sitecol.sids, oq.imtls)
         with self.monitor('saving probability maps'):
+            if self.spill_pmaps:  # store the remaining maps
+                self.spill(pmap_by_key, final=True)
+            for grp_id in sorted(getattr(self, 'spilled', ())):
+                name = 'poes/grp-%02d' % grp_id
+                extreme = self._fix_poes(grp_id)
+                if oq.calculation_mode.endswith(('risk', 'damage', 'bcr')):
+                    with hdf5.File(self.datastore.tempname, 'a') as cache:
+                        self.datastore.hdf5.copy(name, cache, name)
+                data.append((grp_id, self.full_lt.trt_by_grp[grp_id], extreme))
             for key, pmap in pmap_by_key.items():
                 if isinstance(key, str):  # disagg_by_src
                     serial = self.csm.source_info[key][readinput.SERIAL]
@@ -584,6 +753,10 @@ class ClassicalCalculator(base.HazardCalculator):
                     'hmaps-stats', site_id=N, stat=list(hstats),
                     imt=list(oq.imtls), poe=oq.poes)
         ct = oq.concurrent_tasks or 1
+        if oq.pmap_maxsize:  # read the PoEs in tiles smaller than the budget
+            nbytes = sum(dset['array'].size * 8
+                         for dset in self.datastore['poes'].values())
+            ct = max(ct, int(numpy.ceil(nbytes / oq.pmap_maxsize)))
         logging.info('Building hazard statistics')
         self.weights = [rlz.weight for rlz in self.realizations]
         allargs = [  # this list is very fast to generate
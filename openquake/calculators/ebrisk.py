@@ -15,14 +15,13 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+import os
 import logging
 import operator
-import itertools
 from datetime import datetime
 import numpy
 
 from openquake.baselib import datastore, hdf5, parallel, general
-from openquake.baselib.python3compat import zip
 from openquake.hazardlib.calc.filters import getdefault
 from openquake.risklib.scientific import LossesByAsset
 from openquake.risklib.riskinput import (
@@ -34,15 +33,86 @@ from openquake.calculators.post_risk import PostRiskCalculator
 U8 = numpy.uint8
 U16 = numpy.uint16
 U32 = numpy.uint32
+U64 = numpy.uint64
 F32 = numpy.float32
 F64 = numpy.float64
 TWO32 = 2 ** 32
+BLOCKSIZE = 1000000  # number of (asset, event) pairs per block
 get_n_occ = operator.itemgetter(1)
 
 gmf_info_dt = numpy.dtype([('rup_id', U32), ('task_no', U16),
                            ('nsites', U16), ('gmfbytes', F32), ('dt', F32)])
 
 
+def get_slices(offsets, sids):
+    """
+    :param offsets: N+1 offsets of the assets sorted by site ID
+    :param sids: an array of distinct site IDs, in increasing order
+    :returns: a list of slices of contiguous assets on the given sites
+    """
+    starts, stops = offsets[sids], offsets[sids + 1]
+    ok = stops > starts  # discard the sites without assets
+    starts, stops = starts[ok], stops[ok]
+    if len(starts) == 0:
+        return []
+    # merge the ranges of consecutive sites
+    brk = numpy.flatnonzero(starts[1:] != stops[:-1]) + 1
+    return [slice(start, stop) for start, stop in zip(
+        starts[numpy.r_[0, brk]], stops[numpy.r_[brk - 1, len(stops) - 1]])]
+
+
+def read_rows(dset, slices, fields=(), order=None):
+    """
+    :param dset: an HDF5 dataset
+    :param slices: a list of slices on the first axis
+    :param fields: the fields to read (if empty, read all of them)
+    :param order: if not None, a permutation of the rows and the slices
+                  refer to the permuted rows
+    :returns: the concatenated rows
+    """
+    if order is None:
+        return numpy.concatenate(
+            [dset[(slc,) + tuple(fields)] for slc in slices])
+    idxs = numpy.concatenate([order[slc] for slc in slices])
+    srt = numpy.argsort(idxs)  # h5py wants increasing indices
+    rows = dset[(idxs[srt],) + tuple(fields)]
+    out = numpy.empty_like(rows)
+    out[srt] = rows
+    return out
+
+
+def _ranges(starts, counts):
+    # concatenated aranges from starts[i] to starts[i] + counts[i]
+    ends = counts.cumsum()
+    return numpy.repeat(starts - ends + counts, counts) + numpy.arange(
+        ends[-1] if len(ends) else 0)
+
+
+def gen_pairs(assets, gmfs, blocksize=BLOCKSIZE):
+    """
+    Join the assets and the GMFs on the site ID, in blocks.
+
+    :param assets: an array of assets sorted by site_id, all on sites
+                   with GMFs
+    :param gmfs: an array of GMFs sorted by sid
+    :param blocksize: the (approximate) number of pairs per block
+    :yields: arrays of indices (aidx, gidx, num_events), one per
+             (asset, GMF) pair on the same site
+    """
+    sids, gstart, gcount = numpy.unique(
+        gmfs['sid'], return_index=True, return_counts=True)
+    idx = numpy.searchsorted(sids, assets['site_id'])
+    counts = gcount[idx]  # number of GMFs for each asset
+    # an asset is never split across blocks
+    blk = (counts.cumsum() - counts) // blocksize
+    cuts = numpy.flatnonzero(numpy.diff(blk)) + 1
+    for a0, a1 in zip(numpy.r_[0, cuts], numpy.r_[cuts, len(assets)]):
+        nevents = counts[a0:a1]
+        yield (numpy.repeat(numpy.arange(a0, a1), nevents),
+               _ranges(gstart[idx[a0:a1]], nevents),
+               numpy.repeat(nevents, nevents))
+
+
 def calc_risk(gmfs, param, monitor):
     """
     :param gmfs: an array of GMFs with fields sid, eid, gmv
@@ -53,22 +123,21 @@ def calc_risk(gmfs, param, monitor):
     mon_risk = monitor('computing risk', measuremem=False)
     mon_agg = monitor('aggregating losses', measuremem=False)
     dstore = datastore.read(param['hdf5path'])
-    with monitor('getting assets'):
-        assets_df = dstore.read_df('assetcol/array', 'ordinal')
     with monitor('getting crmodel'):
         crmodel = monitor.read('crmodel')
         weights = dstore['weights'][()]
     L = len(param['lba'].loss_names)
     elt_dt = [('event_id', U32), ('loss', (F32, (L,)))]
-    # aggkey -> eid -> loss
     acc = dict(events_per_sid=0, numlosses=numpy.zeros(2, int))  # (kept, tot)
     lba = param['lba']
-    lba.alt = general.AccumDict(  # idx -> eid -> loss
-        accum=general.AccumDict(accum=numpy.zeros(L, F32)))
-    lba.losses_by_E = general.AccumDict(  # eid -> loss
-        accum=numpy.zeros(L, F32))
+    lba.alt = []  # columns aggkey, eid, lni, loss
+    lba.losses_by_E = []  # columns eid, lni, loss
     tempname = param['tempname']
     aggby = param['aggregate_by']
+    tables = crmodel.vulnerability_tables
+    # with all the loss types in the tables the assets are processed in
+    # blocks of (asset, event) pairs, otherwise site by site
+    by_pair = all(lt in tables for lt in crmodel.loss_types)
 
     minimum_loss = []
     for lt, lti in crmodel.lti.items():
@@ -77,34 +146,81 @@ def calc_risk(gmfs, param, monitor):
         if lt in lba.policy_dict:  # same order as in lba.compute
             minimum_loss.append(val)
 
-    haz_by_sid = general.group_array(gmfs, 'sid')
-    for sid, asset_df in assets_df.groupby('site_id'):
-        try:
-            haz = haz_by_sid[sid]
-        except KeyError:  # no hazard here
-            continue
-        with mon_risk:
-            assets = asset_df.to_records()  # fast
-            acc['events_per_sid'] += len(haz)
-            if param['avg_losses']:
-                ws = weights[haz['rlz']]
-            else:
-                ws = None
-            assets_by_taxo = get_assets_by_taxo(assets, tempname)  # fast
-            out = get_output(crmodel, assets_by_taxo, haz)  # slow
-        with mon_agg:
-            tagidxs = assets[aggby] if aggby else None
-            acc['numlosses'] += lba.aggregate(
-                out, haz['eid'], minimum_loss, tagidxs, ws)
-    if len(gmfs):
-        acc['events_per_sid'] /= len(gmfs)
-    acc['elt'] = numpy.fromiter(  # this is ultra-fast
-        ((eid, losses)
-         for eid, losses in lba.losses_by_E.items() if losses.sum()),
-        elt_dt)
-    acc['alt'] = {idx: numpy.fromiter(  # already sorted by aid, ultra-fast
-        ((eid, loss) for eid, loss in lba.alt[idx].items()), elt_dt)
-                  for idx in lba.alt}
+    # sort by site and then by event, as in get_output
+    gmfs = gmfs[numpy.lexsort((gmfs['eid'], gmfs['sid']))]
+    with monitor('getting assets'):
+        slices = get_slices(dstore['asset_offsets'][()],
+                            numpy.unique(gmfs['sid']))
+        # the permutation sorting the assets by site, if they are not
+        order = (dstore['asset_order'][()] if 'asset_order' in dstore
+                 else None)
+        if not slices:  # no assets on the sites with hazard
+            slices = [slice(0, 0)]
+        fields = ['ordinal', 'site_id', 'taxonomy'] + [
+            'occupants_None' if lt == 'occupants' else 'value-' + lt
+            for lt in crmodel.loss_types]
+        for field in aggby:  # h5py rejects duplicated fields
+            if field not in fields:
+                fields.append(field)
+        if lba.policy_dict and lba.policy_name not in fields:
+            fields.append(lba.policy_name)
+        assets = read_rows(dstore['assetcol/array'], slices,
+                           fields if by_pair else (), order)
+        if by_pair and tempname and len(assets):
+            with hdf5.File(tempname, 'r') as h5:
+                eps = read_rows(h5['epsilon_matrix'], slices, (), order)
+        else:
+            eps = None
+    if len(assets):
+        acc['events_per_sid'] = numpy.isin(
+            gmfs['sid'], assets['site_id']).sum() / len(gmfs)
+    if param['avg_losses']:
+        ws = weights[gmfs['rlz']]
+    else:
+        ws = None
+    # encode the tag indices of the assets as integer keys
+    aggkeys = numpy.ravel_multi_index(
+        [assets[tagname] - 1 for tagname in aggby],
+        param['aggshape']) if aggby else None
+
+    if by_pair:
+        for aidx, gidx, nevents in gen_pairs(assets, gmfs):
+            with mon_risk:
+                haz = gmfs[gidx]
+                taxos = assets['taxonomy'][aidx]
+                epsilons = None if eps is None else eps[aidx, haz['eid']]
+                lratios = {lt: tables[lt].ratios_by_pair(
+                    taxos, haz['gmv'], epsilons)
+                           for lt in crmodel.loss_types}
+            with mon_agg:
+                acc['numlosses'] += lba.aggregate_pairs(
+                    assets[aidx], haz['eid'], lratios, minimum_loss,
+                    None if aggkeys is None else aggkeys[aidx],
+                    None if ws is None else ws[gidx], nevents)
+    else:  # site by site, as for the beta and PMF distributions
+        gsids, gstart, gcount = numpy.unique(
+            gmfs['sid'], return_index=True, return_counts=True)
+        sids, astart = numpy.unique(assets['site_id'], return_index=True)
+        astop = numpy.r_[astart[1:], len(assets)]
+        for sid, a0, a1 in zip(sids, astart, astop):
+            with mon_risk:
+                s = numpy.searchsorted(gsids, sid)
+                g0 = gstart[s]
+                haz = gmfs[g0:g0 + gcount[s]]
+                assets_by_taxo = get_assets_by_taxo(assets[a0:a1], tempname)
+                out = get_output(crmodel, assets_by_taxo, haz)  # slow
+            with mon_agg:
+                acc['numlosses'] += lba.aggregate(
+                    out, haz['eid'], minimum_loss,
+                    None if aggkeys is None else aggkeys[a0:a1],
+                    None if ws is None else ws[g0:g0 + gcount[s]])
+    with mon_agg:
+        eids, losses = lba.get_losses_by_E()
+        ok = losses.sum(axis=1) != 0
+        acc['elt'] = numpy.zeros(ok.sum(), elt_dt)
+        acc['elt']['event_id'] = eids[ok]
+        acc['elt']['loss'] = losses[ok]
+        acc['alt'] = lba.get_alt()
     if param['avg_losses']:
         acc['losses_by_A'] = param['lba'].losses_by_A * param['ses_ratio']
         # without resetting the cache the sequential avg_losses would be wrong!
@@ -161,14 +277,6 @@ def ebrisk(rupgetter, param, monitor):
     return res
 
 
-def gen_indices(tagcol, aggby):
-    alltags = [getattr(tagcol, tagname) for tagname in aggby]
-    ranges = [range(1, len(tags)) for tags in alltags]
-    for idxs in itertools.product(*ranges):
-        d = {name: tags[idx] for idx, name, tags in zip(idxs, aggby, alltags)}
-        yield idxs, d
-
-
 @base.calculators.add('ebrisk')
 class EbriskCalculator(event_based.EventBasedCalculator):
     """
@@ -178,6 +286,7 @@ class EbriskCalculator(event_based.EventBasedCalculator):
     is_stochastic = True
     precalc = 'event_based'
     accept_precalc = ['event_based', 'event_based_risk']
+    chunksize = 1_000_000  # number of rows of the event_loss_table sorted
 
     def pre_execute(self):
         oq = self.oqparam
@@ -188,9 +297,20 @@ class EbriskCalculator(event_based.EventBasedCalculator):
                           self.policy_name, self.policy_dict))
         self.param['ses_ratio'] = oq.ses_ratio
         self.param['aggregate_by'] = oq.aggregate_by
+        self.param['aggshape'] = self.assetcol.tagcol.agg_shape(
+            (), oq.aggregate_by)
         ct = oq.concurrent_tasks or 1
         self.param['maxweight'] = int(oq.ebrisk_maxsize / ct)
         self.A = A = len(self.assetcol)
+        # offsets of the assets by site, used by the tasks to read
+        # only the assets on the sites affected by the ruptures
+        sids = self.assetcol['site_id']
+        if (numpy.diff(sids) < 0).any():  # store the sorting permutation
+            order = numpy.argsort(sids, kind='stable')
+            self.datastore['asset_order'] = order
+            sids = sids[order]
+        self.datastore['asset_offsets'] = numpy.searchsorted(
+            sids, numpy.arange(len(self.sitecol.complete) + 1))
         self.L = L = len(lba.loss_names)
         self.check_number_loss_curves()
         mal = {lt: getdefault(oq.minimum_asset_loss, lt)
@@ -204,10 +324,9 @@ class EbriskCalculator(event_based.EventBasedCalculator):
         self.param['minimum_asset_loss'] = mal
 
         elt_dt = [('event_id', U32), ('loss', (F32, (L,)))]
-        for idxs, attrs in gen_indices(self.assetcol.tagcol, oq.aggregate_by):
-            idx = ','.join(map(str, idxs)) + ','
-            self.datastore.create_dset('event_loss_table/' + idx, elt_dt,
-                                       attrs=attrs)
+        self.datastore.create_dset('event_loss_table/agg_id', U32)
+        self.datastore.create_dset('event_loss_table/event_id', U32)
+        self.datastore.create_dset('event_loss_table/loss', F32, (None, L))
         self.param.pop('oqparam', None)  # unneeded
         self.datastore.create_dset('avg_losses-stats', F32, (A, 1, L))  # mean
         elt_nbytes = 4 * self.E * L
@@ -255,6 +374,8 @@ class EbriskCalculator(event_based.EventBasedCalculator):
         smap.reduce(self.agg_dicts)
         if self.indices:
             self.datastore['event_loss_table/indices'] = self.indices
+        with self.monitor('sorting event_loss_table'):
+            self.sort_elt()
         gmf_bytes = self.datastore['gmf_info']['gmfbytes'].sum()
         logging.info(
             'Produced %s of GMFs', general.humansize(gmf_bytes))
@@ -273,14 +394,69 @@ class EbriskCalculator(event_based.EventBasedCalculator):
         self.oqparam.ground_motion_fields = False  # hack
         with self.monitor('saving losses_by_event and event_loss_table'):
             hdf5.extend(self.datastore['losses_by_event'], dic['elt'])
-            for idx, arr in dic['alt'].items():
-                hdf5.extend(self.datastore['event_loss_table/' + idx], arr)
+            for name, col in dic['alt'].items():
+                hdf5.extend(self.datastore['event_loss_table/' + name], col)
         if self.oqparam.avg_losses:
             with self.monitor('saving avg_losses'):
                 self.datastore['avg_losses-stats'][:, 0] += dic['losses_by_A']
         self.events_per_sid.append(dic['events_per_sid'])
         self.numlosses += dic['numlosses']
 
+    def sort_elt(self):
+        """
+        Sort the event_loss_table by agg_id and store the offsets of each
+        aggregation key, so that the losses of the key `agg_id` are in the
+        slice offsets[agg_id]:offsets[agg_id + 1]. The rows are read and
+        written in chunks, so the table is never entirely in memory:
+        first each chunk is sorted, then the rows of each block of keys,
+        which are contiguous in every sorted chunk, are merged and written
+        as a single slice.
+        """
+        elt = self.datastore['event_loss_table']
+        K = numpy.prod(self.param['aggshape'], dtype=int)
+        N, L = elt['loss'].shape
+        slices = list(general.gen_slices(0, N, self.chunksize))
+        counts = numpy.zeros(K, int)
+        for slc in slices:
+            counts += numpy.bincount(elt['agg_id'][slc], minlength=K)
+        offsets = numpy.zeros(K + 1, int)
+        offsets[1:] = counts.cumsum()
+        # blocks of keys with about chunksize rows each
+        bounds = numpy.concatenate([
+            [0], numpy.flatnonzero(
+                numpy.diff(offsets[:-1] // self.chunksize)) + 1, [K]])
+        # the datastore is in SWMR mode, where the datasets cannot be
+        # removed, so the sorted chunks are written in a temporary file and
+        # then merged over the original rows
+        tmpname = general.gettemp(
+            dir=os.path.dirname(self.datastore.filename), suffix='.hdf5')
+        cols = ['agg_id', 'event_id', 'loss']
+        with hdf5.File(tmpname, 'w') as tmp:
+            tmp.create_dataset('agg_id', (N,), elt['agg_id'].dtype)
+            tmp.create_dataset('event_id', (N,), U32)
+            tmp.create_dataset('loss', (N, L), F32)
+            starts = []  # where the blocks start in each sorted chunk
+            for slc in slices:
+                aggids = elt['agg_id'][slc]
+                order = numpy.argsort(aggids, kind='stable')
+                for col in cols:
+                    tmp[col][slc] = elt[col][slc][order]
+                starts.append(slc.start + numpy.searchsorted(
+                    aggids[order], bounds))
+            for b, (k0, k1) in enumerate(zip(bounds[:-1], bounds[1:])):
+                rows = [slice(st[b], st[b + 1]) for st in starts
+                        if st[b] < st[b + 1]]
+                if not rows:
+                    continue
+                data = {col: numpy.concatenate([tmp[col][r] for r in rows])
+                        for col in cols}
+                order = numpy.argsort(data['agg_id'], kind='stable')
+                dest = slice(offsets[k0], offsets[k1])
+                for col in cols:
+                    elt[col][dest] = data[col][order]
+        os.remove(tmpname)
+        self.datastore['event_loss_table/offsets'] = offsets.astype(U64)
+
     def post_execute(self, dummy):
         """
         Compute and store average losses from the losses_by_event dataset,
@@ -20,9 +20,10 @@ import os.path
 import logging
 import operator
 import numpy
+import h5py
 
 from openquake.baselib import hdf5, parallel
-from openquake.baselib.general import AccumDict, copyobj
+from openquake.baselib.general import AccumDict, copyobj, decompress
 from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.hazardlib.stats import compute_pmap_stats
 from openquake.hazardlib.calc.stochastic import sample_ruptures
@@ -31,12 +32,12 @@ from openquake.hazardlib.calc.filters import nofilter
 from openquake.hazardlib import InvalidFile
 from openquake.hazardlib.calc.stochastic import get_rup_array, rupture_dt
 from openquake.hazardlib.source.rupture import EBRupture
-from openquake.hazardlib.geo.mesh import surface_to_array
 from openquake.commonlib import calc, util, logs, readinput, logictree
 from openquake.risklib.riskinput import str2rsi
 from openquake.calculators import base
 from openquake.calculators.getters import (
-    GmfGetter, gen_rupture_getters, sig_eps_dt, time_dt)
+    GmfGetter, gen_rupture_getters, get_shard_dir, sig_eps_dt, time_dt,
+    shard_dt)
 from openquake.calculators.classical import ClassicalCalculator
 from openquake.engine import engine
 
@@ -46,6 +47,8 @@ U32 = numpy.uint32
 F32 = numpy.float32
 F64 = numpy.float64
 TWO32 = numpy.float64(2 ** 32)
+# the GMFs are buffered in the master and stored every 100 MB
+GMF_BUFFER_SIZE = 100 * 1024 ** 2
 by_grp = operator.attrgetter('grp_id')
 
 
@@ -96,7 +99,7 @@ class EventBasedCalculator(base.HazardCalculator):
             self.srcfilter = nofilter
         if not self.datastore.parent:
             self.datastore.create_dset('ruptures', rupture_dt)
-            self.datastore.create_dset('rupgeoms', hdf5.vfloat32)
+            self.datastore.create_dset('rupgeoms', F32, (None, 3))
 
     def acc0(self):
         """
@@ -150,6 +153,8 @@ class EventBasedCalculator(base.HazardCalculator):
                 rup_array['id'] = numpy.arange(
                     self.nruptures, self.nruptures + n)
                 self.nruptures += n
+                # the geometries are appended to a contiguous array of points
+                rup_array['geom_id'] += len(self.datastore['rupgeoms'])
                 hdf5.extend(self.datastore['ruptures'], rup_array)
                 hdf5.extend(self.datastore['rupgeoms'], rup_array.geom)
         if len(self.datastore['ruptures']) == 0:
@@ -173,26 +178,28 @@ class EventBasedCalculator(base.HazardCalculator):
         """
         sav_mon = self.monitor('saving gmfs')
         agg_mon = self.monitor('aggregating hcurves')
-        M = len(self.oqparam.imtls)
-        sec_outputs = self.oqparam.get_sec_outputs()
         with sav_mon:
-            data = result.pop('gmfdata')
-            if len(data):
+            gmfdata = result.pop('gmfdata')
+            if isinstance(gmfdata, bytes):  # compress_gmfs is set
+                gmfdata = decompress(gmfdata)
+            shard = result.pop('gmf_shard', None)
+            if gmfdata or shard is not None:
                 times = result.pop('times')
                 rupids = list(times['rup_id'])
                 self.datastore['gmf_data/time_by_rup'][rupids] = times
-                hdf5.extend(self.datastore['gmf_data/sid'], data['sid'])
-                hdf5.extend(self.datastore['gmf_data/eid'], data['eid'])
-                for m in range(M):
-                    hdf5.extend(self.datastore[f'gmf_data/gmv_{m}'],
-                                data['gmv'][:, m])
-                for m in range(M):
-                    for sec_out in sec_outputs:
-                        hdf5.extend(self.datastore[f'gmf_data/{sec_out}_{m}'],
-                                    data[sec_out][:, m])
+                if shard is not None:  # the GMFs are in the shard file
+                    self.gmf_buffer['shards'].append(shard)
+                    self.offset += shard['nrows'].sum()
+                else:
+                    for name, col in gmfdata.items():
+                        self.gmf_buffer[name].append(col)
+                        self.gmf_nbytes += col.nbytes
+                    self.offset += len(gmfdata['sid'])
                 sig_eps = result.pop('sig_eps')
-                hdf5.extend(self.datastore['gmf_data/sigma_epsilon'], sig_eps)
-                self.offset += len(data)
+                self.gmf_buffer['sigma_epsilon'].append(sig_eps)
+                self.gmf_nbytes += sig_eps.nbytes
+                if self.gmf_nbytes > GMF_BUFFER_SIZE:
+                    self.flush_gmfs()
         if self.offset >= TWO32:
             raise RuntimeError(
                 'The gmf_data table has more than %d rows' % TWO32)
@@ -205,6 +212,50 @@ class EventBasedCalculator(base.HazardCalculator):
         self.datastore.flush()
         return acc
 
+    def flush_gmfs(self):
+        """
+        Append the buffered GMFs to the gmf_data datasets, with a single
+        write per column
+        """
+        for name, cols in self.gmf_buffer.items():
+            hdf5.extend(self.datastore['gmf_data/' + name],
+                        numpy.concatenate(cols))
+        self.gmf_buffer.clear()
+        self.gmf_nbytes = 0
+
+    def build_gmf_vds(self):
+        """
+        Build the gmf_data columns as virtual datasets over the shard files
+        written by the tasks, ordered by task number
+        """
+        oq = self.oqparam
+        shards = numpy.sort(self.datastore['gmf_data/shards'][()],
+                            order='task_no')
+        sec_perils = self.param['sec_perils']
+        if len(shards) == 0:
+            base.create_gmf_data(self.datastore, len(oq.imtls), sec_perils)
+            return
+        cols = ['sid', 'eid']
+        for m in range(len(oq.imtls)):
+            cols.append(f'gmv_{m}')
+            cols.extend(f'{out}_{m}' for sp in sec_perils
+                        for out in sp.outputs)
+        # the paths are relative to the directory of the datastore
+        dirname = os.path.basename(get_shard_dir(self.datastore.filename))
+        for col in cols:
+            dt = U32 if col in ('sid', 'eid') else F32
+            layout = h5py.VirtualLayout((shards['nrows'].sum(),), dt)
+            start = 0
+            for task_no, nrows, _, _ in shards:
+                stop = start + nrows
+                layout[start:stop] = h5py.VirtualSource(
+                    '%s/%d.hdf5' % (dirname, task_no), col, shape=(nrows,))
+                start = stop
+            self.datastore.hdf5.create_virtual_dataset(
+                'gmf_data/' + col, layout)
+        self.datastore.getitem('gmf_data').attrs['__pdcolumns__'] = ' '.join(
+            cols)
+
     def set_param(self, **kw):
         oq = self.oqparam
         # set the minimum_intensity
@@ -236,27 +287,22 @@ class EventBasedCalculator(base.HazardCalculator):
                 {'maximum_distance': oq.maximum_distance,
                  'filter_distance': oq.filter_distance})
             rup = readinput.get_rupture(oq)
-            mesh = surface_to_array(rup.surface).transpose(1, 2, 0).flatten()
             if self.N > oq.max_sites_disagg:  # many sites, split rupture
                 ebrs = [EBRupture(copyobj(rup, rup_id=rup.rup_id + i),
                                   0, 0, G, e0=i * G) for i in range(ngmfs)]
-                meshes = numpy.array([mesh] * ngmfs, object)
             else:  # keep a single rupture with a big occupation number
                 ebrs = [EBRupture(rup, 0, 0, G * ngmfs, rup.rup_id)]
-                meshes = numpy.array([mesh] * ngmfs, object)
-            rup_array = get_rup_array(ebrs, self.srcfilter).array
-            hdf5.extend(self.datastore['rupgeoms'], meshes)
+            aw = get_rup_array(ebrs, self.srcfilter)
+            if len(aw) == 0:
+                raise RuntimeError(
+                    'There are no sites within the maximum_distance'
+                    ' of %s km from the rupture' % oq.maximum_distance(
+                        rup.tectonic_region_type, rup.mag))
         elif oq.inputs['rupture_model'].endswith('.csv'):
             aw = readinput.get_ruptures(oq.inputs['rupture_model'])
             aw.array['n_occ'] = G
-            rup_array = aw.array
-            hdf5.extend(self.datastore['rupgeoms'], aw.geom)
-
-        if len(rup_array) == 0:
-            raise RuntimeError(
-                'There are no sites within the maximum_distance'
-                ' of %s km from the rupture' % oq.maximum_distance(
-                    rup.tectonic_region_type, rup.mag))
+        rup_array = aw.array
+        hdf5.extend(self.datastore['rupgeoms'], aw.geom)
 
         # check the number of branchsets
         branchsets = len(gsim_lt._ltnode)
@@ -276,6 +322,8 @@ class EventBasedCalculator(base.HazardCalculator):
         oq = self.oqparam
         self.set_param()
         self.offset = 0
+        self.gmf_buffer = AccumDict(accum=[])  # column -> arrays
+        self.gmf_nbytes = 0
         if oq.hazard_calculation_id:  # from ruptures
             self.datastore.parent = util.read(oq.hazard_calculation_id)
         elif hasattr(self, 'csm'):  # from sources
@@ -302,7 +350,13 @@ class EventBasedCalculator(base.HazardCalculator):
         if oq.ground_motion_fields:
             M = len(oq.imtls)
             nrups = len(self.datastore['ruptures'])
-            base.create_gmf_data(self.datastore, M, self.param['sec_perils'])
+            if oq.shard_gmfs:  # gmf_data is built at the end
+                os.makedirs(get_shard_dir(self.datastore.filename),
+                            exist_ok=True)
+                self.datastore.create_dset('gmf_data/shards', shard_dt)
+            else:
+                base.create_gmf_data(
+                    self.datastore, M, self.param['sec_perils'])
             self.datastore.create_dset('gmf_data/sigma_epsilon',
                                        sig_eps_dt(oq.imtls))
             self.datastore.create_dset('gmf_data/events_by_sid', U32, (N,))
@@ -321,6 +375,12 @@ class EventBasedCalculator(base.HazardCalculator):
             num_cores=oq.num_cores)
         smap.monitor.save('srcfilter', self.srcfilter)
         acc = smap.reduce(self.agg_dicts, self.acc0())
+        if self.gmf_buffer:
+            with self.monitor('saving gmfs'):
+                self.flush_gmfs()
+        if oq.ground_motion_fields and oq.shard_gmfs:
+            with self.monitor('building gmf_data'):
+                self.build_gmf_vds()
         if 'gmf_data' not in self.datastore:
             return acc
         if oq.ground_motion_fields and oq.minimum_intensity:
@@ -63,7 +63,6 @@ def event_based_risk(riskinputs, param, monitor):
                 'Building array avg of shape (%d, %d, %d)' % (A, R, L))
         result = dict(aids=ri.aids, avglosses=avg)
         acc = AccumDict()  # accumulator eidx -> agglosses
-        aid2idx = {aid: idx for idx, aid in enumerate(ri.aids)}
         if 'builder' in param:
             builder = param['builder']
             P = len(builder.return_periods)
@@ -79,24 +78,18 @@ def event_based_risk(riskinputs, param, monitor):
                 if loss_ratios is None:  # for GMFs below the minimum_intensity
                     continue
                 avalues = riskmodels.get_values(loss_type, ri.assets)
-                for a, asset in enumerate(ri.assets):
-                    aval = avalues[a]
-                    aid = asset['ordinal']
-                    idx = aid2idx[aid]
-                    ratios = loss_ratios[a]  # length E
-
-                    # average losses
-                    avg[idx, r, l] = (
-                        ratios.sum(axis=0) * param['ses_ratio'] * aval)
-                    # agglosses
-                    agglosses[:, l] += ratios * aval
-                    if 'builder' in param:
-                        with mon:  # this is the heaviest part
-                            try:
-                                all_curves[idx, r][loss_type] = (
-                                    builder.build_curve(aval, ratios, r))
-                            except ValueError:
-                                pass  # not enough event to compute the curve
+                # average losses
+                avg[:, r, l] = (loss_ratios.sum(axis=1) *
+                                param['ses_ratio'] * avalues)
+                # agglosses
+                agglosses[:, l] += avalues @ loss_ratios
+                if 'builder' in param:
+                    with mon:  # this is the heaviest part
+                        try:
+                            all_curves[loss_type][:, r] = (
+                                builder.build_curve(avalues, loss_ratios, r))
+                        except ValueError:
+                            pass  # not enough event to compute the curve
 
             # NB: I could yield the agglosses per output, but then I would
             # have millions of small outputs with big data transfer and slow
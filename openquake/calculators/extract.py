@@ -866,7 +866,14 @@ def extract_gmf_npz(dstore, what):
     mesh = get_mesh(dstore['sitecol'])
     n = len(mesh)
     try:
-        df = dstore.read_df('gmf_data', 'eid').loc[eid]
+        if 'gmf_data' in dstore:
+            df = dstore.read_df('gmf_data', 'eid').loc[eid]
+        else:  # regenerate the GMFs of the event from the ruptures
+            if 'amplification' in oq.inputs:
+                raise NotImplementedError(
+                    'Cannot regenerate amplified GMFs, please store them')
+            df = getters.GmfRegenerator(dstore).get_gmf_df(
+                [eid]).set_index('eid').loc[eid]
     except KeyError:
         # zero GMF
         yield 'rlz-%03d' % rlzi, []
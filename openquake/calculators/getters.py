@@ -16,14 +16,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
 import operator
+import functools
 import unittest.mock as mock
 import numpy
+import pandas
 from openquake.baselib import hdf5, datastore, general
+from openquake.baselib.performance import Monitor
 from openquake.hazardlib.gsim.base import ContextMaker, FarAwayRupture
 from openquake.hazardlib import calc, probability_map, stats
 from openquake.hazardlib.source.rupture import (
     EBRupture, BaseRupture, events_dt, RuptureProxy)
+from openquake.risklib import riskmodels
 from openquake.risklib.riskinput import rsi2str
 from openquake.commonlib.calc import gmvs_to_poes
 
@@ -128,14 +134,21 @@ class PmapGetter(object):
         self._pmap_by_grp = {}
         if 'poes' in self.dstore:
             # build probability maps restricted to the given sids
-            ok_sids = set(self.sids)
             for grp, dset in self.dstore['poes'].items():
                 ds = dset['array']
                 L, G = ds.shape[1:]
-                pmap = probability_map.ProbabilityMap(L, G)
-                for idx, sid in enumerate(dset['sids'][()]):
-                    if sid in ok_sids:
-                        pmap[sid] = probability_map.ProbabilityCurve(ds[idx])
+                sids = dset['sids'][()]
+                idxs, = numpy.isin(sids, self.sids).nonzero()
+                if len(idxs) == 0:
+                    pmap = probability_map.ProbabilityMap(L, G)
+                elif idxs[-1] - idxs[0] < 2 * len(idxs):
+                    # read a contiguous slice, i.e. a tile of sites
+                    array = ds[idxs[0]:idxs[-1] + 1][idxs - idxs[0]]
+                    pmap = probability_map.ProbabilityMap.from_array(
+                        array, sids[idxs])
+                else:  # read only the needed rows
+                    pmap = probability_map.ProbabilityMap.from_array(
+                        ds[idxs], sids[idxs])
                 self._pmap_by_grp[grp] = pmap
                 self.nbytes += pmap.nbytes
         return self._pmap_by_grp
@@ -273,6 +286,8 @@ class ZeroGetter(object):
 
 time_dt = numpy.dtype(
     [('rup_id', U32), ('nsites', U16), ('time', F32), ('task_no', U16)])
+shard_dt = numpy.dtype(
+    [('task_no', U16), ('nrows', U32), ('eid_min', U32), ('eid_max', U32)])
 
 
 class GmfGetter(object):
@@ -301,6 +316,9 @@ class GmfGetter(object):
         self.cmaker = ContextMaker(
             rupgetter.trt, rupgetter.rlzs_by_gsim, param)
         self.correl_model = oqparam.correl_model
+        self.master_seed = (oqparam.ses_seed if
+                            oqparam.gmf_random_generator == 'philox'
+                            else None)
 
     def gen_computers(self, mon):
         """
@@ -320,7 +338,8 @@ class GmfGetter(object):
                     computer = calc.gmf.GmfComputer(
                         ebr, sitecol, self.oqparam.imtls, self.cmaker,
                         self.oqparam.truncation_level, self.correl_model,
-                        self.amplifier, self.sec_perils)
+                        self.amplifier, self.sec_perils,
+                        self.oqparam.gmf_precision, self.master_seed)
                 except FarAwayRupture:
                     continue
                 # due to numeric errors ruptures within the maximum_distance
@@ -367,40 +386,210 @@ class GmfGetter(object):
             return {}
         return general.group_array(data, 'sid')
 
+    def get_gmfcols(self, mon):
+        """
+        :returns:
+            a dictionary with the columns sid, eid, rlz, gmv and the
+            outputs of the secondary perils, possibly empty
+        """
+        allcols = []
+        self.sig_eps = []
+        self.times = []  # rup_id, nsites, dt
+        for computer in self.gen_computers(mon):
+            t0 = time.time()
+            cols = computer.compute_columns(
+                self.min_iml, self.rlzs_by_gsim, self.sig_eps)
+            self.times.append((computer.ebrupture.id, len(computer.sids),
+                               time.time() - t0))
+            if len(cols['sid']):
+                allcols.append(cols)
+        if not allcols:
+            return {}
+        return {name: numpy.concatenate([cols[name] for cols in allcols])
+                for name in allcols[0]}
+
     def compute_gmfs_curves(self, monitor):
         """
-        :returns: a dict with keys gmfdata, hcurves
+        :returns:
+            a dict with keys gmfdata, hcurves, times, sig_eps; gmfdata is a
+            dictionary with the columns of gmf_data (sid, eid, gmv_0, ...)
+            or the compressed version of it if oqparam.compress_gmfs is set;
+            if oqparam.shard_gmfs is set the columns are saved in a shard
+            file and gmfdata is replaced by gmf_shard, a record of dtype
+            shard_dt with the number of rows and the range of event IDs
         """
         oq = self.oqparam
         mon = monitor('getting ruptures', measuremem=True)
         hcurves = {}  # key -> poes
-        if oq.hazard_curves_from_gmfs:
-            hc_mon = monitor('building hazard curves', measuremem=False)
-            gmfdata = self.get_gmfdata(mon)  # returned later
-            hazard = self.get_hazard_by_sid(data=gmfdata)
-            for sid, hazardr in hazard.items():
-                dic = general.group_array(hazardr, 'rlz')
-                for rlzi, array in dic.items():
-                    with hc_mon:
-                        poes = gmvs_to_poes(
-                            array['gmv'].T, oq.imtls,
-                            oq.ses_per_logic_tree_path)
-                        for m, imt in enumerate(oq.imtls):
-                            hcurves[rsi2str(rlzi, sid, imt)] = poes[m]
+        cols = self.get_gmfcols(mon)
+        if oq.hazard_curves_from_gmfs and cols:
+            with monitor('building hazard curves', measuremem=False):
+                # group the rows by site and realization
+                R = numpy.int64(cols['rlz'].max() + 1)
+                keys = cols['sid'] * R + cols['rlz']
+                order = numpy.argsort(keys, kind='stable')
+                ukeys, starts = numpy.unique(keys[order], return_index=True)
+                for key, idxs in zip(
+                        ukeys, numpy.split(order, starts[1:])):
+                    sid, rlzi = divmod(int(key), int(R))
+                    poes = gmvs_to_poes(
+                        cols['gmv'][idxs].T, oq.imtls,
+                        oq.ses_per_logic_tree_path)
+                    for m, imt in enumerate(oq.imtls):
+                        hcurves[rsi2str(rlzi, sid, imt)] = poes[m]
         if not oq.ground_motion_fields:
-            return dict(gmfdata=(), hcurves=hcurves)
-        if not oq.hazard_curves_from_gmfs:
-            gmfdata = self.get_gmfdata(mon)
-        if len(gmfdata) == 0:
-            return dict(gmfdata=[])
+            return dict(gmfdata={}, hcurves=hcurves)
+        if not cols:
+            return dict(gmfdata={})
         times = numpy.array([tup + (monitor.task_no,) for tup in self.times],
                             time_dt)
         times.sort(order='rup_id')
-        res = dict(gmfdata=gmfdata, hcurves=hcurves, times=times,
+        gmfdata = to_gmfdata(cols, len(oq.imtls), self.sec_perils)
+        res = dict(hcurves=hcurves, times=times,
                    sig_eps=numpy.array(self.sig_eps, self.sig_eps_dt))
+        if oq.shard_gmfs:
+            with monitor('saving gmf shard', measuremem=False):
+                fname = os.path.join(get_shard_dir(monitor.filename),
+                                     '%d.hdf5' % monitor.task_no)
+                with hdf5.File(fname, 'w') as f:
+                    for name, col in gmfdata.items():
+                        f[name] = col
+            eids = cols['eid']
+            res['gmfdata'] = {}
+            res['gmf_shard'] = numpy.array(
+                [(monitor.task_no, len(eids), eids.min(), eids.max())],
+                shard_dt)
+        elif oq.compress_gmfs:
+            res['gmfdata'] = general.compress(gmfdata)
+        else:
+            res['gmfdata'] = gmfdata
         return res
 
 
+def to_gmfdata(cols, M, sec_perils=()):
+    """
+    Convert the columns returned by GmfGetter.get_gmfcols into the layout
+    of gmf_data in the datastore
+
+    :param cols: a dictionary with keys sid, eid, rlz, gmv, ...
+    :param M: the number of IMTs
+    :param sec_perils: the secondary perils, if any
+    :returns: a dictionary with keys sid, eid, gmv_0, ...
+    """
+    gmfdata = dict(sid=cols['sid'], eid=cols['eid'])
+    for m in range(M):
+        gmfdata[f'gmv_{m}'] = cols['gmv'][:, m]
+    for m in range(M):
+        for sp in sec_perils:
+            for out in sp.outputs:
+                gmfdata[f'{out}_{m}'] = cols[out][:, m]
+    return gmfdata
+
+
+class GmfRegenerator(object):
+    """
+    Regenerate on demand the ground motion fields of selected events and
+    sites from the ruptures stored in a datastore, so that there is no
+    need to store gmf_data. The GMFs of all the events of the most recently
+    used ruptures are kept in a LRU cache.
+
+    :param dstore: a DataStore with the ruptures and the events
+    :param amplifier: None or an instance of Amplifier
+    :param sec_perils: the secondary perils, if any
+    :param maxsize: the maximum number of ruptures in the cache
+    """
+    def __init__(self, dstore, amplifier=None, sec_perils=(), maxsize=128):
+        # the random numbers depend on the parameters and on the sites of
+        # the calculation generating the ruptures, so they are read from it
+        # and not from a risk child, which can have fewer sites
+        hstore = (dstore.parent if dstore.parent and 'ruptures' in
+                  dstore.parent else dstore)
+        # the geometries can be converted in the child, see convert_rupgeoms
+        self.filename = (dstore.filename if 'rupgeoms' in dstore.hdf5
+                         else hstore.filename)
+        self.oqparam = hstore['oqparam']
+        if not self.oqparam.minimum_intensity and 'risk_model' in hstore:
+            # inferred from the risk model, as in the hazard calculation
+            crmodel = riskmodels.CompositeRiskModel.read(hstore)
+            self.oqparam.minimum_intensity = crmodel.min_iml
+        self.amplifier = amplifier
+        self.sec_perils = sec_perils
+        self.rup_array = dstore['ruptures'][()]
+        self.rup_ids = dstore['events']['rup_id']
+        full_lt = dstore['full_lt']
+        self.trt_by_grp = full_lt.trt_by_grp
+        self.rlzs_by_gsim = full_lt.get_rlzs_by_gsim_grp()
+        self.srcfilter = calc.filters.SourceFilter(
+            hstore['sitecol'].complete, self.oqparam.maximum_distance)
+        self.get_rupture_gmfs = functools.lru_cache(maxsize)(
+            self._get_rupture_gmfs)
+
+    def _get_rupture_gmfs(self, rup_id):
+        # GMFs for all the events of the given rupture
+        rec = self.rup_array[rup_id]
+        grp_id = rec['grp_id']
+        rgetter = RuptureGetter(
+            [RuptureProxy(rec)], self.filename, grp_id,
+            self.trt_by_grp[grp_id], self.rlzs_by_gsim[grp_id])
+        getter = GmfGetter(rgetter, self.srcfilter, self.oqparam,
+                           self.amplifier, self.sec_perils)
+        return getter.get_gmfcols(Monitor())
+
+    def get_gmfcols(self, eids=None, sids=None):
+        """
+        :param eids: event IDs (None means all events)
+        :param sids: site IDs (None means all sites)
+        :returns:
+            a dictionary with the columns sid, eid, rlz, gmv and the outputs
+            of the secondary perils, possibly empty, ordered by rupture
+        """
+        if eids is None:
+            rup_ids = range(len(self.rup_array))
+        else:
+            eids = numpy.unique(eids)
+            rup_ids = numpy.unique(self.rup_ids[eids])
+        allcols = []
+        for rup_id in rup_ids:
+            cols = self.get_rupture_gmfs(int(rup_id))
+            if not cols:
+                continue
+            ok = numpy.ones(len(cols['eid']), bool)
+            if eids is not None:
+                ok &= numpy.isin(cols['eid'], eids)
+            if sids is not None:
+                ok &= numpy.isin(cols['sid'], sids)
+            if ok.any():
+                allcols.append({k: col[ok] for k, col in cols.items()})
+        if not allcols:
+            return {}
+        return {name: numpy.concatenate([cols[name] for cols in allcols])
+                for name in allcols[0]}
+
+    def get_gmf_df(self, eids=None, sids=None):
+        """
+        :param eids: event IDs (None means all events)
+        :param sids: site IDs (None means all sites)
+        :returns: a DataFrame with the same columns as gmf_data
+        """
+        M = len(self.oqparam.imtls)
+        cols = self.get_gmfcols(eids, sids)
+        if not cols:  # build an empty DataFrame with the right columns
+            cols = dict(sid=U32([]), eid=U32([]),
+                        gmv=numpy.zeros((0, M), F32))
+            for sp in self.sec_perils:
+                for out in sp.outputs:
+                    cols[out] = numpy.zeros((0, M), F32)
+        return pandas.DataFrame(to_gmfdata(cols, M, self.sec_perils))
+
+
+def get_shard_dir(filename):
+    """
+    :param filename: the path of a datastore, i.e. .../calc_XXX.hdf5
+    :returns: the directory .../calc_XXX_gmfs containing the GMF shards
+    """
+    return filename[:-5] + '_gmfs'
+
+
 def gen_rupture_getters(dstore, ct=0, slc=slice(None)):
     """
     :param dstore: a :class:`openquake.baselib.datastore.DataStore`
@@ -411,7 +600,9 @@ def gen_rupture_getters(dstore, ct=0, slc=slice(None)):
     trt_by_grp = full_lt.trt_by_grp
     rlzs_by_gsim = full_lt.get_rlzs_by_gsim_grp()
     rup_array = dstore['ruptures'][slc]
-    rup_array.sort(order='grp_id')  # avoid generating too many tasks
+    # avoid generating too many tasks; the stable sort keeps the geometries
+    # of a block contiguous in the rupgeoms dataset
+    rup_array.sort(order='grp_id', kind='stable')
     maxweight = rup_array['n_occ'].sum() / (ct or 1)
     for block in general.block_splitter(
             rup_array, maxweight, operator.itemgetter('n_occ'),
@@ -448,6 +639,16 @@ def get_eid_rlz(proxies, rlzs_by_gsim):
     return numpy.array(eid_rlz, events_dt)
 
 
+def get_geom(rupgeoms, rec):
+    """
+    :param rupgeoms: a dataset of points of shape (P, 3)
+    :param rec: a rupture record with fields geom_id, s1, s2
+    :returns: the points of the rupture geometry as an array of shape (n, 3)
+    """
+    start = int(rec['geom_id'])
+    return rupgeoms[start:start + int(rec['s1']) * int(rec['s2'])]
+
+
 # this is never called directly; gen_rupture_getters is used instead
 class RuptureGetter(object):
     """
@@ -484,7 +685,7 @@ class RuptureGetter(object):
         with datastore.read(self.filename) as dstore:
             rupgeoms = dstore['rupgeoms']
             rec = self.proxies[0].rec
-            geom = rupgeoms[rec['id']].reshape(
+            geom = get_geom(rupgeoms, rec).reshape(
                 rec['s1'], rec['s2'], 3).transpose(2, 0, 1)
             dic['lons'] = geom[0]
             dic['lats'] = geom[1]
@@ -505,14 +706,19 @@ class RuptureGetter(object):
         """
         :returns: a list of RuptureProxies
         """
-        proxies = []
+        proxies = [proxy for proxy in self.proxies if proxy['mag'] >= min_mag]
+        if not proxies:
+            return proxies
+        starts = numpy.array(
+            [int(proxy['geom_id']) for proxy in proxies])
+        stops = starts + numpy.array(
+            [int(proxy['s1']) * int(proxy['s2']) for proxy in proxies])
+        start = starts.min()
         with datastore.read(self.filename) as dstore:
-            rupgeoms = dstore['rupgeoms']
-            for proxy in self.proxies:
-                if proxy['mag'] < min_mag:
-                    continue
-                proxy.geom = rupgeoms[proxy['geom_id']]
-                proxies.append(proxy)
+            # the geometries of a block are contiguous, read them at once
+            geoms = dstore['rupgeoms'][start:stops.max()]
+        for proxy, a, b in zip(proxies, starts - start, stops - start):
+            proxy.geom = geoms[a:b]
         return proxies
 
     def split(self, srcfilter, maxw):
@@ -16,13 +16,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import ast
 import logging
-import itertools
 import numpy
-import pandas
 
-from openquake.baselib import general, parallel, datastore
+from openquake.baselib import general, parallel, datastore, hdf5
 from openquake.baselib.python3compat import encode
 from openquake.hazardlib.stats import set_rlzs_stats
 from openquake.risklib import scientific
@@ -30,31 +27,27 @@ from openquake.calculators import base, views
 
 F32 = numpy.float32
 U32 = numpy.uint32
+U64 = numpy.uint64
 
 
-def build_aggkeys(aggregate_by, tagcol, full_aggregate_by):
+def build_aggids(aggregate_by, tagcol, full_aggregate_by):
     """
     :param aggregate_by: what to aggregate
     :param tagcol: the TagCollection
     :param full_aggregate_by: maximum possible aggregation
+    :returns: an array mapping the agg_ids of full_aggregate_by into the
+              agg_ids of aggregate_by
     """
     name2index = {n: i for i, n in enumerate(full_aggregate_by)}
     indexes = [name2index[n] for n in aggregate_by]
     if indexes != sorted(indexes):
         raise ValueError('The aggregation tags must be an ordered subset of '
                          '%s, got %s' % (full_aggregate_by, aggregate_by))
-    tagids = []
-    for tagname in full_aggregate_by:
-        n1 = len(getattr(tagcol, tagname))
-        lst = list(range(1, n1))
-        if tagname in aggregate_by:
-            tagids.append(lst)
-        else:
-            tagids.append([lst])
-    aggkeys = []
-    for ids in itertools.product(*tagids):
-        aggkeys.append(','.join(map(str, ids)) + ',')
-    return sorted(aggkeys)
+    fullshape = tagcol.agg_shape((), full_aggregate_by)
+    idxs = numpy.unravel_index(
+        numpy.arange(numpy.prod(fullshape, dtype=int)), fullshape)
+    return numpy.ravel_multi_index(
+        [idxs[i] for i in indexes], tagcol.agg_shape((), aggregate_by))
 
 
 def get_loss_builder(dstore, return_periods=None, loss_dt=None):
@@ -74,39 +67,111 @@ def get_loss_builder(dstore, return_periods=None, loss_dt=None):
         eff_time, oq.risk_investigation_time)
 
 
-def post_ebrisk(dstore, aggkey, monitor):
+def read_elt(elt, slices):
+    """
+    :param elt: the event_loss_table group
+    :param slices: a list of triples (agg_id, start, stop)
+    :returns: arrays agg_id, event_id, loss with the content of the slices
+    """
+    aggids, starts, stops = map(numpy.array, zip(*slices))
+    sizes = stops - starts
+    if (starts[1:] == stops[:-1]).all():  # contiguous, single read
+        eids = elt['event_id'][starts[0]:stops[-1]]
+        losses = elt['loss'][starts[0]:stops[-1]]
+    else:
+        ranges = list(zip(starts, stops))
+        eids = numpy.concatenate(
+            [elt['event_id'][start:stop] for start, stop in ranges])
+        losses = numpy.concatenate(
+            [elt['loss'][start:stop] for start, stop in ranges])
+    return numpy.repeat(aggids, sizes), eids, losses
+
+
+def convert_elt(parent, dstore, fullshape, L):
+    """
+    Convert the event_loss_table of a parent datastore generated by an
+    engine storing a dataset per aggregation key (named after the 1-based
+    tag indices, like "1,3,") into the layout with the columns agg_id,
+    event_id, loss sorted by agg_id and the offsets, saved in `dstore`.
+
+    :param parent: a DataStore with the old layout
+    :param dstore: the DataStore of the child calculation
+    :param fullshape: the shape of the aggregate_by of the parent
+    :param L: the number of loss types
+    """
+    logging.info('Converting the event_loss_table of %s', parent)
+    old = parent['event_loss_table']
+    aggids = {numpy.ravel_multi_index(
+        [int(idx) - 1 for idx in key[:-1].split(',')], fullshape): key
+        for key in old if key.endswith(',')}  # skip the indices
+    dstore.create_dset('event_loss_table/agg_id', U32)
+    dstore.create_dset('event_loss_table/event_id', U32)
+    dstore.create_dset('event_loss_table/loss', F32, (None, L))
+    counts = numpy.zeros(numpy.prod(fullshape, dtype=int), int)
+    for aggid in sorted(aggids):  # one key at the time to save memory
+        dset = old[aggids[aggid]]
+        if len(dset) == 0:
+            continue
+        recs = dset[()]
+        counts[aggid] = len(recs)
+        hdf5.extend(dstore['event_loss_table/agg_id'],
+                    numpy.full(len(recs), aggid, U32))
+        hdf5.extend(dstore['event_loss_table/event_id'], recs['event_id'])
+        hdf5.extend(dstore['event_loss_table/loss'], recs['loss'])
+    offsets = numpy.zeros(len(counts) + 1, U64)
+    offsets[1:] = counts.cumsum()
+    dstore['event_loss_table/offsets'] = offsets
+
+
+def post_ebrisk(dstore, aggids, slices, monitor):
     """
     :param dstore: a DataStore instance
-    :param aggkey: aggregation key
+    :param aggids: aggregation keys of aggregate_by
+    :param slices: triples (agg_id, start, stop) of the event_loss_table
     :param monitor: Monitor instance
-    :returns: a dictionary rlzi -> {agg_curves, agg_losses, idx}
+    :returns: a dictionary with keys agg_id, rlz, agg_curves, agg_losses
     """
     dstore.open('r')
     oq = dstore['oqparam']
     L = len(oq.loss_names)
-    agglist = [x if isinstance(x, list) else [x]
-               for x in ast.literal_eval(aggkey)]
-    idx = tuple(x[0] - 1 for x in agglist if len(x) == 1)
     rlz_id = dstore['events']['rlz_id']
-    E = len(rlz_id)
-    arr = numpy.zeros((E, L))
-    for ids in itertools.product(*agglist):
-        key = ','.join(map(str, ids)) + ','
-        try:
-            recs = dstore['event_loss_table/' + key][()]
-        except dstore.EmptyDataset:   # no data
-            continue
-        for rec in recs:
-            arr[rec['event_id']] += rec['loss']
+    rlzs = numpy.unique(rlz_id)
+    R = rlzs.max() + 1
+    A = len(aggids)
+    aggids = numpy.array(aggids)
+    if slices:
+        with monitor('reading event_loss_table'):
+            kids, eids, losses = read_elt(dstore['event_loss_table'], slices)
+        # sum the losses of the same event over the full aggregation keys
+        keys = (kids.astype(numpy.int64) << 32) + eids
+        N = len(keys)
+        ukeys, losses = scientific.sum_by_key(
+            numpy.repeat(keys, L), numpy.tile(numpy.arange(L), N),
+            losses.ravel(), L)
+        # group the losses by aggregation key, realization and loss type
+        sorter = numpy.argsort(aggids)
+        ais = sorter[numpy.searchsorted(aggids, ukeys >> 32, sorter=sorter)]
+        rlzis = rlz_id[ukeys & 0xFFFFFFFF]
+        groups = ((ais * R + rlzis) * L)[:, None] + numpy.arange(L)
+        groups, losses = groups.ravel(), losses.ravel()
+    else:
+        groups, losses = numpy.zeros(0, int), numpy.zeros(0)
     builder = get_loss_builder(dstore)
-    out = {}
-    for rlz in numpy.unique(rlz_id):
-        # DO NOT USE groupby here! you would run out of memory
-        array = arr[rlz_id == rlz]  # shape E', L
-        out[rlz] = dict(agg_curves=builder.build_curves(array, rlz),
-                        agg_losses=array.sum(axis=0) * oq.ses_ratio,
-                        idx=idx)
-    return out
+    num_events = numpy.array([builder.num_events.get(r, 0) for r in range(R)])
+    with monitor('building curves'):
+        curves = scientific.build_grouped_curves(
+            groups, losses, numpy.tile(numpy.repeat(num_events, L), A),
+            builder.return_periods, builder.eff_time)
+    P = len(curves)
+    agg_curves = curves.reshape(P, A, R, L)[:, :, rlzs]
+    agg_losses = numpy.bincount(groups, losses, A * R * L).reshape(
+        A, R, L)[:, rlzs] * oq.ses_ratio
+    n = A * len(rlzs)
+    return dict(agg_id=numpy.repeat(aggids, len(rlzs)),
+                rlz=numpy.tile(rlzs, A),
+                agg_curves=agg_curves.transpose(1, 2, 0, 3).reshape(
+                    n, P, L).astype(F32),
+                agg_losses=agg_losses.reshape(n, L))
 
 
 def get_src_loss_table(dstore, L):
@@ -131,6 +196,8 @@ class PostRiskCalculator(base.RiskCalculator):
     """
     Compute losses and loss curves starting from an event loss table.
     """
+    chunksize = 1_000_000  # number of rows of losses_by_event read at once
+
     def pre_execute(self):
         oq = self.oqparam
         if oq.hazard_calculation_id and not self.datastore.parent:
@@ -138,6 +205,29 @@ class PostRiskCalculator(base.RiskCalculator):
         self.L = len(oq.loss_names)
         self.tagcol = self.datastore['assetcol/tagcol']
 
+    def gen_blocks(self, dstore, full_aggregate_by):
+        """
+        :param dstore: the datastore containing the event_loss_table
+        :param full_aggregate_by: the aggregate_by of the event_loss_table
+        :yields: pairs (aggids, slices) of similar weight, one per task
+        """
+        oq = self.oqparam
+        kids = build_aggids(oq.aggregate_by, self.tagcol, full_aggregate_by)
+        # the offsets are stored as uint64, which numpy.repeat rejects
+        offsets = dstore['event_loss_table/offsets'][()].astype(int)
+        sizes = numpy.diff(offsets)
+        slices = general.AccumDict(accum=[])  # aggid -> [(aggid, start, stop)]
+        for fullid in numpy.nonzero(sizes)[0]:
+            kid = kids[fullid]
+            slices[kid].append((kid, offsets[fullid], offsets[fullid + 1]))
+        K = numpy.prod(self.get_shape(), dtype=int)
+        blocks = general.split_in_blocks(
+            range(K), oq.concurrent_tasks or 1,
+            lambda kid: 1 + sum(stop - start
+                                for _, start, stop in slices.get(kid, ())))
+        for block in blocks:
+            yield list(block), sum((slices.get(kid, []) for kid in block), [])
+
     def build_datasets(self, builder, aggregate_by, prefix):
         """
         Create the datasets agg_curves-XXX, tot_curves-XXX,
@@ -184,42 +274,63 @@ class PostRiskCalculator(base.RiskCalculator):
         full_aggregate_by = (parent['oqparam'].aggregate_by if parent
                              else ()) or oq.aggregate_by
         if oq.aggregate_by:
-            aggkeys = build_aggkeys(oq.aggregate_by, self.tagcol,
-                                    full_aggregate_by)
             if parent and 'event_loss_table' in parent:
                 ds = parent
+                if 'offsets' not in parent['event_loss_table']:
+                    # stored by an engine with a dataset per key
+                    convert_elt(parent, self.datastore,
+                                self.tagcol.agg_shape((), full_aggregate_by),
+                                self.L)
+                    ds = self.datastore
+                    ds.swmr_on()
             else:
                 ds = self.datastore
                 ds.swmr_on()
-            smap = parallel.Starmap(
-                post_ebrisk, [(ds, aggkey) for aggkey in aggkeys],
-                h5=self.datastore.hdf5)
+            smap = parallel.Starmap(post_ebrisk, h5=self.datastore.hdf5)
+            for aggids, slices in self.gen_blocks(ds, full_aggregate_by):
+                smap.submit((ds, aggids, slices))
         else:
             smap = ()
         # do everything in process since it is really fast
         ds = self.datastore
+        if oq.aggregate_by:
+            P = len(builder.return_periods)
+            K = numpy.prod(shp[1:], dtype=int)
+            agg_curves = numpy.zeros((P, self.R, self.L, K), F32)
+            agg_losses = numpy.zeros((self.L, self.R, K), F32)
+            app_curves = numpy.zeros((P, self.R, self.L), F32)
         for res in smap:
-            if not res:
-                continue
-            for r, dic in res.items():
-                if oq.aggregate_by:
-                    ds['agg_curves-rlzs'][
-                        (slice(None), r, slice(None)) + dic['idx']  # PRLT..
-                    ] = dic['agg_curves']
-                    ds['agg_losses-rlzs'][
-                        (slice(None), r) + dic['idx']  # LRT...
-                    ] = dic['agg_losses']
-                    ds['app_curves-rlzs'][:, r] += dic['agg_curves']  # PL
+            kids, rlzs = res['agg_id'], res['rlz']
+            agg_curves[:, rlzs, :, kids] = res['agg_curves']  # K'PL
+            agg_losses[:, rlzs, kids] = res['agg_losses'].T  # LK'
+            numpy.add.at(app_curves, (slice(None), rlzs),
+                         res['agg_curves'].transpose(1, 0, 2))
+        if oq.aggregate_by:
+            ds['agg_curves-rlzs'][()] = agg_curves.reshape(
+                (P, self.R, self.L) + shp[1:])  # PRLT...
+            ds['agg_losses-rlzs'][()] = agg_losses.reshape(
+                (self.L, self.R) + shp[1:])  # LRT...
+            ds['app_curves-rlzs'][()] = app_curves  # PRL
 
-        lbe = ds['losses_by_event'][()]
-        rlz_ids = ds['events']['rlz_id'][lbe['event_id']]
-        dic = dict(enumerate(lbe['loss'].T))  # lti -> losses
-        df = pandas.DataFrame(dic, rlz_ids)
-        for r, losses_df in df.groupby(rlz_ids):
-            losses = numpy.array(losses_df)
-            curves = builder.build_curves(losses, r),
-            ds['tot_curves-rlzs'][:, r] = curves  # PL
-            ds['tot_losses-rlzs'][:, r] = losses.sum(axis=0) * oq.ses_ratio
+        # the event loss table is read in chunks to save memory
+        rlz_id = ds['events']['rlz_id']
+        lbe = ds['losses_by_event']
+        tops = {}
+        tot_losses = numpy.zeros((self.L, self.R))
+        for slc in general.gen_slices(0, len(lbe), self.chunksize):
+            arr = lbe[slc]
+            rlzs = rlz_id[arr['event_id']]
+            for r in numpy.unique(rlzs):
+                losses = arr['loss'][rlzs == r]
+                if r not in tops:
+                    tops[r] = scientific.TopLosses(
+                        self.L, builder.return_periods, builder.eff_time)
+                tops[r].add(losses)
+                tot_losses[:, r] += losses.sum(axis=0)
+        for r, top in tops.items():
+            ds['tot_curves-rlzs'][:, r] = top.get_curves(
+                builder.num_events[r])  # PL
+            ds['tot_losses-rlzs'][:, r] = tot_losses[:, r] * oq.ses_ratio
         units = self.datastore['cost_calculator'].get_units(oq.loss_names)
         aggby = {tagname: encode(getattr(self.tagcol, tagname)[1:])
                  for tagname in oq.aggregate_by}
@@ -251,6 +251,28 @@ class ClassicalTestCase(CalculatorTestCase):
         # test disagg_by_src in a complex case with duplicated sources
         check_disagg_by_src(self.calc.datastore)
 
+    def test_case_13_pmap_maxsize(self):
+        # spilling the probability maps in tiles of few sites must give
+        # the same results as keeping them in memory
+        def read(dstore):
+            dic = {name: dstore[name][()]
+                   for name in ('hcurves-stats', 'hmaps-stats')}
+            for key in dstore['poes']:
+                pmap = dstore['poes/' + key]
+                dic[key] = numpy.zeros((self.calc.N,) + pmap.array.shape[1:])
+                dic[key][pmap.sids] = pmap.array
+            return dic
+        self.run_calc(case_13.__file__, 'job.ini')
+        expected = read(self.calc.datastore)
+        self.assertGreater(len(expected), 3)  # several groups
+        self.run_calc(case_13.__file__, 'job.ini', pmap_maxsize='12500')
+        self.assertGreater(self.calc.tile_size, 1)
+        self.assertLess(self.calc.tile_size, self.calc.N)
+        got = read(self.calc.datastore)
+        self.assertEqual(sorted(got), sorted(expected))
+        for key in expected:
+            aac(got[key], expected[key], atol=1E-12, err_msg=key)
+
     def test_case_14(self):
         # test classical with 2 gsims and 1 sample
         self.assert_curves_ok(['hazard_curve-rlz-000_PGA.csv'],
@@ -297,6 +319,15 @@ hazard_uhs-std.csv
         exp = str(list(smlt))
         self.assertEqual('''[<Realization #0 source_model_1.xml, path=SM1, weight=0.5>, <Realization #1 source_model_2.xml, path=SM2_a3pt2b0pt8, weight=0.25>, <Realization #2 source_model_2.xml, path=SM2_a3b1, weight=0.25>]''', exp)
 
+    def test_case_15_tabulated_sf(self):
+        # the tabulated survival function must give the same curves
+        # as the exact one, within the tolerance of the tabulation
+        self.run_calc(case_15.__file__, 'job.ini')
+        exact = self.calc.datastore['hcurves-stats'][()]
+        self.run_calc(case_15.__file__, 'job.ini',
+                      survival_function='tabulated')
+        aac(self.calc.datastore['hcurves-stats'][()], exact, atol=1E-6)
+
     def test_case_16(self):   # sampling
         self.assert_curves_ok(
             ['hazard_curve-mean.csv',
@@ -469,6 +500,19 @@ hazard_uhs-std.csv
         self.assertEqual(len(self.calc.datastore['mag_5.25/rctx']), 34)
         self.assertEqual(self.calc.totrups, 780)
 
+    def test_case_24_tabulated_gsims(self):
+        # with pointsource_distance=0 all the ruptures are point ruptures
+        # and the interpolated GSIMs must give the same curves as the
+        # GSIMs, within the tabulation tolerance
+        self.run_calc(case_24.__file__, 'job.ini', pointsource_distance='0')
+        exact = self.calc.datastore['hcurves-stats'][()]
+        self.run_calc(case_24.__file__, 'job.ini', pointsource_distance='0',
+                      tabulated_gsims='true')
+        report = self.calc.datastore['gsim_tables'][()]
+        self.assertTrue((report['ndists'] > 0).all())  # all tabulated
+        self.assertLess(report['err_mean'].max(), .01)
+        aac(self.calc.datastore['hcurves-stats'][()], exact, rtol=1E-2)
+
     def test_case_25(self):  # negative depths
         self.assert_curves_ok(['hazard_curve-smltp_b1-gsimltp_b1.csv'],
                               case_25.__file__)
@@ -17,17 +17,25 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import os
 import logging
+import unittest
 from unittest import mock
 import numpy
 
 from openquake.baselib.general import gettemp
+from openquake.baselib import hdf5, datastore
 from openquake.baselib.hdf5 import read_csv
+from openquake.hazardlib import InvalidFile
 from openquake.commonlib import logs
+from openquake.risklib.asset import TagCollection
 from openquake.calculators.views import view, rst_table
 from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
-from openquake.calculators.post_risk import PostRiskCalculator
+from openquake.calculators.getters import GmfRegenerator
+from openquake.calculators.post_risk import (
+    PostRiskCalculator, build_aggids, convert_elt)
+from openquake.calculators.ebrisk import (
+    EbriskCalculator, get_slices, gen_pairs, read_rows)
 from openquake.qa_tests_data.event_based_risk import (
     case_1, case_2, case_3, case_4, case_4a, case_6c, case_master, case_miriam,
     occupants, case_1f, case_1g, case_7a, recompute)
@@ -428,6 +436,38 @@ class EventBasedRiskTestCase(CalculatorTestCase):
         [fname] = out['tot_curves-rlzs', 'csv']
         self.assertEqualFiles('expected/agg_curves.csv', fname, delta=1E-5)
 
+    def test_regenerate_gmfs(self):
+        # the risk calculation is on a region smaller than the hazard one
+        # and the GMFs are correlated, so they depend on the hazard sites
+        region = '-122.6 38.3, -121.5 38.3, -121.5 38.0, -122.6 38.0'
+        self.run_calc(case_6c.__file__, 'job_h.ini')
+        hc = str(self.calc.datastore.calc_id)
+        gmf_df = self.calc.datastore.read_df('gmf_data')
+        self.run_calc(case_6c.__file__, 'job_r.ini', hazard_calculation_id=hc,
+                      region=region)
+        expected = self.calc.datastore['avg_losses-rlzs'][()]
+        sids = numpy.unique(self.calc.assetcol['site_id'])
+        self.assertLess(len(sids), len(numpy.unique(gmf_df.sid)))
+        gmf_df = gmf_df[gmf_df.sid.isin(sids)].sort_values(['eid', 'sid'])
+        regen = GmfRegenerator(self.calc.datastore)
+        df = regen.get_gmf_df(sids=sids).sort_values(['eid', 'sid'])
+        for col in gmf_df.columns:
+            numpy.testing.assert_allclose(df[col], gmf_df[col], rtol=1E-6)
+
+        # the GMFs are not stored and are regenerated only if requested
+        self.run_calc(case_6c.__file__, 'job_h.ini',
+                      ground_motion_fields='false')
+        hc = str(self.calc.datastore.calc_id)
+        self.assertNotIn('gmf_data', self.calc.datastore)
+        with self.assertRaises(InvalidFile):  # the GMFs are needed
+            self.run_calc(case_6c.__file__, 'job_r.ini',
+                          hazard_calculation_id=hc, region=region,
+                          ground_motion_fields='true')
+        self.run_calc(case_6c.__file__, 'job_r.ini', hazard_calculation_id=hc,
+                      region=region, regenerate_gmfs='true')
+        numpy.testing.assert_allclose(
+            self.calc.datastore['avg_losses-rlzs'][()], expected, rtol=1E-5)
+
     def test_asset_loss_table(self):
         # this is a case with L=1, R=1, T1=2, P=3
         out = self.run_calc(case_6c.__file__, 'job_eb.ini', exports='csv',
@@ -458,3 +498,114 @@ class EventBasedRiskTestCase(CalculatorTestCase):
         oq.hazard_calculation_id = parent.calc_id
         with mock.patch.dict(os.environ, {'OQ_DISTRIBUTE': 'no'}):
             prc.run()
+
+
+class BuildAggidsTestCase(unittest.TestCase):
+    def test(self):
+        tagcol = TagCollection(['taxonomy', 'state', 'city'])
+        for state in ['A', 'B']:
+            tagcol.add('state', state)
+        for city in ['a', 'b', 'c']:
+            tagcol.add('city', city)
+        full = ['state', 'city']
+        # the full agg_ids are 0..5 in the order (A,a) (A,b) ... (B,c)
+        numpy.testing.assert_equal(
+            build_aggids(full, tagcol, full), [0, 1, 2, 3, 4, 5])
+        numpy.testing.assert_equal(
+            build_aggids(['state'], tagcol, full), [0, 0, 0, 1, 1, 1])
+        numpy.testing.assert_equal(
+            build_aggids(['city'], tagcol, full), [0, 1, 2, 0, 1, 2])
+        with self.assertRaises(ValueError):
+            build_aggids(['city', 'state'], tagcol, full)
+
+
+class EbriskHelpersTestCase(unittest.TestCase):
+    def test_get_slices(self):
+        # 6 sites with 0, 2, 1, 0, 3, 0 assets
+        offsets = numpy.array([0, 0, 2, 3, 3, 6, 6])
+        # the consecutive sites 1 and 2 are merged, as well as 2 and 4
+        # since site 3 has no assets; sites 0 and 5 are skipped
+        self.assertEqual(get_slices(offsets, numpy.array([0, 1, 2, 4, 5])),
+                         [slice(0, 6)])
+        self.assertEqual(get_slices(offsets, numpy.array([1, 4])),
+                         [slice(0, 2), slice(3, 6)])
+        self.assertEqual(get_slices(offsets, numpy.array([0, 3, 5])), [])
+
+    def test_gen_pairs(self):
+        assets = numpy.zeros(3, [('site_id', numpy.uint32)])
+        assets['site_id'] = [1, 1, 4]
+        gmfs = numpy.zeros(5, [('sid', numpy.uint32), ('eid', numpy.uint32)])
+        gmfs['sid'] = [0, 1, 1, 4, 4]
+        gmfs['eid'] = [7, 8, 9, 8, 9]
+        blocks = list(gen_pairs(assets, gmfs))
+        self.assertEqual(len(blocks), 1)
+        [(aidx, gidx, nevents)] = blocks
+        numpy.testing.assert_equal(aidx, [0, 0, 1, 1, 2, 2])
+        numpy.testing.assert_equal(gidx, [1, 2, 1, 2, 3, 4])
+        numpy.testing.assert_equal(nevents, [2, 2, 2, 2, 2, 2])
+        # an asset is never split across blocks
+        blocks = list(gen_pairs(assets, gmfs, blocksize=3))
+        numpy.testing.assert_equal([b[0] for b in blocks],
+                                   [[0, 0, 1, 1], [2, 2]])
+
+    def test_read_rows(self):
+        # assets not sorted by site, read through the sorting permutation
+        sids = numpy.array([4, 1, 1, 2, 0], numpy.uint32)
+        order = numpy.argsort(sids, kind='stable')
+        fname = gettemp(suffix='.hdf5')
+        with hdf5.File(fname, 'w') as h5:
+            h5['assets'] = numpy.array(list(zip(range(5), sids)), [
+                ('ordinal', numpy.uint32), ('site_id', numpy.uint32)])
+            rows = read_rows(h5['assets'], [slice(1, 3), slice(4, 5)],
+                             ['ordinal', 'site_id'], order)
+        numpy.testing.assert_equal(rows['site_id'], [1, 1, 4])
+        numpy.testing.assert_equal(rows['ordinal'], [1, 2, 0])
+
+    def test_convert_elt(self):
+        # event_loss_table with a dataset per aggregation key
+        elt_dt = [('event_id', numpy.uint32), ('loss', (numpy.float32, 2))]
+        fname = gettemp(suffix='.hdf5')
+        with hdf5.File(fname, 'w') as h5:
+            h5['event_loss_table/2,1,'] = numpy.array(
+                [(3, [.3, .4]), (1, [.1, .2])], elt_dt)
+            h5['event_loss_table/1,2,'] = numpy.array([(5, [.5, .6])], elt_dt)
+            h5['event_loss_table/1,1,'] = numpy.zeros(0, elt_dt)
+            h5['event_loss_table/indices'] = numpy.zeros(2, numpy.uint32)
+            dstore = datastore.DataStore()
+            convert_elt(h5, dstore, (2, 2), 2)
+        elt = dstore['event_loss_table']
+        numpy.testing.assert_equal(elt['offsets'][()], [0, 0, 1, 3, 3])
+        numpy.testing.assert_equal(elt['agg_id'][()], [1, 2, 2])
+        numpy.testing.assert_equal(elt['event_id'][()], [5, 3, 1])
+        numpy.testing.assert_allclose(
+            elt['loss'][()], [[.5, .6], [.3, .4], [.1, .2]], rtol=1E-6)
+        dstore.close()
+
+        # a parent without losses has no datasets per key
+        with hdf5.File(fname, 'w') as h5:
+            h5['event_loss_table/indices'] = numpy.zeros(2, numpy.uint32)
+            dstore = datastore.DataStore()
+            convert_elt(h5, dstore, (2, 2), 2)
+        elt = dstore['event_loss_table']
+        numpy.testing.assert_equal(elt['offsets'][()], [0, 0, 0, 0, 0])
+        self.assertEqual(elt['agg_id'].shape, (0,))
+        self.assertEqual(elt['event_id'].shape, (0,))
+        self.assertEqual(elt['loss'].shape, (0, 2))
+        dstore.close()
+
+    def test_sort_elt(self):
+        dstore = datastore.DataStore()
+        dstore['event_loss_table/agg_id'] = numpy.uint32([3, 1, 3, 0, 1])
+        dstore['event_loss_table/event_id'] = numpy.uint32([0, 1, 2, 3, 4])
+        dstore['event_loss_table/loss'] = numpy.float32(
+            [[0, 0], [1, 1], [2, 2], [3, 3], [4, 4]])
+        # sort by reading 2 rows at the time
+        calc = mock.Mock(datastore=dstore, param={'aggshape': (2, 2)},
+                         chunksize=2)
+        EbriskCalculator.sort_elt(calc)
+        elt = dstore['event_loss_table']
+        numpy.testing.assert_equal(elt['offsets'][()], [0, 1, 3, 3, 5])
+        numpy.testing.assert_equal(elt['agg_id'][()], [0, 1, 1, 3, 3])
+        numpy.testing.assert_equal(elt['event_id'][()], [3, 1, 4, 0, 2])
+        numpy.testing.assert_equal(elt['loss'][:, 0], [3, 1, 4, 0, 2])
+        dstore.close()
@@ -20,11 +20,14 @@ import io
 import os
 import re
 import math
+from unittest import mock
 
 import numpy.testing
+import pandas
 
 from openquake.baselib.general import countby, gettemp
 from openquake.baselib.datastore import read
+from openquake.baselib.performance import Monitor
 from openquake.hazardlib import nrml, InvalidFile
 from openquake.hazardlib.sourceconverter import RuptureConverter
 from openquake.commonlib.writers import write_csv
@@ -33,7 +36,10 @@ from openquake.commonlib.calc import gmvs_to_poes
 from openquake.calculators.views import view
 from openquake.calculators.export import export
 from openquake.calculators.extract import extract
+from openquake.calculators import event_based
 from openquake.calculators.event_based import get_mean_curves
+from openquake.calculators.getters import (
+    GmfGetter, GmfRegenerator, gen_rupture_getters)
 from openquake.calculators.tests import CalculatorTestCase
 from openquake.qa_tests_data.classical import case_18 as gmpe_tables
 from openquake.qa_tests_data.event_based import (
@@ -126,6 +132,25 @@ class EventBasedTestCase(CalculatorTestCase):
         self.assertEqualFiles('expected/gmf-data.csv', fname)
         self.assertEqualFiles('expected/sig-eps.csv', sig_eps)
 
+    def test_gmf_buffer(self):
+        # storing the GMFs after each task, with and without compression,
+        # gives the same gmf_data as storing them once at the end
+        self.run_calc(blocksize.__file__, 'job.ini', concurrent_tasks='4')
+        expected = self.calc.datastore.read_df('gmf_data').sort_values(
+            ['eid', 'sid'], ignore_index=True)
+        flush_gmfs = event_based.EventBasedCalculator.flush_gmfs
+        for compress in ('false', 'true'):
+            with mock.patch.object(event_based, 'GMF_BUFFER_SIZE', 1), \
+                    mock.patch.object(
+                        event_based.EventBasedCalculator, 'flush_gmfs',
+                        autospec=True, side_effect=flush_gmfs) as flush:
+                self.run_calc(blocksize.__file__, 'job.ini',
+                              concurrent_tasks='4', compress_gmfs=compress)
+            self.assertGreater(flush.call_count, 1)
+            df = self.calc.datastore.read_df('gmf_data').sort_values(
+                ['eid', 'sid'], ignore_index=True)
+            pandas.testing.assert_frame_equal(df, expected)
+
     def test_case_1(self):
         out = self.run_calc(case_1.__file__, 'job.ini', exports='csv,xml')
 
@@ -191,6 +216,76 @@ class EventBasedTestCase(CalculatorTestCase):
         [fname, _, _] = out['gmf_data', 'csv']
         self.assertEqualFiles('expected/minimum-intensity-gmf-data.csv', fname)
 
+    def test_gmf_precision(self):
+        # the GMFs computed in single precision are the same as the
+        # ones computed in double precision up to a relative error of 1E-5
+        out = self.run_calc(blocksize.__file__, 'job.ini', exports='csv',
+                            gmf_precision='float32')
+        [fname, sig_eps, _] = out['gmf_data', 'csv']
+        self.assertEqualFiles('expected/gmf-data.csv', fname, delta=1E-5)
+        self.assertEqualFiles('expected/sig-eps.csv', sig_eps, delta=1E-5)
+
+        out = self.run_calc(case_5.__file__, 'job.ini', exports='csv',
+                            gmf_precision='float32')
+        [fname, _, _] = out['gmf_data', 'csv']
+        self.assertEqualFiles('expected/%s' % strip_calc_id(fname), fname,
+                              delta=1E-5)
+
+    def test_gmf_random_generator(self):
+        # with the counter-based generator any subset of the events of a
+        # rupture has the same ground motion values as in the full rupture
+        self.run_calc(blocksize.__file__, 'job.ini',
+                      gmf_random_generator='philox',
+                      ses_per_logic_tree_path='200')
+        oq = self.calc.oqparam
+        ncomputers = 0
+        for rgetter in gen_rupture_getters(self.calc.datastore):
+            getter = GmfGetter(rgetter, self.calc.srcfilter, oq)
+            for computer in getter.gen_computers(Monitor()):
+                eids_by_rlz = computer.ebrupture.get_eids_by_rlz(
+                    rgetter.rlzs_by_gsim)
+                for gs, rlzs in rgetter.rlzs_by_gsim.items():
+                    eids = numpy.concatenate(
+                        [eids_by_rlz[rlz] for rlz in rlzs])
+                    if len(eids) < 3:
+                        continue
+                    full = computer.compute(gs, len(eids), eids)[0]
+                    idx = numpy.array([len(eids) - 1] + list(
+                        range(0, len(eids) - 1, 2)))  # skip some events
+                    sub = computer.compute(gs, len(idx), eids[idx])[0]
+                    numpy.testing.assert_allclose(
+                        sub, full[:, :, idx], rtol=1E-6)
+                    ncomputers += 1
+        self.assertGreater(ncomputers, 0)
+
+    def test_gmf_regenerator(self):
+        self.run_calc(case_5.__file__, 'job.ini')
+        dstore = self.calc.datastore
+        expected = dstore.read_df('gmf_data').sort_values(['eid', 'sid'])
+        regen = GmfRegenerator(dstore)
+        df = regen.get_gmf_df().sort_values(['eid', 'sid'])
+        self.assertEqual(list(df.columns), list(expected.columns))
+        for col in df.columns:
+            numpy.testing.assert_array_equal(df[col], expected[col])
+
+        # regenerating a subset of events and sites
+        eids = numpy.unique(expected.eid)[::2]
+        sids = numpy.unique(expected.sid)[1:]
+        ok = expected.eid.isin(eids) & expected.sid.isin(sids)
+        df = regen.get_gmf_df(eids, sids)
+        numpy.testing.assert_array_equal(
+            df.sort_values(['eid', 'sid']).gmv_0, expected[ok].gmv_0)
+        self.assertGreater(regen.get_rupture_gmfs.cache_info().hits, 0)
+
+        # extracting the GMFs of an event without storing gmf_data
+        eid = eids[-1]
+        exp = dict(extract(dstore, 'gmf_data?event_id=%d' % eid))
+        self.run_calc(case_5.__file__, 'job.ini', ground_motion_fields='false')
+        self.assertNotIn('gmf_data', self.calc.datastore)
+        got = dict(extract(self.calc.datastore, 'gmf_data?event_id=%d' % eid))
+        for key in exp:
+            numpy.testing.assert_array_equal(got[key], exp[key])
+
     def test_case_2(self):
         out = self.run_calc(case_2.__file__, 'job.ini', exports='csv')
 
@@ -481,6 +576,14 @@ class EventBasedTestCase(CalculatorTestCase):
         pd_mean = df[df.liq_prob_0 > 0].liq_prob_0.mean()
         self.assertGreater(pd_mean, 0)
 
+        # storing the GMFs in shard files must give the same gmf_data
+        expected = self.calc.datastore.read_df('gmf_data').sort_values(
+            ['eid', 'sid'], ignore_index=True)
+        self.run_calc(case_26.__file__, 'job_liq.ini', shard_gmfs='true')
+        df = self.calc.datastore.read_df('gmf_data').sort_values(
+            ['eid', 'sid'], ignore_index=True)
+        pandas.testing.assert_frame_equal(df, expected)
+
     def test_overflow(self):
         too_many_imts = {'SA(%s)' % period: [0.1, 0.2, 0.3]
                          for period in numpy.arange(0.1,  1, 0.001)}
@@ -29,6 +29,7 @@ from openquake.baselib.general import (
     humansize, countby, AccumDict, CallableDict,
     get_array, group_array, fast_agg, fast_agg3)
 from openquake.baselib.performance import performance_view
+from openquake.baselib.parallel import CostModel
 from openquake.baselib.python3compat import encode, decode
 from openquake.hazardlib.gsim.base import ContextMaker
 from openquake.commonlib import util, calc
@@ -526,6 +527,37 @@ def view_task_info(token, dstore):
     return rst_table(data)
 
 
+@view.add('task_cost')
+def view_task_cost(token, dstore):
+    """
+    Display the cost model learned by the Starmap, i.e. the time per unit
+    of weight for each task function and kind of task::
+
+      $ oq show task_cost
+    """
+    data = ['taskname kind tasks weight duration time_per_weight'.split()]
+    model = CostModel(dstore['task_cost'][()])
+    for (name, kind), (w, dt, n) in sorted(model.acc.items()):
+        data.append((name, kind, int(n), w, dt, dt / w if w else numpy.nan))
+    if len(data) == 1:
+        return 'Not available'
+    return rst_table(data)
+
+
+@view.add('gsim_tables')
+def view_gsim_tables(token, dstore):
+    """
+    Display the GSIMs tabulated for the point ruptures, with the number of
+    distances and the maximum errors on the means, stddevs and PoEs
+    compared to the exact calculation (ndists=0 means not tabulated)::
+
+      $ oq show gsim_tables
+    """
+    if 'gsim_tables' not in dstore:
+        return 'Not available'
+    return rst_table(dstore['gsim_tables'][()])
+
+
 @view.add('task_durations')
 def view_task_durations(token, dstore):
     """
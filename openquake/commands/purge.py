@@ -17,6 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import os
 import re
+import shutil
 import getpass
 from openquake.baselib import sap, datastore
 from openquake.commonlib.logs import dbcmd
@@ -35,6 +36,10 @@ def purge_one(calc_id, user, force):
         if os.path.exists(f):  # not removed yet
             os.remove(f)
             print('Removed %s' % f)
+    shards = os.path.join(datadir, 'calc_%s_gmfs' % calc_id)
+    if os.path.exists(shards):  # GMFs stored with shard_gmfs
+        shutil.rmtree(shards)
+        print('Removed %s' % shards)
 
 
 # used in the reset command
@@ -47,6 +47,7 @@ from openquake.baselib import parallel
 from openquake.baselib.general import get_indices
 from openquake.hazardlib.source import rupture
 from openquake.hazardlib import probability_map
+from openquake.hazardlib.calc.stochastic import rupture_dt
 from openquake.commonlib import util
 
 TWO16 = 2 ** 16
@@ -254,6 +255,87 @@ def make_uhs(hmap, info):
     return uhs
 
 
+def read_points(dset, starts, sizes):
+    """
+    Read slices of a dataset of points, by reading with a single operation
+    the slices close to each other, without reading more than twice the
+    total number of requested points at once.
+
+    :param dset: a dataset (or array) of points of shape (P, 3)
+    :param starts: the first point of each slice
+    :param sizes: the number of points of each slice
+    :returns: a list of arrays of points, one per slice
+    """
+    starts = numpy.array(starts, numpy.int64)
+    stops = starts + sizes
+    limit = 2 * sum(sizes)
+    out = [None] * len(starts)
+    idxs = numpy.argsort(starts, kind='stable')
+    i = 0
+    while i < len(idxs):
+        start = starts[idxs[i]]
+        stop = stops[idxs[i]]
+        j = i + 1
+        while j < len(idxs) and stops[idxs[j]] - start <= limit:
+            stop = max(stop, stops[idxs[j]])
+            j += 1
+        points = dset[start:stop]
+        for k in idxs[i:j]:
+            out[k] = points[starts[k] - start:stops[k] - start]
+        i = j
+    return out
+
+
+def reorder_geoms(rup_array, geoms, out, maxsize=1_000_000):
+    """
+    Store the geometries contiguously by source group, in the order of the
+    ruptures, so that the geometries of a block of ruptures of the same
+    group can be read with a single slice; the field geom_id is updated
+    with the new offsets. The geometries are read and written in chunks of
+    at most `maxsize` points (or a single rupture, if bigger).
+
+    :param rup_array: an array of ruptures sorted by ID
+    :param geoms: a function (geom_ids, sizes) -> list of arrays of points
+    :param out: a dataset (or array) of shape (P, 3) where to store the points
+    :param maxsize: the maximum number of points in memory
+    """
+    order = numpy.argsort(rup_array['grp_id'], kind='stable')
+    sizes = rup_array['s1'][order].astype(numpy.int64) * rup_array['s2'][order]
+    stops = numpy.cumsum(sizes)
+    offsets = stops - sizes
+    geom_ids = rup_array['geom_id'][order].astype(numpy.int64)
+    i = 0
+    while i < len(order):
+        j = numpy.searchsorted(stops, offsets[i] + maxsize, 'right')
+        j = max(j, i + 1)  # at least a rupture
+        points = geoms(geom_ids[i:j], sizes[i:j])
+        out[offsets[i]:stops[j - 1]] = numpy.concatenate(points).reshape(-1, 3)
+        i = j
+    rup_array['geom_id'][order] = offsets
+
+
+def convert_rupgeoms(parent, h5):
+    """
+    Convert the ruptures of a parent datastore generated by an engine
+    storing a variable-length row per geometry into the contiguous layout,
+    by saving new `ruptures` and `rupgeoms` datasets in `h5`.
+
+    :param parent: a DataStore with the old layout
+    :param h5: the HDF5 file (or group) of the child calculation
+    """
+    logging.info('Converting the rupture geometries of %s', parent)
+    # the old layout has the same fields, with a 32 bit geom_id
+    rup_array = parent['ruptures'][()].astype(rupture_dt)
+    old = parent['rupgeoms']
+    size = (rup_array['s1'].astype(numpy.int64) * rup_array['s2']).sum()
+    out = h5.create_dataset('rupgeoms', (size, 3), F32)
+    # the old geom_ids are row indices, one row per rupture
+    reorder_geoms(rup_array, lambda geom_ids, sizes: [
+        rows[0] for rows in read_points(
+            old, geom_ids, numpy.ones_like(geom_ids))], out)
+    h5['ruptures'] = rup_array
+
+
 class RuptureImporter(object):
     """
     Import an array of ruptures correctly, i.e. by populating the datasets
@@ -280,8 +362,15 @@ class RuptureImporter(object):
         rup_array.sort(order='serial')
         nr = len(rup_array)
         assert len(numpy.unique(rup_array['serial'])) == nr  # sanity
-        rup_array['geom_id'] = rup_array['id']
         rup_array['id'] = numpy.arange(nr)
+        # store the geometries contiguously by group, in a new dataset
+        dset = self.datastore['rupgeoms']
+        if len(dset):
+            out = self.datastore.create_dset('rupgeoms_', F32, dset.shape)
+            reorder_geoms(rup_array, lambda starts, sizes: read_points(
+                dset, starts, sizes), out)
+            del self.datastore['rupgeoms']
+            self.datastore.hdf5.move('rupgeoms_', 'rupgeoms')
         self.datastore['ruptures'] = rup_array
         self.save_events(rup_array)
 
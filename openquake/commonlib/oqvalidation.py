@@ -110,6 +110,7 @@ class OqParam(valid.ParamSet):
     collapse_level = valid.Param(valid.Choice('0', '1', '2', '3'), 0)
     coordinate_bin_width = valid.Param(valid.positivefloat)
     compare_with_classical = valid.Param(valid.boolean, False)
+    compress_gmfs = valid.Param(valid.boolean, False)
     concurrent_tasks = valid.Param(
         valid.positiveint, multiprocessing.cpu_count() * 2)  # by M. Simionato
     conditional_loss_poes = valid.Param(valid.probabilities, [])
@@ -129,6 +130,9 @@ class OqParam(valid.ParamSet):
     export_multi_curves = valid.Param(valid.boolean, False)
     exports = valid.Param(valid.export_formats, ())
     filter_distance = valid.Param(valid.Choice('rrup'), None)
+    gmf_precision = valid.Param(valid.Choice('float32', 'float64'), 'float64')
+    gmf_random_generator = valid.Param(
+        valid.Choice('legacy', 'philox'), 'legacy')
     ground_motion_correlation_model = valid.Param(
         valid.NoneOr(valid.Choice(*GROUND_MOTION_CORRELATION_MODELS)), None)
     ground_motion_correlation_params = valid.Param(valid.dictionary, {})
@@ -189,6 +193,7 @@ class OqParam(valid.ParamSet):
         valid.positivefloat, numpy.nan)
     reference_siteclass = valid.Param(valid.Choice('A', 'B', 'C', 'D'), 'D')
     reference_backarc = valid.Param(valid.boolean, False)
+    regenerate_gmfs = valid.Param(valid.boolean, False)  # used in risk
     region = valid.Param(valid.wkt_polygon, None)
     region_grid_spacing = valid.Param(valid.positivefloat, None)
     risk_imtls = valid.Param(valid.intensity_measure_types_and_levels, {})
@@ -210,6 +215,7 @@ class OqParam(valid.ParamSet):
         valid.compose(valid.nonzero, valid.positiveint), 1)
     ses_seed = valid.Param(valid.positiveint, 42)
     shakemap_id = valid.Param(valid.nice_string, None)
+    shard_gmfs = valid.Param(valid.boolean, False)
     shift_hypo = valid.Param(valid.boolean, False)
     site_effects = valid.Param(valid.boolean, False)  # shakemap amplification
     sites = valid.Param(valid.NoneOr(valid.coordinates), None)
@@ -221,7 +227,12 @@ class OqParam(valid.ParamSet):
     spatial_correlation = valid.Param(valid.Choice('yes', 'no', 'full'), 'yes')
     specific_assets = valid.Param(valid.namelist, [])
     split_sources = valid.Param(valid.boolean, True)
+    survival_function = valid.Param(
+        valid.Choice('exact', 'tabulated'), 'exact')  # used in classical
+    tabulated_gsims = valid.Param(valid.boolean, False)  # used in classical
+    tabulation_tolerance = valid.Param(valid.positivefloat, .01)
     ebrisk_maxsize = valid.Param(valid.positivefloat, 5E9)  # used in ebrisk
+    pmap_maxsize = valid.Param(valid.NoneOr(valid.positivefloat), None)
     min_weight = valid.Param(valid.positiveint, 6_000)  # used in classical
     max_weight = valid.Param(valid.positiveint, 300_000)  # used in classical
     taxonomies_from_model = valid.Param(valid.boolean, False)
@@ -577,6 +577,7 @@ def get_ruptures(fname_csv):
     rups = []
     geoms = []
     n_occ = 1
+    offset = 0
     for u, row in enumerate(aw.array):
         hypo = row['lon'], row['lat'], row['dep']
         dic = json.loads(row['extra'])
@@ -593,12 +594,13 @@ def get_ruptures(fname_csv):
         rate = dic.get('occurrence_rate', numpy.nan)
         tup = (u, row['serial'], 'no-source', trts.index(row['trt']),
                code[row['kind']], n_occ, row['mag'], row['rake'], rate,
-               minlon, minlat, maxlon, maxlat, hypo, u, s1, s2, 0, 0)
+               minlon, minlat, maxlon, maxlat, hypo, offset, s1, s2, 0, 0)
         rups.append(tup)
-        geoms.append(mesh.transpose(1, 2, 0).flatten())
+        geoms.append(mesh.transpose(1, 2, 0).reshape(-1, 3))
+        offset += s1 * s2
     if not rups:
         return ()
-    dic = dict(geom=numpy.array(geoms, object))
+    dic = dict(geom=numpy.concatenate(geoms))
     # NB: PMFs for nonparametric ruptures are missing
     return hdf5.ArrayWrapper(numpy.array(rups, rupture_dt), dic)
 
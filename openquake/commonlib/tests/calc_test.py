@@ -1,6 +1,6 @@
 import unittest
 import numpy
-from openquake.baselib import general
+from openquake.baselib import general, hdf5
 from openquake.hazardlib.sourceconverter import SourceConverter
 from openquake.commonlib import calc
 
@@ -64,3 +64,60 @@ class HazardMapsTestCase(unittest.TestCase):
         ]
         actual = calc.compute_hazard_maps(numpy.array(curves), imls, poes)
         aaae(expected, actual.T)
+
+
+class RupgeomsTestCase(unittest.TestCase):
+
+    def test_convert_rupgeoms(self):
+        from openquake.hazardlib.calc.stochastic import rupture_dt
+        from openquake.calculators.getters import get_geom
+        rup_array = numpy.zeros(3, rupture_dt)
+        rup_array['grp_id'] = [1, 0, 1]
+        rup_array['s1'] = [1, 2, 1]
+        rup_array['s2'] = [2, 2, 1]
+        rup_array['geom_id'] = [0, 1, 2]  # one row per rupture
+        geoms = [numpy.arange(n * 3, dtype=numpy.float32) + 100 * i
+                 for i, n in enumerate([2, 4, 1])]
+        tmp = general.gettemp(suffix='.hdf5')
+        with hdf5.File(tmp, 'w') as parent:
+            parent['ruptures'] = rup_array
+            dset = parent.create_dataset('rupgeoms', (3,), hdf5.vfloat32)
+            dset[:] = numpy.array(geoms, object)
+            calc.convert_rupgeoms(parent, parent.create_group('child'))
+        with hdf5.File(tmp, 'r') as h5:
+            rups = h5['child/ruptures'][()]
+            rupgeoms = h5['child/rupgeoms']
+            # the offsets are 64 bit, the geometries contiguous by group
+            self.assertEqual(rups['geom_id'].dtype, numpy.uint64)
+            self.assertEqual(list(rups['geom_id']), [4, 0, 6])
+            for rec, geom in zip(rups, geoms):
+                aaae(get_geom(rupgeoms, rec), geom.reshape(-1, 3))
+
+    def test_reorder_geoms(self):
+        from openquake.hazardlib.calc.stochastic import rupture_dt
+        rup_array = numpy.zeros(4, rupture_dt)
+        rup_array['grp_id'] = [1, 0, 1, 0]
+        rup_array['s1'] = [1, 2, 1, 3]
+        rup_array['s2'] = [2, 2, 1, 1]
+        rup_array['geom_id'] = [0, 2, 6, 7]  # offsets of the points
+        points = numpy.arange(30, dtype=numpy.float32).reshape(10, 3)
+
+        def geoms(starts, sizes):
+            return calc.read_points(points, starts, sizes)
+        outs = []
+        for maxsize in (1, 3, 100):  # one rupture, chunks, everything
+            rups = rup_array.copy()
+            out = numpy.zeros_like(points)
+            calc.reorder_geoms(rups, geoms, out, maxsize)
+            self.assertEqual(list(rups['geom_id']), [7, 0, 9, 4])
+            outs.append(out)
+        for out in outs:
+            aaae(out, points[[2, 3, 4, 5, 7, 8, 9, 0, 1, 6]])
+
+    def test_read_points(self):
+        points = numpy.arange(30).reshape(10, 3)
+        # the first two slices are read together, the last one apart
+        out = calc.read_points(points, [4, 0, 9], [2, 1, 1])
+        aaae(out[0], points[4:6])
+        aaae(out[1], points[0:1])
+        aaae(out[2], points[9:10])
@@ -16,21 +16,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
 import ast
 import sys
 import time
+import pickle
+import hashlib
 import logging
 import operator
+import tempfile
 from contextlib import contextmanager
 import numpy
 from scipy.spatial import cKDTree, distance
 
-from openquake.baselib import general
+from openquake.baselib import general, hdf5, config
 from openquake.baselib.python3compat import raise_
 from openquake.hazardlib.geo.utils import (
     KM_TO_DEGREES, angular_distance, fix_lon, get_bounding_box, cross_idl,
     get_longitudinal_extent, BBoxError, spherical_to_cartesian)
+from openquake.hazardlib.geo.geodetic import geodetic_distance
+from openquake.hazardlib.geo.mesh import Mesh
 
 U32 = numpy.uint32
 MAX_DISTANCE = 2000  # km, ultra big distance used if there is no filter
@@ -213,9 +219,180 @@ class MagDepDistance(dict):
         return .01 + numpy.arange(nbins) * self(trt) / (nbins - 1)
 
 
-def split_sources(srcs):
+def _update_hash(h, obj, seen=()):
+    # feed the hash object with a canonical representation of obj, which
+    # does not depend on the pickle protocol or on the Python version
+    if isinstance(obj, numpy.generic):
+        obj = obj.item()
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        h.update(('%s:%r;' % (type(obj).__name__, obj)).encode('utf8'))
+    elif isinstance(obj, bytes):
+        h.update(b'bytes:%d:' % len(obj) + obj)
+    elif isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject:
+        h.update(('array:%s:%s:' % (obj.dtype.str, obj.shape)).encode('utf8'))
+        h.update(numpy.ascontiguousarray(obj).tobytes())
+    elif id(obj) in seen:  # cyclic reference
+        h.update(b'cycle;')
+    else:
+        seen = seen + (id(obj),)
+        if isinstance(obj, (list, tuple, numpy.ndarray)):
+            h.update(('%s:%d[' % (type(obj).__name__, len(obj))).encode())
+            for item in obj:
+                _update_hash(h, item, seen)
+            h.update(b']')
+        elif isinstance(obj, dict):
+            h.update(b'dict{')
+            for key in sorted(obj, key=str):
+                _update_hash(h, key, seen)
+                _update_hash(h, obj[key], seen)
+            h.update(b'}')
+        elif isinstance(obj, (set, frozenset)):
+            h.update(b'set{')
+            for item in sorted(obj, key=repr):
+                _update_hash(h, item, seen)
+            h.update(b'}')
+        elif hasattr(obj, '__dict__') or hasattr(obj, '__slots__'):
+            cls = obj.__class__
+            h.update(('%s.%s(' % (cls.__module__, cls.__qualname__)).encode())
+            # the private attributes are caches, like the 2D polygon
+            dic = {k: v for k, v in getattr(obj, '__dict__', {}).items()
+                   if not k.startswith('_')}
+            for slot in getattr(cls, '__slots__', ()):
+                if not slot.startswith('_') and hasattr(obj, slot):
+                    dic[slot] = getattr(obj, slot)
+            _update_hash(h, dic, seen)
+            h.update(b')')
+        else:
+            h.update(('%s:%r;' % (type(obj).__name__, obj)).encode('utf8'))
+
+
+class SplitCache(object):
+    """
+    A persistent cache of split sources, shared across calculations.
+    The split sources are stored in a file <source_id>-<checksum>.hdf5,
+    where the checksum is computed from the parameters of the source;
+    since the mesh spacings and the minimum magnitude are attributes of
+    the source, the cache is automatically invalidated when such
+    parameters change. When the total size of the cache exceeds `maxsize`
+    the least recently used files are removed.
+
+    :param cachedir: directory where to store the cache files
+    :param maxsize: maximum size of the cache in bytes
+    """
+    # attributes set by the engine, which do not change the split sources
+    ignore = {'grp_id', 'gidx', 'id', 'samples', 'scaling_rate', 'serial',
+              'checksum', 'num_ruptures', 'indices'}
+
+    @classmethod
+    def from_config(cls):
+        """
+        :returns:
+            a SplitCache instance if the `split_cache` directory is set
+            in openquake.cfg, None otherwise
+        """
+        cachedir = config.directory.get('split_cache')
+        if cachedir:
+            maxsize = int(config.directory.get('split_cache_size', 1000))
+            return cls(os.path.expanduser(cachedir), maxsize * 1024 ** 2)
+
+    def __init__(self, cachedir, maxsize):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    def get_key(self, src):
+        """
+        :returns:
+            a string <source_id>-<checksum> where the checksum is the SHA1
+            hash of the relevant parameters of the source
+        """
+        dic = {k: v for k, v in vars(src).items()
+               if k not in self.ignore and not k.startswith('_')}
+        h = hashlib.sha1(src.__class__.__name__.encode('utf8'))
+        _update_hash(h, dic)
+        srcid = re.sub(r'[^\w.-]', '_', src.source_id)
+        return '%s-%s' % (srcid, h.hexdigest())
+
+    def get(self, key):
+        """
+        :returns:
+            a pair (split sources, number of ruptures of the unsplit source)
+            associated to the key, or None
+        """
+        fname = os.path.join(self.cachedir, key + '.hdf5')
+        try:
+            with hdf5.File(fname, 'r') as f:
+                splits = pickle.loads(f['splits'][()].tobytes())
+                num_ruptures = int(f['splits'].attrs['num_ruptures'])
+        except (OSError, KeyError):  # missing or broken file
+            self.misses += 1
+            return
+        os.utime(fname)  # mark as recently used
+        self.hits += 1
+        return splits, num_ruptures
+
+    def put(self, key, splits, num_ruptures):
+        """
+        Store the split sources associated to the key, together with
+        the number of ruptures of the unsplit source
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+        os.close(fd)
+        with hdf5.File(tmp, 'w') as f:
+            f['splits'] = numpy.void(pickle.dumps(splits, protocol=4))
+            f['splits'].attrs['num_ruptures'] = num_ruptures
+        # atomic rename, safe when several workers share the cache
+        os.replace(tmp, os.path.join(self.cachedir, key + '.hdf5'))
+
+    def evict(self):
+        """
+        Remove the least recently used files if the cache is too big
+        """
+        files = []
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith('.hdf5'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(f[1] for f in files)
+        for _mtime, nbytes, path in sorted(files):
+            if size <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # already removed by another worker
+                pass
+            size -= nbytes
+
+
+def _split(src):
+    # split the source, discarding the splits below the minimum magnitude
+    if not src.num_ruptures:  # not set yet
+        src.num_ruptures = src.count_ruptures()
+    mag_a, mag_b = src.get_min_max_mag()
+    min_mag = src.min_mag
+    if mag_b < min_mag:  # discard the source completely
+        return []
+    if min_mag:
+        splits = []
+        for s in src:
+            s.min_mag = min_mag
+            mag_a, mag_b = s.get_min_max_mag()
+            if mag_b < min_mag:
+                continue
+            s.num_ruptures = s.count_ruptures()
+            if s.num_ruptures:
+                splits.append(s)
+    else:
+        splits = list(src)
+    return splits
+
+
+def split_sources(srcs, cache=None):
     """
     :param srcs: sources
+    :param cache: a :class:`SplitCache` instance or None
     :returns: a pair (split sources, split time) or just the split_sources
     """
     from openquake.hazardlib.source import splittable
@@ -226,24 +403,18 @@ def split_sources(srcs):
             sources.append(src)
             continue
         t0 = time.time()
-        if not src.num_ruptures:  # not set yet
-            src.num_ruptures = src.count_ruptures()
-        mag_a, mag_b = src.get_min_max_mag()
-        min_mag = src.min_mag
-        if mag_b < min_mag:  # discard the source completely
-            continue
-        if min_mag:
-            splits = []
-            for s in src:
-                s.min_mag = min_mag
-                mag_a, mag_b = s.get_min_max_mag()
-                if mag_b < min_mag:
-                    continue
-                s.num_ruptures = s.count_ruptures()
-                if s.num_ruptures:
-                    splits.append(s)
+        if cache is None:
+            splits = _split(src)
         else:
-            splits = list(src)
+            key = cache.get_key(src)
+            cached = cache.get(key)
+            if cached is None:
+                splits = _split(src)
+                cache.put(key, splits, src.num_ruptures)
+            else:
+                splits, src.num_ruptures = cached
+        if not splits:  # discarded source
+            continue
         split_time[src.id] = time.time() - t0
         sources.extend(splits)
         has_samples = hasattr(src, 'samples')
@@ -269,6 +440,8 @@ def split_sources(srcs):
                 s.samples = src.samples
             if has_scaling_rate:
                 s.scaling_rate = src.scaling_rate
+    if cache and cache.misses:
+        cache.evict()
     return sources, split_time
 
 
@@ -279,8 +452,11 @@ class SourceFilter(object):
     within the given maximum distance. There is also a .new method
     that filters the sources in parallel and returns a dictionary
     grp_id -> filtered sources.
-    Filter the sources by using `self.sitecol.within_bbox` which is
-    based on numpy.
+    The sites are indexed with a KD-tree on their cartesian coordinates,
+    built lazily in the process using the filter (it is not pickled);
+    the sources are filtered with a radius query around their enlarged
+    bounding box, followed by the bounding box check on the candidate
+    sites only.
     """
     def __init__(self, sitecol, integration_distance):
         if sitecol is not None and len(sitecol) < len(sitecol.complete):
@@ -293,6 +469,27 @@ class SourceFilter(object):
             if isinstance(integration_distance, MagDepDistance)
             else MagDepDistance(integration_distance))
 
+    @property
+    def kdt(self):
+        """
+        The spatial index of the site collection, built at first access
+        """
+        if '_kdt' not in vars(self):
+            self._kdt = cKDTree(self.sitecol.xyz)
+            lons = self.sitecol.lons
+            depths = self.sitecol.depths
+            # used to decide the IDL crossing as SiteCollection.within_bbox
+            self._lonrange = lons.min(), lons.max()
+            # the radius queries are performed at zero depth
+            self._maxdepth = numpy.abs(depths).max() if len(depths) else 0
+        return self._kdt
+
+    def __getstate__(self):
+        # do not send the spatial index to the workers, it is rebuilt
+        # at first access; sending it would make the task arguments big
+        return {k: v for k, v in vars(self).items()
+                if k not in ('_kdt', '_lonrange', '_maxdepth')}
+
     def get_rectangle(self, src):
         """
         :param src: a source object
@@ -351,8 +548,6 @@ class SourceFilter(object):
             return []
         elif not self.integration_distance:  # do not filter
             return self.sitecol.sids
-        if not hasattr(self, 'kdt'):
-            self.kdt = cKDTree(self.sitecol.xyz)
         xyz = spherical_to_cartesian(*rec['hypo'])
         dlon = get_longitudinal_extent(rec['minlon'], rec['maxlon'])
         dlat = rec['maxlat'] - rec['minlat']
@@ -362,6 +557,109 @@ class SourceFilter(object):
         sids.sort()
         return sids
 
+    def close_ruptures(self, recs, trt):
+        """
+        Vectorized version of :meth:`close_sids` for many ruptures.
+
+        :param recs:
+           an array with fields minlon, minlat, maxlon, maxlat, hypo
+        :param trt:
+           tectonic region type string
+        :returns:
+           a boolean array, True for the ruptures with close sites
+        """
+        if self.sitecol is None:
+            return numpy.zeros(len(recs), bool)
+        elif not self.integration_distance:  # do not filter
+            return numpy.ones(len(recs), bool)
+        hypo = recs['hypo'].astype(float)
+        xyz = spherical_to_cartesian(hypo[:, 0], hypo[:, 1], hypo[:, 2])
+        dlon = get_longitudinal_extent(
+            recs['minlon'].astype(float), recs['maxlon'].astype(float))
+        dlat = recs['maxlat'].astype(float) - recs['minlat']
+        delta = numpy.maximum(dlon, dlat) / KM_TO_DEGREES
+        maxradius = self.integration_distance(trt) + delta
+        nsites = self.kdt.query_ball_point(
+            xyz, maxradius, eps=.001, return_length=True)
+        return nsites > 0
+
+    def get_sids_within(self, lon, lat, radius, depth=0.):
+        """
+        :param lon: longitude of the center
+        :param lat: latitude of the center
+        :param radius: distance in km
+        :param depth: depth of the center in km (default 0)
+        :returns:
+           a sorted array with a superset of the site IDs with a distance
+           from the center (geodetic distance combined with the depth)
+           smaller than the radius
+        """
+        # the euclidean distance is never larger than the geodetic
+        # distance combined with the depth, so nothing is lost
+        xyz = spherical_to_cartesian(lon, lat, depth)
+        sids = U32(self.kdt.query_ball_point(
+            xyz, radius + self._maxdepth + 1E-3))
+        sids.sort()
+        return sids
+
+    def split(self, sites, location, distance):
+        """
+        Equivalent to `sites.split(location, distance)`, but computing the
+        distances only for the sites returned by the spatial index.
+
+        :param sites: a subset of the site collection
+        :param location: a Point object
+        :param distance: a distance in km or None
+        :returns: (close_sites, far_sites)
+        """
+        if distance is None:  # all close
+            return sites, None
+        cand = numpy.zeros(len(self.sitecol), bool)
+        cand[self.get_sids_within(location.longitude, location.latitude,
+                                  distance, location.depth)] = True
+        close = cand[sites.sids]
+        idxs, = close.nonzero()
+        if len(idxs):
+            mesh = Mesh(sites.lons[idxs], sites.lats[idxs],
+                        sites.depths[idxs])
+            close[idxs] = location.distance_to_mesh(mesh) < distance
+        return sites.filter(close), sites.filter(~close)
+
+    def _get_bsphere(self, min_lon, min_lat, max_lon, max_lat):
+        # returns the center and the radius of a sphere containing a box
+        # with min_lon < max_lon < min_lon + 180
+        min_lat, max_lat = max(min_lat, -90.), min(max_lat, 90.)
+        lon = fix_lon((min_lon + max_lon) / 2.)
+        lat = (min_lat + max_lat) / 2.
+        # the farthest points of the box are on its corners, since
+        # the box is less than 180 degrees wide
+        lons = numpy.array([min_lon, min_lon, max_lon, max_lon])
+        lats = numpy.array([min_lat, max_lat, min_lat, max_lat])
+        radius = geodetic_distance(lon, lat, lons, lats).max()
+        return lon, lat, radius * 1.001
+
+    def _within_bbox(self, box):
+        # same as self.sitecol.within_bbox(box), but checking the box
+        # only for the sites returned by the spatial index
+        self.kdt  # make sure the index and the longitude range are there
+        min_lon, min_lat, max_lon, max_lat = box
+        idl = cross_idl(*self._lonrange, min_lon, max_lon)
+        if idl:
+            min_lon, max_lon = min_lon % 360, max_lon % 360
+        if not 0 < max_lon - min_lon <= 180:
+            # the bounding sphere built from the corners would not enclose
+            # the box, use the unfiltered path
+            return self.sitecol.within_bbox(box)
+        sids = self.get_sids_within(
+            *self._get_bsphere(min_lon, min_lat, max_lon, max_lat))
+        lons = self.sitecol.lons[sids]
+        lats = self.sitecol.lats[sids]
+        if idl:
+            lons = lons % 360
+        mask = (min_lon < lons) * (lons < max_lon) * \
+               (min_lat < lats) * (lats < max_lat)
+        return sids[mask]
+
     # used for debugging purposes
     def get_cdist(self, rec):
         """
@@ -388,7 +686,7 @@ class SourceFilter(object):
                 src.indices = self.sitecol.sids
                 yield src
                 continue
-            indices = self.sitecol.within_bbox(box)
+            indices = self._within_bbox(box)
             if len(indices):
                 src.indices = indices
                 yield src
@@ -20,6 +20,7 @@
 Module :mod:`~openquake.hazardlib.calc.gmf` exports
 :func:`ground_motion_fields`.
 """
+import copy
 import time
 import numpy
 import scipy.stats
@@ -31,6 +32,7 @@ from openquake.hazardlib.imt import from_string
 
 U32 = numpy.uint32
 F32 = numpy.float32
+F64 = numpy.float64
 
 
 class CorrelationButNoInterIntraStdDevs(Exception):
@@ -47,9 +49,42 @@ intra event standard deviations.''' % (
             self.corr.__class__.__name__, self.gsim.__class__.__name__)
 
 
-def rvs(distribution, *size):
+def rvs(distribution, *size, dtype=F64):
     array = distribution.rvs(size)
-    return array
+    return array.astype(dtype, copy=False)
+
+
+def get_rng(master_seed, rup_seed, stream, counter=0):
+    """
+    :param master_seed: the master seed of the calculation
+    :param rup_seed: the seed of the rupture
+    :param stream: an integer identifying the stream (IMT and kind)
+    :param counter: the initial value of the counter
+    :returns: a numpy Generator based on the counter-based Philox generator
+    """
+    key = [((master_seed & 0xFFFFFFFF) << 32) + rup_seed, stream]
+    return numpy.random.Generator(numpy.random.Philox(
+        counter=numpy.array([counter, 0, 0, 0], numpy.uint64),
+        key=numpy.array(key, numpy.uint64)))
+
+
+def to_float32(ctx):
+    """
+    :param ctx: a RuptureContext, DistancesContext or SiteCollection
+    :returns: a shallow copy of the context with float32 arrays
+    """
+    new = copy.copy(ctx)
+    dic = vars(new)  # NB: there could be cached properties
+    for name, value in vars(ctx).items():
+        if not isinstance(value, numpy.ndarray):
+            continue
+        elif value.dtype == F64:
+            dic[name] = value.astype(F32)
+        elif value.dtype.names:  # the array of a SiteCollection
+            dt = value.dtype
+            dic[name] = value.astype(
+                [(n, F32 if dt[n] == F64 else dt[n]) for n in dt.names])
+    return new
 
 
 def to_imt_unit_values(vals, imt):
@@ -91,6 +126,21 @@ class GmfComputer(object):
 
     :param amplifier:
         None or an instance of Amplifier
+
+    :param sec_perils:
+        a list of secondary perils
+
+    :param precision:
+        'float64' (the default) or 'float32'; in the latter case the
+        contexts, the GSIM outputs, the random numbers and the residuals
+        are all kept in single precision
+
+    :param master_seed:
+        if None, the random numbers are generated by the global numpy
+        generator seeded with the rupture seed; otherwise each IMT has
+        its own Philox streams keyed by (master_seed, rupture seed), in
+        which each event owns a fixed range of counters, and any subset of
+        events can be computed independently
     """
     # The GmfComputer is called from the OpenQuake Engine. In that case
     # the rupture is an higher level containing a
@@ -101,7 +151,8 @@ class GmfComputer(object):
     # seed is extracted from the underlying rupture.
     def __init__(self, rupture, sitecol, imts, cmaker,
                  truncation_level=None, correlation_model=None,
-                 amplifier=None, sec_perils=()):
+                 amplifier=None, sec_perils=(), precision='float64',
+                 master_seed=None):
         if len(sitecol) == 0:
             raise ValueError('No sites')
         elif len(imts) == 0:
@@ -114,6 +165,7 @@ class GmfComputer(object):
         self.correlation_model = correlation_model
         self.amplifier = amplifier
         self.sec_perils = sec_perils
+        self.master_seed = master_seed
         # `rupture` is an EBRupture instance in the engine
         if hasattr(rupture, 'source_id'):
             self.ebrupture = rupture
@@ -125,6 +177,13 @@ class GmfComputer(object):
         self.rctx, self.sctx, self.dctx = cmaker.make_contexts(
             sitecol, rupture)
         self.sids = self.sctx.sids
+        self.dtype = numpy.dtype(precision)
+        if self.dtype == F32:  # the GSIMs will work on float32 arrays
+            self.rctx = to_float32(self.rctx)
+            self.dctx = to_float32(self.dctx)
+            self.gsim_sctx = to_float32(self.sctx)
+        else:
+            self.gsim_sctx = self.sctx
         if correlation_model:  # store the filtered sitecol
             self.sites = sitecol.complete.filtered(self.sids)
         if truncation_level is None:
@@ -136,67 +195,78 @@ class GmfComputer(object):
             self.distribution = scipy.stats.truncnorm(
                 - truncation_level, truncation_level)
 
-
     def compute_all(self, min_iml, rlzs_by_gsim, sig_eps=None):
         """
-        :returns: [(sid, eid, gmv), ...], dt
+        :returns: (array of dtype (sid, eid, rlz, gmv, ...), dt)
         """
         t0 = time.time()
-        sids = self.sids
+        cols = self.compute_columns(min_iml, rlzs_by_gsim, sig_eps)
+        dt = F32, (len(min_iml),)
+        dtlist = [('sid', U32), ('eid', U32), ('rlz', U32), ('gmv', dt)] + [
+            (out, dt) for sp in self.sec_perils for out in sp.outputs]
+        d = numpy.zeros(len(cols['sid']), dtlist)
+        for name, col in cols.items():
+            d[name] = col
+        return d, time.time() - t0
+
+    def compute_columns(self, min_iml, rlzs_by_gsim, sig_eps=None):
+        """
+        :param min_iml: an array of M minimum intensities
+        :param rlzs_by_gsim: a dictionary gsim -> realization indices
+        :param sig_eps: if not None, a list populated with the tuples
+                        (eid, rlz, sig..., eps...) for the nonzero events
+        :returns:
+            a dictionary with keys sid, eid, rlz, gmv and the outputs of the
+            secondary perils, if any; the rows are ordered by realization,
+            event and site and the rows with zero ground motion are discarded
+        """
         eids_by_rlz = self.ebrupture.get_eids_by_rlz(rlzs_by_gsim)
         mag = self.ebrupture.rupture.mag
-        data = []
-        No = sum(len(sp.outputs) for sp in self.sec_perils)
+        min_iml = numpy.array(min_iml, F32)
+        outputs = [out for sp in self.sec_perils for out in sp.outputs]
+        cols = {name: [] for name in ['sid', 'eid', 'rlz', 'gmv'] + outputs}
         for gs, rlzs in rlzs_by_gsim.items():
-            num_events = sum(len(eids_by_rlz[rlz]) for rlz in rlzs)
+            eids = numpy.concatenate([eids_by_rlz[rlz] for rlz in rlzs])
+            rlzi = numpy.repeat(
+                U32(rlzs), [len(eids_by_rlz[rlz]) for rlz in rlzs])
             # NB: the trick for performance is to keep the call to
             # compute.compute outside of the loop over the realizations
             # it is better to have few calls producing big arrays
-            array, sig, eps = self.compute(gs, num_events)
-            array = array.transpose(1, 0, 2)  # from M, N, E to N, M, E
-            for i, miniml in enumerate(min_iml):  # gmv < minimum
-                arr = array[:, i, :]
-                arr[arr < miniml] = 0
-            n = 0
-            for rlz in rlzs:
-                eids = eids_by_rlz[rlz]
-                for ei, eid in enumerate(eids):
-                    gmfa = array[:, :, n + ei]  # shape (N, M)
-                    tot = gmfa.sum(axis=0)  # shape (M,)
-                    if not tot.sum():
-                        continue
-                    if sig_eps is not None:
-                        tup = tuple([eid, rlz] + list(sig[:, n + ei]) +
-                                    list(eps[:, n + ei]))
-                        sig_eps.append(tup)
-                    sp_out = numpy.zeros((No,) + gmfa.shape)  # No, N, M
-                    for m, imt in enumerate(self.imts):
-                        o = 0
-                        for sp in self.sec_perils:
-                            o1 = o + len(sp.outputs)
-                            sp_out[o:o1, :, m] = sp.compute(
-                                mag, imt, gmfa[:, m], self.sctx)
-                            o = o1
-                    for i, gmv in enumerate(gmfa):
-                        if gmv.sum():
-                            if No:
-                                data.append((sids[i], eid, rlz, gmv) +
-                                            tuple(sp_out[:, i, :]))
-                            else:
-                                data.append((sids[i], eid, rlz, gmv))
-                        # gmv can be zero due to the minimum_intensity, coming
-                        # from the job.ini or from the vulnerability functions
-                n += len(eids)
-        dt = F32, (len(min_iml),)
-        dtlist = [('sid', U32), ('eid', U32), ('rlz', U32), ('gmv', dt)] + [
-            (out, dt) for sp in self.sec_perils for out in sp.outputs]
-        d = numpy.array(data, dtlist)
-        return d, time.time() - t0
-
-    def compute(self, gsim, num_events):
+            array, sig, eps = self.compute(gs, len(eids), eids)
+            array[array < min_iml[:, None, None]] = 0  # gmv < minimum
+            gmfs = array.transpose(2, 1, 0)  # from M, N, E to E, N, M
+            # gmv can be zero due to the minimum_intensity, coming
+            # from the job.ini or from the vulnerability functions
+            ok_events = gmfs.sum(axis=(1, 2)) != 0
+            ok = (gmfs.sum(axis=2) != 0) & ok_events[:, None]
+            e, s = ok.nonzero()  # ordered by event and then by site
+            cols['sid'].append(self.sids[s])
+            cols['eid'].append(eids[e])
+            cols['rlz'].append(rlzi[e])
+            cols['gmv'].append(gmfs[e, s])
+            if sig_eps is not None:
+                for ei in ok_events.nonzero()[0]:
+                    sig_eps.append(tuple([eids[ei], rlzi[ei]] +
+                                         list(sig[:, ei]) + list(eps[:, ei])))
+            if outputs:
+                # the secondary perils are computed on arrays of shape (E, N)
+                sp_out = numpy.zeros((len(outputs),) + gmfs.shape)
+                for m, imt in enumerate(self.imts):
+                    o = 0
+                    for sp in self.sec_perils:
+                        o1 = o + len(sp.outputs)
+                        sp_out[o:o1, :, :, m] = sp.compute(
+                            mag, imt, gmfs[:, :, m], self.sctx)
+                        o = o1
+                for out, arr in zip(outputs, sp_out):
+                    cols[out].append(arr[e, s])
+        return {name: numpy.concatenate(col) for name, col in cols.items()}
+
+    def compute(self, gsim, num_events, eids=None):
         """
         :param gsim: a GSIM instance
         :param num_events: the number of seismic events
+        :param eids: the event IDs (by default 0, 1, ... num_events - 1)
         :returns:
             a 32 bit array of shape (num_imts, num_sites, num_events) and
             two arrays with shape (num_imts, num_events): sig for stddev_inter
@@ -205,6 +275,8 @@ class GmfComputer(object):
         result = numpy.zeros((len(self.imts), len(self.sids), num_events), F32)
         sig = numpy.zeros((len(self.imts), num_events), F32)
         eps = numpy.zeros((len(self.imts), num_events), F32)
+        if eids is None:
+            eids = numpy.arange(num_events)
         numpy.random.seed(self.seed)
         for imti, imt in enumerate(self.imts):
             if isinstance(gsim, MultiGMPE):
@@ -213,7 +285,7 @@ class GmfComputer(object):
                 gs = gsim  # regular GMPE
             try:
                 result[imti], sig[imti], eps[imti] = self._compute(
-                     gs, num_events, imt)
+                     gs, num_events, imt, imti, eids)
             except Exception as exc:
                 raise exc.__class__(
                     '%s for %s, %s, source_id=%s' %
@@ -224,22 +296,58 @@ class GmfComputer(object):
                 self.sctx.ampcode, result, self.imts, self.seed)
         return result, sig, eps
 
-    def _compute(self, gsim, num_events, imt):
+    def _rvs(self, imti, eids, num_sids=None):
+        """
+        :param imti: the IMT index
+        :param eids: the event IDs
+        :param num_sids: the number of sites, or None for the epsilons
+        :returns: an array of shape (num_sids, E) or (E,) if num_sids is None
+        """
+        size = (len(eids),) if num_sids is None else (num_sids, len(eids))
+        if self.master_seed is None:  # use the global numpy generator
+            return rvs(self.distribution, *size, dtype=self.dtype)
+        # each event owns a fixed range of counters of the Philox stream
+        # of the IMT, so any subset of events can be drawn; the uniform
+        # numbers of each run of consecutive event IDs are drawn at once
+        # and transformed with the inverse CDF of the distribution
+        n, stream = (1, 2 * imti + 1) if num_sids is None else (
+            num_sids, 2 * imti)
+        per_step = 4 if self.dtype == F64 else 8  # numbers per counter
+        steps = -(-n // per_step)  # counters per event
+        eids = numpy.array(eids, numpy.int64)
+        uni = numpy.zeros((len(eids), n), self.dtype)
+        # indices of the first events of the runs (the IDs are nonnegative)
+        starts = numpy.flatnonzero(numpy.diff(eids, prepend=-2) != 1)
+        for e0, e1 in zip(starts, list(starts[1:]) + [len(eids)]):
+            rng = get_rng(self.master_seed, self.seed, stream,
+                          eids[e0] * steps)
+            uni[e0:e1] = rng.random(
+                (e1 - e0, steps * per_step), self.dtype)[:, :n]
+        # the uniform numbers are in [0, 1) and ppf(0) can be -inf, so the
+        # zeros become half of the smallest positive number, which is epsneg
+        numpy.maximum(uni, numpy.finfo(self.dtype).epsneg / 2, out=uni)
+        return self.distribution.ppf(uni.T).astype(
+            self.dtype, copy=False).reshape(size)
+
+    def _compute(self, gsim, num_events, imt, imti=0, eids=()):
         """
         :param gsim: a GSIM instance
         :param num_events: the number of seismic events
         :param imt: an IMT instance
+        :param imti: the index of the IMT
+        :param eids: the event IDs
         :returns: (gmf(num_sites, num_events), stddev_inter(num_events),
                    epsilons(num_events))
         """
         dctx = self.dctx.roundup(gsim.minimum_distance)
+        sctx, dtype = self.gsim_sctx, self.dtype
         if self.distribution is None:
             if self.correlation_model:
                 raise ValueError('truncation_level=0 requires '
                                  'no correlation model')
             mean, _stddevs = gsim.get_mean_and_stddevs(
-                self.sctx, self.rctx, dctx, imt, stddev_types=[])
-            gmf = to_imt_unit_values(mean, imt)
+                sctx, self.rctx, dctx, imt, stddev_types=[])
+            gmf = to_imt_unit_values(mean.astype(dtype, copy=False), imt)
             gmf.shape += (1, )
             gmf = gmf.repeat(num_events, axis=1)
             return (gmf,
@@ -256,34 +364,38 @@ class GmfComputer(object):
                     self.correlation_model, gsim)
 
             mean, [stddev_total] = gsim.get_mean_and_stddevs(
-                self.sctx, self.rctx, dctx, imt, [StdDev.TOTAL])
-            stddev_total = stddev_total.reshape(stddev_total.shape + (1, ))
-            mean = mean.reshape(mean.shape + (1, ))
+                sctx, self.rctx, dctx, imt, [StdDev.TOTAL])
+            stddev_total = stddev_total.astype(dtype, copy=False).reshape(
+                stddev_total.shape + (1, ))
+            mean = mean.astype(dtype, copy=False).reshape(mean.shape + (1, ))
 
-            total_residual = stddev_total * rvs(
-                self.distribution, num_sids, num_events)
+            total_residual = stddev_total * self._rvs(
+                imti, eids, num_sids).astype(dtype, copy=False)
             gmf = to_imt_unit_values(mean + total_residual, imt)
             stdi = numpy.nan
             epsilons = numpy.empty(num_events, F32)
             epsilons.fill(numpy.nan)
         else:
             mean, [stddev_inter, stddev_intra] = gsim.get_mean_and_stddevs(
-                self.sctx, self.rctx, dctx, imt,
+                sctx, self.rctx, dctx, imt,
                 [StdDev.INTER_EVENT, StdDev.INTRA_EVENT])
-            stddev_intra = stddev_intra.reshape(stddev_intra.shape + (1, ))
-            stddev_inter = stddev_inter.reshape(stddev_inter.shape + (1, ))
-            mean = mean.reshape(mean.shape + (1, ))
-            intra_residual = stddev_intra * rvs(
-                self.distribution, num_sids, num_events)
+            stddev_intra = stddev_intra.astype(dtype, copy=False).reshape(
+                stddev_intra.shape + (1, ))
+            stddev_inter = stddev_inter.astype(dtype, copy=False).reshape(
+                stddev_inter.shape + (1, ))
+            mean = mean.astype(dtype, copy=False).reshape(mean.shape + (1, ))
+            intra_residual = stddev_intra * self._rvs(
+                imti, eids, num_sids).astype(dtype, copy=False)
 
             if self.correlation_model is not None:
                 intra_residual = self.correlation_model.apply_correlation(
                     self.sites, imt, intra_residual, stddev_intra)
+                intra_residual = intra_residual.astype(dtype, copy=False)
                 sh = intra_residual.shape
                 if len(sh) == 1:  # a vector
                     intra_residual = intra_residual.reshape(sh + (1,))
 
-            epsilons = rvs(self.distribution, num_events)
+            epsilons = self._rvs(imti, eids).astype(dtype, copy=False)
             inter_residual = stddev_inter * epsilons
 
             gmf = to_imt_unit_values(
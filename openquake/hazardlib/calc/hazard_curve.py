@@ -183,7 +183,7 @@ def calc_hazard_curves(
     param = dict(imtls=imtls, truncation_level=truncation_level,
                  filter_distance=filter_distance, reqv=reqv,
                  cluster=grp.cluster, shift_hypo=shift_hypo)
-    pmap = ProbabilityMap(len(imtls.array), 1)
+    pmap = ProbabilityMap.build(len(imtls.array), 1, ())
     # Processing groups with homogeneous tectonic region
     mon = Monitor()
     for group in groups:
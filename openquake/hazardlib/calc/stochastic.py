@@ -28,7 +28,10 @@ from openquake.baselib.general import AccumDict
 from openquake.baselib.performance import Monitor
 from openquake.baselib.python3compat import raise_
 from openquake.hazardlib.calc.filters import nofilter
-from openquake.hazardlib.source.rupture import BaseRupture, EBRupture
+from openquake.hazardlib.source.rupture import (
+    BaseRupture, EBRupture, ParametricProbabilisticRupture)
+from openquake.hazardlib.source.point import get_rupture_corners
+from openquake.hazardlib.geo.surface.planar import PlanarSurface
 from openquake.hazardlib.geo.mesh import surface_to_array
 
 TWO16 = 2 ** 16  # 65,536
@@ -36,6 +39,7 @@ TWO32 = 2 ** 32  # 4,294,967,296
 F64 = numpy.float64
 U16 = numpy.uint16
 U32 = numpy.uint32
+U64 = numpy.uint64
 U8 = numpy.uint8
 I32 = numpy.int32
 F32 = numpy.float32
@@ -90,22 +94,23 @@ rupture_dt = numpy.dtype([
     ('code', U8), ('n_occ', U32), ('mag', F32), ('rake', F32),
     ('occurrence_rate', F32),
     ('minlon', F32), ('minlat', F32), ('maxlon', F32), ('maxlat', F32),
-    ('hypo', (F32, 3)), ('geom_id', U32), ('s1', U16), ('s2', U16),
+    ('hypo', (F32, 3)), ('geom_id', U64), ('s1', U16), ('s2', U16),
     ('e0', U32), ('e1', U32)])
 
 
-# this is really fast
 def get_rup_array(ebruptures, srcfilter=nofilter):
     """
     Convert a list of EBRuptures into a numpy composite array, by filtering
-    out the ruptures far away from every site
+    out the ruptures far away from every site. The bounding boxes and the
+    filtering are computed in bulk. The geometries are returned as a
+    contiguous array of points of shape (P, 3) in the attribute .geom;
+    the field `geom_id` of each rupture is the index of its first point.
     """
     if not BaseRupture._code:
         BaseRupture.init()  # initialize rupture codes
-
     rups = []
-    geoms = []
-    nbytes = 0
+    points = []
+    trts = []
     for ebrupture in ebruptures:
         rup = ebrupture.rupture
         mesh = surface_to_array(rup.surface)
@@ -113,31 +118,153 @@ def get_rup_array(ebruptures, srcfilter=nofilter):
         assert sy < TWO16, 'Too many multisurfaces: %d' % sy
         assert sz < TWO16, 'The rupture mesh spacing is too small'
         hypo = rup.hypocenter.x, rup.hypocenter.y, rup.hypocenter.z
-        points = mesh.reshape(3, -1).T   # shape (n, 3)
-        rec = numpy.zeros(1, rupture_dt)[0]
-        rec['serial'] = rup.rup_id
-        rec['minlon'] = minlon = points[:, 0].min()
-        rec['minlat'] = minlat = points[:, 1].min()
-        rec['maxlon'] = maxlon = points[:, 0].max()
-        rec['maxlat'] = maxlat = points[:, 1].max()
-        rec['mag'] = rup.mag
-        rec['hypo'] = hypo
-        if srcfilter.integration_distance and len(
-                srcfilter.close_sids(rec, rup.tectonic_region_type)) == 0:
-            continue
         rate = getattr(rup, 'occurrence_rate', numpy.nan)
-        tup = (0, ebrupture.rup_id, ebrupture.source_id, ebrupture.grp_id,
-               rup.code, ebrupture.n_occ, rup.mag, rup.rake, rate,
-               minlon, minlat, maxlon, maxlat, hypo, 0, sy, sz, 0, 0)
-        rups.append(tup)
-        geoms.append(points.flatten())
-        nbytes += rupture_dt.itemsize + mesh.nbytes
+        rups.append((0, ebrupture.rup_id, ebrupture.source_id,
+                     ebrupture.grp_id, rup.code, ebrupture.n_occ, rup.mag,
+                     rup.rake, rate, 0, 0, 0, 0, hypo, 0, sy, sz, 0, 0))
+        points.append(mesh.reshape(3, -1).T)   # shape (n, 3)
+        trts.append(rup.tectonic_region_type)
     if not rups:
         return ()
-    dic = dict(geom=numpy.array(geoms, object), nbytes=nbytes)
+    return _build_rup_array(numpy.array(rups, rupture_dt), points,
+                            numpy.array(trts), srcfilter)
+
+
+def _build_rup_array(array, points, trts, srcfilter):
+    # set the bounding boxes and the geom_ids, then filter the ruptures
+    sizes = numpy.array([len(pts) for pts in points])
+    offsets = numpy.cumsum(sizes) - sizes
+    geom = numpy.concatenate(points).astype(F32)  # shape (P, 3)
+    array['minlon'] = numpy.minimum.reduceat(geom[:, 0], offsets)
+    array['minlat'] = numpy.minimum.reduceat(geom[:, 1], offsets)
+    array['maxlon'] = numpy.maximum.reduceat(geom[:, 0], offsets)
+    array['maxlat'] = numpy.maximum.reduceat(geom[:, 1], offsets)
+    if srcfilter.integration_distance:
+        ok = numpy.zeros(len(array), bool)
+        for trt in numpy.unique(trts):
+            idx = trts == trt
+            ok[idx] = srcfilter.close_ruptures(array[idx], trt)
+        if not ok.any():
+            return ()
+        array = array[ok]
+        geom = geom[numpy.repeat(ok, sizes)]
+        sizes = sizes[ok]
+    array['geom_id'] = numpy.cumsum(sizes) - sizes
+    dic = dict(geom=geom, nbytes=array.nbytes + geom.nbytes)
     # NB: PMFs for nonparametric ruptures are not saved since they
     # are useless for the GMF computation
-    return hdf5.ArrayWrapper(numpy.array(rups, rupture_dt), dic)
+    return hdf5.ArrayWrapper(array, dic)
+
+
+def concat_rup_arrays(rup_arrays):
+    """
+    :param rup_arrays: a list of outputs of :func:`get_rup_array`
+    :returns: a single ArrayWrapper with all the ruptures, or ()
+    """
+    rup_arrays = [ra for ra in rup_arrays if len(ra)]
+    if not rup_arrays:
+        return ()
+    elif len(rup_arrays) == 1:
+        return rup_arrays[0]
+    offset = 0
+    for ra in rup_arrays:
+        ra.array['geom_id'] += offset
+        offset += len(ra.geom)
+    dic = dict(geom=numpy.concatenate([ra.geom for ra in rup_arrays]),
+               nbytes=sum(ra.nbytes for ra in rup_arrays))
+    return hdf5.ArrayWrapper(
+        numpy.concatenate([ra.array for ra in rup_arrays]), dic)
+
+
+def sample_point_ruptures(src, eff_num_ses, srcfilter=nofilter):
+    """
+    Sample the ruptures of a point, area or multipoint source with Poisson
+    occurrences. This is equivalent to calling `src.sample_ruptures` and
+    `get_rup_array`, with the same random numbers, but the rates are
+    computed as a flat array, the occurrences are drawn in a single call
+    and the planar geometries are built in bulk only for the occurring
+    ruptures, directly in the `rupture_dt` layout.
+
+    :param src: a source with a nodal_plane_distribution
+    :param eff_num_ses: number of stochastic event sets * number of samples
+    :param srcfilter: SourceFilter instance used for post filtering
+    :returns: an ArrayWrapper of ruptures (with attribute .geom) or ()
+    """
+    if not BaseRupture._code:
+        BaseRupture.init()  # initialize rupture codes
+    code = BaseRupture._code[ParametricProbabilisticRupture, PlanarSurface]
+    tom = src.temporal_occurrence_model
+    trt = src.tectonic_region_type
+    nps = src.nodal_plane_distribution.data
+    hcs = src.hypocenter_distribution.data
+    np_probs = numpy.array([prob for prob, np in nps])
+    hc_probs = numpy.array([prob for prob, hc in hcs])
+    nodal_planes = numpy.array([(np.strike, np.dip, np.rake)
+                                for prob, np in nps])  # shape (P, 3)
+    hc_depths = numpy.array([depth for prob, depth in hcs])  # shape (H,)
+    P, H = len(nps), len(hcs)
+
+    # build a flat array of rates ordered by point, mag, nodal plane, depth
+    rates, mags, points = [], [], []
+    for p, ps in enumerate(src):
+        mag_rates = numpy.array([
+            (mag, rate) for mag, rate in ps.get_annual_occurrence_rates()
+            if mag >= src.min_mag]).reshape(-1, 2)
+        rates.append((mag_rates[:, 1, None, None] * np_probs[None, :, None] *
+                      hc_probs[None, None, :]).flatten())
+        mags.append(mag_rates[:, 0])
+        points.append((ps.location.longitude, ps.location.latitude,
+                       ps.rupture_aspect_ratio, ps.upper_seismogenic_depth,
+                       ps.lower_seismogenic_depth))
+    nmags = numpy.array([len(m) for m in mags])
+    offsets = numpy.concatenate([[0], numpy.cumsum(nmags * P * H)])
+    rates = numpy.concatenate(rates)
+    mags = numpy.concatenate(mags)
+    mag_offsets = numpy.concatenate([[0], numpy.cumsum(nmags)])
+    points = numpy.array(points)  # shape (num_points, 5)
+    eff_rates = rates * tom.time_span * eff_num_ses
+
+    arrays = []
+    rup_id = src.serial
+    numpy.random.seed(src.serial)
+    for grp_id in src.grp_ids:
+        occurs = numpy.random.poisson(eff_rates)
+        idx, = occurs.nonzero()
+        serial = rup_id + numpy.arange(len(idx))
+        rup_id += len(idx)
+        if len(idx) == 0:
+            continue
+        # decode the flat index into point, magnitude, nodal plane, depth
+        pt = numpy.searchsorted(offsets, idx, 'right') - 1
+        m, nh = divmod(idx - offsets[pt], P * H)  # m relative to the point
+        n, h = divmod(nh, H)
+        planes = nodal_planes[n]
+        hypo = numpy.zeros((len(idx), 3))
+        hypo[:, 0] = points[pt, 0]
+        hypo[:, 1] = points[pt, 1]
+        hypo[:, 2] = hc_depths[h]
+        mag = mags[mag_offsets[pt] + m]
+        corners = get_rupture_corners(
+            src.magnitude_scaling_relationship, points[pt, 2],
+            points[pt, 3], points[pt, 4], mag, planes[:, 0], planes[:, 1],
+            planes[:, 2], hypo)
+        arr = numpy.zeros(len(idx), rupture_dt)
+        arr['serial'] = serial
+        arr['source_id'] = src.source_id
+        arr['grp_id'] = grp_id
+        arr['code'] = code
+        arr['n_occ'] = occurs[idx]
+        arr['mag'] = mag
+        arr['rake'] = planes[:, 2]
+        arr['occurrence_rate'] = rates[idx]
+        arr['hypo'] = hypo
+        arr['s1'] = 1
+        arr['s2'] = 4
+        ra = _build_rup_array(
+            arr, corners, numpy.repeat(trt, len(arr)), srcfilter)
+        if len(ra):
+            arrays.append(ra)
+    return concat_rup_arrays(arrays)
 
 
 def sample_cluster(sources, srcfilter, num_ses, param):
@@ -246,6 +373,7 @@ def sample_ruptures(sources, srcfilter, param, monitor=Monitor()):
                              eff_ruptures={trt: len(eb_ruptures)}))
     else:
         eb_ruptures = []
+        rup_arrays = []  # sampled from point-like sources
         eff_ruptures = 0
         # AccumDict of arrays with 2 elements weight, calc_time
         calc_times = AccumDict(accum=numpy.zeros(3, numpy.float32))
@@ -253,22 +381,30 @@ def sample_ruptures(sources, srcfilter, param, monitor=Monitor()):
             nr = src.num_ruptures
             eff_ruptures += nr
             t0 = time.time()
-            if len(eb_ruptures) > MAX_RUPTURES:
+            if len(eb_ruptures) + sum(map(len, rup_arrays)) > MAX_RUPTURES:
                 # yield partial result to avoid running out of memory
-                yield AccumDict(dict(rup_array=get_rup_array(eb_ruptures,
-                                                             srcfilter),
+                rup_arrays.append(get_rup_array(eb_ruptures, srcfilter))
+                yield AccumDict(dict(rup_array=concat_rup_arrays(rup_arrays),
                                      calc_times={}, eff_ruptures={}))
                 eb_ruptures.clear()
+                rup_arrays.clear()
             samples = getattr(src, 'samples', 1)
-            for rup, grp_id, n_occ in src.sample_ruptures(samples * num_ses):
-                ebr = EBRupture(rup, src.source_id, grp_id, n_occ)
-                eb_ruptures.append(ebr)
+            if (hasattr(src, 'nodal_plane_distribution') and
+                    hasattr(src, 'temporal_occurrence_model')):
+                rup_arrays.append(sample_point_ruptures(
+                    src, samples * num_ses, srcfilter))
+            else:
+                for rup, grp_id, n_occ in src.sample_ruptures(
+                        samples * num_ses):
+                    ebr = EBRupture(rup, src.source_id, grp_id, n_occ)
+                    eb_ruptures.append(ebr)
             dt = time.time() - t0
             try:
                 n_sites = len(_sites)
             except (TypeError, ValueError):  # for None or a closed dataset
                 n_sites = 0
             calc_times[src.source_id] += numpy.array([nr, n_sites, dt])
-        rup_array = get_rup_array(eb_ruptures, srcfilter)
-        yield AccumDict(dict(rup_array=rup_array, calc_times=calc_times,
+        rup_arrays.append(get_rup_array(eb_ruptures, srcfilter))
+        yield AccumDict(dict(rup_array=concat_rup_arrays(rup_arrays),
+                             calc_times=calc_times,
                              eff_ruptures={trt: eff_ruptures}))
@@ -44,6 +44,11 @@ from openquake.hazardlib.geo.surface import PlanarSurface
 bymag = operator.attrgetter('mag')
 bydist = operator.attrgetter('dist')
 I16 = numpy.int16
+U32 = numpy.uint32
+F32 = numpy.float32
+F64 = numpy.float64
+# maximum number of elements in the (N, L, G) arrays of a batch of contexts
+MAX_BATCH_ELEMENTS = 2 ** 22
 tmp = 'rrup rx ry0 rjb rhypo repi rcdpp azimuth azimuth_cp rvolc '
 tmp += 'closest_point'
 KNOWN_DISTANCES = frozenset(tmp.split())
@@ -112,14 +117,13 @@ def make_pmap(ctxs, gsims, imtls, trunclevel, investigation_time):
     for imt, imls in imtls.items():
         if imt != 'MMI':
             loglevels[imt] = numpy.log(imls)
-    pmap = ProbabilityMap(len(loglevels.array), len(gsims))
+    pmap = ProbabilityMap.build(len(loglevels.array), len(gsims), ())
     for ctx in ctxs:
         mean_std = ctx.get_mean_std(imts, gsims)  # shape (2, N, M, G)
         poes = base.get_poes(mean_std, loglevels, trunclevel, gsims,
                              None, ctx.mag, None, ctx.rrup)  # (N, L, G)
         pnes = ctx.get_probability_no_exceedance(poes)
-        for sid, pne in zip(ctx.sids, pnes):
-            pmap.setdefault(sid, 1.).array *= pne
+        pmap.imul(ctx.sids, pnes)
     return ~pmap
 
 
@@ -184,7 +188,9 @@ class ContextMaker(object):
         self.maximum_distance = (
             param.get('maximum_distance') or MagDepDistance({}))
         self.trunclevel = param.get('truncation_level')
+        self.survival_function = param.get('survival_function', 'exact')
         self.effect = param.get('effect')
+        self.gsim_tables = param.get('gsim_tables', {}).get(trt)
         for req in self.REQUIRES:
             reqset = set()
             for gsim in gsims:
@@ -392,6 +398,108 @@ class ContextMaker(object):
             out.extend(_collapse(values))
         return out
 
+    def recarray(self, ctxs):
+        """
+        :param ctxs: a non-empty list of RuptureContexts
+        :returns:
+            a composite array with a record for each (rupture, site) pair,
+            containing the index of the rupture in ``ctxs``, the rupture
+            parameters, the distances and the site parameters
+        """
+        ctx0 = ctxs[0]
+        rparams = sorted(self.REQUIRES_RUPTURE_PARAMETERS)
+        dparams = sorted(self.REQUIRES_DISTANCES | {'rrup'})
+        sparams = sorted(self.REQUIRES_SITES_PARAMETERS)
+        dtlist = [('ridx', U32), ('sids', U32), ('occurrence_rate', F64)]
+        dtlist.extend((par, F64) for par in rparams)
+        for par in dparams + sparams:
+            arr = getattr(ctx0, par)
+            dtlist.append((par, arr.dtype, arr.shape[1:]))
+        nsites = numpy.array([len(ctx.sids) for ctx in ctxs])
+        rec = numpy.zeros(nsites.sum(), dtlist)
+        rec['ridx'] = numpy.repeat(numpy.arange(len(ctxs)), nsites)
+        for par in ['occurrence_rate'] + rparams:
+            rec[par] = numpy.repeat(
+                [getattr(ctx, par) for ctx in ctxs], nsites)
+        for par in ['sids'] + dparams + sparams:
+            rec[par] = numpy.concatenate([getattr(ctx, par) for ctx in ctxs])
+        return rec
+
+    def gen_batches(self, ctxs, max_elements=MAX_BATCH_ELEMENTS):
+        """
+        Group the contexts by magnitude, temporal occurrence model and
+        grp_ids and split them in batches small enough to keep the arrays
+        of shape (N, L, G) below ``max_elements`` elements.
+
+        :param ctxs: a list of parametric RuptureContexts
+        :yields: pairs (contexts, recarray)
+        """
+        L, G = len(self.loglevels.array), len(self.gsims)
+        maxrows = max(max_elements // (L * G), 1)
+
+        def key(ctx):
+            tom = ctx.temporal_occurrence_model
+            return (ctx.mag, tom.__class__.__name__, tom.time_span,
+                    tuple(ctx.grp_ids))
+        for ctxgroup in groupby(ctxs, key).values():
+            batch, nrows = [], 0
+            for ctx in ctxgroup:
+                if batch and nrows + len(ctx.sids) > maxrows:
+                    yield batch, self.recarray(batch)
+                    batch, nrows = [], 0
+                batch.append(ctx)
+                nrows += len(ctx.sids)
+            if batch:
+                yield batch, self.recarray(batch)
+
+    def get_mean_std(self, ctxs, rec):
+        """
+        Compute mean and standard deviation for a batch of contexts,
+        by calling :meth:`GroundShakingIntensityModel.get_mean_std` once
+        per GSIM. GSIMs needing the rupture geometry are called once
+        per rupture. If there are GSIM tables (see :class:`GsimTables`)
+        the means and stddevs for the point ruptures are interpolated.
+
+        :param ctxs: a list of RuptureContexts
+        :param rec: the corresponding composite array (see .recarray)
+        :returns: an array of shape (2, N, M, G) with means and stddevs
+        """
+        arr = numpy.zeros((2, len(rec), len(self.imts), len(self.gsims)))
+        bctx = RuptureContext((par, rec[par]) for par in rec.dtype.names)
+        byrup = None  # list of pairs (context, indices)
+        tab = self.gsim_tables
+        if tab is not None and tab.tables:
+            ok, idxs = tab.get_indices(ctxs, rec)
+            if not ok.any():
+                tab = None
+            elif not ok.all():  # context for the rows not in the tables
+                rest = rec[~ok]
+                rctx = RuptureContext(
+                    (par, rest[par]) for par in rest.dtype.names)
+        for g, gsim in enumerate(self.gsims):
+            if tab is not None and g in tab.tables:
+                out = arr[:, :, :, g]  # a view of shape (2, N, M)
+                out[:, ok] = tab.interp(g, idxs[:, ok])
+                if not ok.all():
+                    out[:, ~ok] = gsim.get_mean_std(rctx, self.imts)
+                continue
+            elif not gsim.uses_rupture_surface:
+                arr[:, :, :, g] = gsim.get_mean_std(bctx, self.imts)
+                continue
+            if byrup is None:
+                byrup = []
+                for r, idxs in _group_indices(rec['ridx']):
+                    ctx = RuptureContext()
+                    vars(ctx).update(vars(ctxs[r]))
+                    for par in rec.dtype.names:
+                        if par not in self.REQUIRES_RUPTURE_PARAMETERS:
+                            setattr(ctx, par, rec[par][idxs])
+                    byrup.append((ctx, idxs))
+            out = arr[:, :, :, g]  # a view of shape (2, N, M)
+            for ctx, idxs in byrup:
+                out[:, idxs] = ctx.get_mean_std(self.imts, [gsim])[:, :, :, 0]
+        return arr
+
     def max_intensity(self, sitecol1, mags, dists):
         """
         :param sitecol1: a SiteCollection instance with a single site
@@ -427,6 +535,214 @@ class ContextMaker(object):
         return gmv
 
 
+# rupture and distance parameters of the GSIMs which can be tabulated
+TABULATED_RUPTURE_PARAMETERS = frozenset(
+    'mag rake strike dip ztor hypo_depth width'.split())
+TABULATED_DISTANCES = frozenset('rrup rx ry0 rjb rhypo repi'.split())
+report_dt = numpy.dtype([('trt', hdf5.vstr), ('gsim', hdf5.vstr),
+                         ('imt', hdf5.vstr), ('ndists', U32),
+                         ('err_mean', F32), ('err_std', F32),
+                         ('err_poe', F32)])
+
+
+class GsimTables(object):
+    """
+    Tables of means and standard deviations for point ruptures, computed
+    on a grid (magnitude, distance) for each hypocentral depth and for
+    each distinct combination of site parameters (site class). For point
+    ruptures all distances are hypocentral distances and the rupture
+    parameters depend only on the magnitude and depth, so the GSIMs can
+    be replaced by a bilinear interpolation in (magnitude, log distance).
+    The distance grid is refined until the interpolation error on the
+    midpoints (on the logarithm of the mean and on the stddev) is below
+    the tolerance, otherwise the GSIM is not tabulated.
+
+    :param cmaker: a ContextMaker
+    :param sitecol: a (complete) SiteCollection
+    :param mags: the magnitudes of the ruptures of the TRT
+    :param depths: the hypocentral depths of the point ruptures of the TRT
+    :param tolerance: the maximum interpolation error
+    """
+    ndists = 64  # initial number of distances
+    max_ndists = 1024
+    max_rows = 1_000_000  # maximum number of rows computed in one go
+
+    def __init__(self, cmaker, sitecol, mags, depths, tolerance=.01):
+        self.trt = cmaker.trt
+        self.mags = numpy.array(sorted(set(mags)))
+        self.depths = numpy.array(sorted(set(depths)))
+        self.tolerance = tolerance
+        sparams = sorted(cmaker.REQUIRES_SITES_PARAMETERS)
+        if sparams:
+            self.classes, self.kidx = numpy.unique(
+                sitecol.complete.array[sparams], return_inverse=True)
+        else:
+            self.classes = numpy.zeros(1, [('sids', U32)])
+            self.kidx = numpy.zeros(len(sitecol.complete), U32)
+        dmin = max(self.depths.min(), 1.) if len(self.depths) else 1.
+        dmax = cmaker.maximum_distance(cmaker.trt) * 1.01
+        self.logdmin, self.logdmax = numpy.log(dmin), numpy.log(dmax)
+        self.logdists = {}  # gsim index -> log distances
+        self.tables = {}  # gsim index -> array (2, D, K, #mags, #dists, M)
+        self.report = []
+        nrows = len(self.classes) * len(self.mags) * self.ndists
+        if len(self.depths) == 0 or len(self.mags) == 0:
+            return
+        elif nrows > self.max_rows:
+            logging.warning('Not tabulating the GSIMs for %s: too many site '
+                            'classes (%d)', self.trt, len(self.classes))
+            return
+        for g, gsim in enumerate(cmaker.gsims):
+            if (gsim.uses_rupture_surface or
+                    set(gsim.REQUIRES_RUPTURE_PARAMETERS) -
+                    TABULATED_RUPTURE_PARAMETERS or
+                    set(gsim.REQUIRES_DISTANCES) - TABULATED_DISTANCES):
+                self._add_report(gsim, cmaker.imts, 0)
+                continue
+            try:
+                self._build(cmaker, g)
+            except ValueError as exc:  # magnitude outside of supported range
+                logging.warning('Not tabulating %s: %s', gsim, exc)
+                self._add_report(gsim, cmaker.imts, 0)
+
+    def _add_report(self, gsim, imts, ndists, errs=None):
+        for m, imt in enumerate(imts):
+            err = (0, 0, 0) if errs is None else errs[m]
+            self.report.append((self.trt, str(gsim), str(imt), ndists) + err)
+
+    def _compute(self, cmaker, g, logdists):
+        # returns an array of shape (2, D, K, #mags, #dists, M)
+        from openquake.hazardlib.source.rupture import PointRupture
+        from openquake.hazardlib.geo.point import Point
+        gsim = cmaker.gsims[g]
+        K, MG, DG, M = (len(self.classes), len(self.mags), len(logdists),
+                        len(cmaker.imts))
+        kk, mm, dd = [idx.flatten() for idx in numpy.meshgrid(
+            numpy.arange(K), numpy.arange(MG), numpy.arange(DG),
+            indexing='ij')]
+        dists = numpy.exp(logdists)[dd]
+        out = numpy.zeros((2, len(self.depths), K, MG, DG, M))
+        for d, depth in enumerate(self.depths):
+            rup = PointRupture(self.mags[0], self.trt, Point(0, 0, depth),
+                               1., None)
+            ctx = cmaker.make_rctx(rup)
+            ctx.mag = self.mags[mm]
+            for par in cmaker.REQUIRES_RUPTURE_PARAMETERS - {'mag'}:
+                setattr(ctx, par, numpy.repeat(getattr(ctx, par), len(mm)))
+            for dst in cmaker.REQUIRES_DISTANCES | {'rrup'}:
+                setattr(ctx, dst, dists)
+            for par in cmaker.REQUIRES_SITES_PARAMETERS:
+                setattr(ctx, par, self.classes[par][kk])
+            ctx.sids = numpy.zeros(len(kk), U32)
+            out[:, d] = gsim.get_mean_std(ctx, cmaker.imts).reshape(
+                2, K, MG, DG, M)
+        return out
+
+    def _build(self, cmaker, g):
+        # build the table for the GSIM with index g, refining the distances
+        ndists = self.ndists
+        M = len(cmaker.imts)
+        while True:
+            logdists = numpy.linspace(self.logdmin, self.logdmax, ndists)
+            table = self._compute(cmaker, g, logdists)
+            exact = self._compute(cmaker, g, (logdists[1:] + logdists[:-1]) / 2)
+            approx = (table[..., 1:, :] + table[..., :-1, :]) / 2
+            diff = numpy.abs(exact - approx).reshape(2, -1, M)
+            err_mean, err_std = diff.max(axis=1)
+            ok = max(err_mean.max(), err_std.max()) <= self.tolerance
+            if ok or ndists >= self.max_ndists:
+                break
+            ndists *= 2
+        # compare the PoEs of the exact and interpolated midpoints
+        ex = exact.reshape(2, -1, M)[:, :, :, None]
+        ap = approx.reshape(2, -1, M)[:, :, :, None]
+        poes = [base.get_poes(ms, cmaker.loglevels, cmaker.trunclevel,
+                              [cmaker.gsims[g]])[:, :, 0] for ms in (ex, ap)]
+        dpoe = numpy.abs(poes[0] - poes[1]).max(axis=0)  # shape L
+        errs = [(err_mean[m], err_std[m], dpoe[cmaker.loglevels(imt)].max())
+                for m, imt in enumerate(cmaker.loglevels)]
+        if ok:
+            self.logdists[g] = logdists
+            self.tables[g] = table
+            self._add_report(cmaker.gsims[g], cmaker.imts, ndists, errs)
+        else:
+            logging.warning('Not tabulating %s: interpolation error %.3f > '
+                            '%s', cmaker.gsims[g],
+                            max(err_mean.max(), err_std.max()),
+                            self.tolerance)
+            self._add_report(cmaker.gsims[g], cmaker.imts, 0, errs)
+
+    def get_indices(self, ctxs, rec):
+        """
+        :param ctxs: a list of RuptureContexts
+        :param rec: the corresponding composite array (see .recarray)
+        :returns:
+            a boolean mask of the rows coming from point ruptures within
+            the tables and an array of shape (4, N) with the depth index,
+            the site class index, the magnitudes and the log distances
+        """
+        ispoint = numpy.array([not getattr(ctx, 'surface', True)
+                               for ctx in ctxs])[rec['ridx']]
+        depth = numpy.array([ctx.hypocenter.depth if not
+                             getattr(ctx, 'surface', True) else numpy.nan
+                             for ctx in ctxs])[rec['ridx']]
+        mag = numpy.array([ctx.mag for ctx in ctxs])[rec['ridx']]
+        didx = numpy.searchsorted(self.depths, depth).clip(
+            0, len(self.depths) - 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            logdist = numpy.log(rec['rrup'])
+        ok = (ispoint & numpy.isclose(self.depths[didx], depth) &
+              (mag >= self.mags[0] - 1E-6) & (mag <= self.mags[-1] + 1E-6) &
+              (logdist >= self.logdmin) & (logdist <= self.logdmax))
+        return ok, numpy.array([didx, self.kidx[rec['sids']], mag, logdist])
+
+    def interp(self, g, idxs):
+        """
+        :param g: the index of a tabulated GSIM
+        :param idxs: an array of shape (4, N) returned by .get_indices
+        :returns: an array of shape (2, N, M) with means and stddevs
+        """
+        table = self.tables[g]
+        d, k = idxs[0].astype(int), idxs[1].astype(int)
+        i, wm = _weights(self.mags, idxs[2])
+        j, wd = _weights(self.logdists[g], idxs[3])
+        i1 = numpy.minimum(i + 1, len(self.mags) - 1)
+        out = (table[:, d, k, i, j] * ((1. - wm) * (1. - wd))[:, None] +
+               table[:, d, k, i, j + 1] * ((1. - wm) * wd)[:, None] +
+               table[:, d, k, i1, j] * (wm * (1. - wd))[:, None] +
+               table[:, d, k, i1, j + 1] * (wm * wd)[:, None])
+        return out
+
+
+def _weights(grid, values):
+    # returns the left indices and the weights for a linear interpolation
+    if len(grid) == 1:
+        return numpy.zeros(len(values), int), numpy.zeros(len(values))
+    idx = (numpy.searchsorted(grid, values) - 1).clip(0, len(grid) - 2)
+    w = (values - grid[idx]) / (grid[idx + 1] - grid[idx])
+    return idx, w.clip(0., 1.)
+
+
+def _group_indices(ridx):
+    # returns a list of pairs (rupture index, row indices)
+    order = ridx.argsort(kind='stable')
+    counts = numpy.bincount(ridx)
+    out = []
+    for idxs in numpy.split(order, numpy.cumsum(counts)[:-1]):
+        if len(idxs):
+            out.append((ridx[idxs[0]], idxs))
+    return out
+
+
+def _multiply_by_sid(sids, pnes):
+    # returns the unique site IDs and the product of the pnes for each site
+    order = sids.argsort(kind='stable')
+    ssids = sids[order]
+    usids, start = numpy.unique(ssids, return_index=True)
+    return usids, numpy.multiply.reduceat(pnes[order], start, axis=0)
+
+
 # see contexts_tests.py for examples of collapse
 def combine_pmf(o1, o2):
     """
@@ -503,11 +819,51 @@ class PmapMaker(object):
         self.poe_mon = cmaker.mon('get_poes', measuremem=False)
         self.pne_mon = cmaker.mon('composing pnes', measuremem=False)
         self.gmf_mon = cmaker.mon('computing mean_std', measuremem=False)
+        self.buf = base.Buffer()  # memory reused across calls to get_poes
 
     def _update_pmap(self, ctxs, pmap=None):
         # compute PoEs and update pmap
         if pmap is None:  # for src_indep
             pmap = self.pmap
+        if self.rup_indep and not self.af:
+            # parametric ruptures are managed in batches
+            nonparam = [ctx for ctx in ctxs
+                        if numpy.isnan(ctx.occurrence_rate)]
+            param = [ctx for ctx in ctxs
+                     if not numpy.isnan(ctx.occurrence_rate)]
+            for batch, rec in self.cmaker.gen_batches(param):
+                self._update_pmap_by_batch(batch, rec, pmap)
+            ctxs = nonparam
+        self._update_pmap_by_ctx(ctxs, pmap)
+
+    def _zero_poes(self, poes):
+        # set to zero the PoEs of the GSIMs with zero weight
+        ll = self.loglevels
+        for g, gsim in enumerate(self.gsims):
+            for m, imt in enumerate(ll):
+                if hasattr(gsim, 'weight') and gsim.weight[imt] == 0:
+                    # set by the engine when parsing the gsim logictree
+                    # when 0 ignore the gsim: see _build_trts_branches
+                    poes[:, ll(imt), g] = 0
+
+    def _update_pmap_by_batch(self, ctxs, rec, pmap):
+        # a single vectorized call for all the contexts in the batch
+        with self.gmf_mon:
+            mean_std = self.cmaker.get_mean_std(ctxs, rec)  # (2, N, M, G)
+        with self.poe_mon:
+            poes = base.get_poes(mean_std, self.loglevels, self.trunclevel,
+                                 self.gsims, buf=self.buf,
+                                 sf=self.survival_function)
+            self._zero_poes(poes)
+        with self.pne_mon:
+            tom = ctxs[0].temporal_occurrence_model
+            pnes = tom.get_probability_no_exceedance(
+                rec['occurrence_rate'][:, None, None], poes)
+            sids, pnes = _multiply_by_sid(rec['sids'], pnes)
+            for grp_id in ctxs[0].grp_ids:
+                pmap[grp_id].imul(sids, pnes)
+
+    def _update_pmap_by_ctx(self, ctxs, pmap):
         rup_indep = self.rup_indep
         for ctx in ctxs:
             # this must be fast since it is inside an inner loop
@@ -522,24 +878,21 @@ class PmapMaker(object):
                 else:
                     sitecode = None
                 poes = base.get_poes(mean_std, ll, self.trunclevel, self.gsims,
-                                     af, ctx.mag, sitecode, ctx.rrup)
-                for g, gsim in enumerate(self.gsims):
-                    for m, imt in enumerate(ll):
-                        if hasattr(gsim, 'weight') and gsim.weight[imt] == 0:
-                            # set by the engine when parsing the gsim logictree
-                            # when 0 ignore the gsim: see _build_trts_branches
-                            poes[:, ll(imt), g] = 0
+                                     af, ctx.mag, sitecode, ctx.rrup,
+                                     self.buf, self.survival_function)
+                self._zero_poes(poes)
 
             with self.pne_mon:
                 # pnes and poes of shape (N, L, G)
                 pnes = ctx.get_probability_no_exceedance(poes)
+                if rup_indep:
+                    for grp_id in ctx.grp_ids:
+                        pmap[grp_id].imul(ctx.sids, pnes)
+                    continue
                 for sid, pne in zip(ctx.sids, pnes):
                     for grp_id in ctx.grp_ids:
-                        probs = pmap[grp_id].setdefault(sid, rup_indep).array
-                        if rup_indep:
-                            probs *= pne
-                        else:  # rup_mutex
-                            probs += (1. - pne) * ctx.weight
+                        probs = pmap[grp_id].setdefault(sid, 0.).array
+                        probs += (1. - pne) * ctx.weight  # rup_mutex
 
     def _ruptures(self, src, filtermag=None):
         with self.cmaker.mon('iter_ruptures', measuremem=False):
@@ -592,7 +945,8 @@ class PmapMaker(object):
             rups = self._ruptures(src)
             gidx = getattr(src, 'gidx', 0)
             L, G = len(self.cmaker.imtls.array), len(self.cmaker.gsims)
-            pmap = {grp_id: ProbabilityMap(L, G) for grp_id in src.grp_ids}
+            pmap = {grp_id: ProbabilityMap.build(L, G, ())
+                    for grp_id in src.grp_ids}
             ctxs = self._make_ctxs(rups, sites, gidx, numpy.array(src.grp_ids))
             self._update_pmap(ctxs, pmap)
             for grp_id in src.grp_ids:
@@ -617,7 +971,8 @@ class PmapMaker(object):
         self.rupdata = []
         imtls = self.cmaker.imtls
         L, G = len(imtls.array), len(self.gsims)
-        self.pmap = AccumDict(accum=ProbabilityMap(L, G))  # grp_id -> pmap
+        # grp_id -> dense pmap, updated in bulk for each batch of contexts
+        self.pmap = AccumDict(accum=ProbabilityMap.build(L, G, ()))
         # AccumDict of arrays with 3 elements nrups, nsites, calc_time
         self.calc_times = AccumDict(accum=numpy.zeros(3, numpy.float32))
         self.totrups = 0
@@ -674,7 +1029,8 @@ class PmapMaker(object):
                 # pointsource_distance from the rupture (if any)
                 for pr in src.point_ruptures():
                     pdist = self.pointsource_distance['%.2f' % pr.mag]
-                    close, far = sites.split(pr.hypocenter, pdist)
+                    close, far = self.srcfilter.split(
+                        sites, pr.hypocenter, pdist)
                     if self.fewsites:
                         if close is None:  # all is far, common for small mag
                             _add([pr], sites)
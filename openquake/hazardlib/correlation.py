@@ -19,6 +19,41 @@ spatially-distributed ground-shaking intensities.
 """
 import abc
 import numpy
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from scipy.spatial import cKDTree
+from openquake.hazardlib.geo import geodetic
+
+MAX_CACHED = 16  # maximum number of factors kept in memory
+
+
+def wendland(h):
+    """
+    Wendland taper :math:`(1-h)^4 (1+4h)`, positive definite in 3D and
+    vanishing for h >= 1
+
+    :param h: an array of distances divided by the taper distance
+    """
+    h = numpy.minimum(h, 1.)
+    return (1. - h) ** 4 * (1. + 4. * h)
+
+
+def sparse_cholesky(corma):
+    """
+    Sparse Cholesky decomposition of a symmetric positive definite matrix,
+    obtained from the LU factorization with a symmetric fill-reducing
+    permutation and no pivoting.
+
+    :param corma: a sparse matrix of shape (N, N)
+    :returns: a sparse lower triangular matrix L and a permutation p such
+              that (L @ residuals)[p] has covariance `corma`
+    """
+    lu = splu(corma.tocsc(), permc_spec='MMD_AT_PLUS_A',
+              diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+    diag = lu.U.diagonal()
+    if (lu.perm_r != lu.perm_c).any() or (diag <= 0).any():
+        raise ValueError('The correlation matrix is not positive definite')
+    return (lu.L @ sparse.diags(numpy.sqrt(diag))).tocsr(), lu.perm_c
 
 
 class BaseCorrelationModel(metaclass=abc.ABCMeta):
@@ -26,6 +61,8 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
     Base class for correlation models for spatially-distributed ground-shaking
     intensities.
     """
+    taper_distance = None  # set by the subclasses
+
     def apply_correlation(self, sites, imt, residuals, stddev_intra=0):
         """
         Apply correlation to randomly sampled residuals.
@@ -49,7 +86,12 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
         NB: the correlation matrix is cached. It is computed only once
         per IMT for the complete site collection and then the portion
         corresponding to the sites is multiplied by the residuals.
+        If a `taper_distance` is set, a sparse factor is computed and
+        cached for each IMT and subset of sites instead.
         """
+        if self.taper_distance:
+            low, perm = self.get_sparse_factor(sites, imt)
+            return (low @ residuals)[perm]
         # intra-event residual for a single relization is a product
         # of lower-triangle decomposed correlation matrix and vector
         # of N random numbers (where N is equal to number of sites).
@@ -73,6 +115,51 @@ class BaseCorrelationModel(metaclass=abc.ABCMeta):
         else:  # complete site collection
             return corma @ residuals  # shape (N, s)
 
+    def get_tapered_correlation_matrix(self, sites, imt):
+        """
+        :param sites:
+            :class:`~openquake.hazardlib.site.SiteCollection` to create
+            correlation matrix for.
+        :param imt:
+            Intensity measure type object, see :mod:`openquake.hazardlib.imt`.
+        :returns:
+            the correlation matrix multiplied by a Wendland taper vanishing
+            at `taper_distance`, as a sparse matrix in CSC format; only the
+            pairs of sites closer than `taper_distance` are considered
+        """
+        N = len(sites)
+        # the chord distance is smaller than the geodetic distance
+        i, j = cKDTree(sites.xyz).query_pairs(
+            self.taper_distance, output_type='ndarray').T
+        dist = geodetic.geodetic_distance(
+            sites.lons[i], sites.lats[i], sites.lons[j], sites.lats[j])
+        corr = self._get_correlation_matrix(dist, imt) * wendland(
+            dist / self.taper_distance)
+        ok = corr > 0
+        i, j, corr = i[ok], j[ok], corr[ok]
+        diag = numpy.arange(N)
+        return sparse.csc_matrix(
+            (numpy.concatenate([corr, corr, numpy.ones(N)]),
+             (numpy.concatenate([i, j, diag]),
+              numpy.concatenate([j, i, diag]))), shape=(N, N))
+
+    def get_sparse_factor(self, sites, imt):
+        """
+        :returns:
+            the sparse Cholesky factor of the tapered correlation matrix
+            and the associated permutation, cached per IMT and sites
+        """
+        key = imt, sites.sids.tobytes()
+        try:
+            return self.cache[key]
+        except KeyError:
+            if len(self.cache) >= MAX_CACHED:
+                self.cache.clear()
+            factor = sparse_cholesky(
+                self.get_tapered_correlation_matrix(sites, imt))
+            self.cache[key] = factor
+            return factor
+
 
 class JB2009CorrelationModel(BaseCorrelationModel):
     """
@@ -84,9 +171,14 @@ class JB2009CorrelationModel(BaseCorrelationModel):
         Boolean value to indicate whether "Case 1" or "Case 2" from page 1700
         should be applied. ``True`` value means that Vs 30 values show or are
         expected to show clustering ("Case 2"), ``False`` means otherwise.
+    :param taper_distance:
+        If given, distance in km beyond which the correlation is set to zero
+        by a Wendland taper, so that a sparse Cholesky factorization can be
+        used for large site collections.
     """
-    def __init__(self, vs30_clustering):
+    def __init__(self, vs30_clustering, taper_distance=None):
         self.vs30_clustering = vs30_clustering
+        self.taper_distance = taper_distance
         self.cache = {}  # imt -> correlation model
 
     def _get_correlation_matrix(self, sites, imt):
@@ -159,11 +251,20 @@ class HM2018CorrelationModel(BaseCorrelationModel):
         Value to be multiplied by the uncertainty in the correlation parameter
         beta. If uncertainty_multiplier = 0 (default), the median value is
         used as a constant value.
+    :param taper_distance:
+        If given, distance in km beyond which the correlation is set to zero
+        by a Wendland taper, so that a sparse Cholesky factorization can be
+        used for large site collections.
     """
-    def __init__(self, uncertainty_multiplier=0):
+    def __init__(self, uncertainty_multiplier=0, taper_distance=None):
+        if taper_distance and uncertainty_multiplier:
+            raise ValueError('taper_distance cannot be used together with '
+                             'uncertainty_multiplier=%s' %
+                             uncertainty_multiplier)
         self.uncertainty_multiplier = uncertainty_multiplier
+        self.taper_distance = taper_distance
         self.distance_matrix = {}
-        self.cache = {}
+        self.cache = {}  # (imt, sids) -> correlation model
 
     def _get_correlation_matrix(self, sites, imt):
         return hmcorrelation(sites, imt, self.uncertainty_multiplier)
@@ -190,23 +291,32 @@ class HM2018CorrelationModel(BaseCorrelationModel):
             # normalized, sampled from a standard normal distribution.
             # For this, every row of 'residuals' (every site) is divided by its
             # corresponding standard deviation element.
-            residuals_norm = residuals / stddev_intra[sites.sids, None]
-
-            # Lower diagonal of the Cholesky decomposition from/to cache
+            stddev = stddev_intra[sites.sids, None]
+            residuals_norm = residuals / stddev
+            if self.taper_distance:
+                low, perm = self.get_sparse_factor(sites, imt)
+                return stddev * (low @ residuals_norm)[perm]
+
+            # Lower diagonal of the Cholesky decomposition from/to cache;
+            # the covariance diag(s) @ C @ diag(s) has lower triangular
+            # factor diag(s) @ L, so only L is cached, per IMT and sites
+            key = imt, sites.sids.tobytes()
             try:
-                cormaLow = self.cache[imt]
+                cormaLow = self.cache[key]
             except KeyError:
+                # the filtered sites change with the rupture, so the
+                # cache is bounded as in get_sparse_factor
+                if len(self.cache) >= MAX_CACHED:
+                    self.cache.clear()
                 # Note that instead of computing the whole correlation matrix
                 # corresponding to sites.complete, here we compute only the
                 # correlation matrix corresponding to sites.
                 cormaLow = numpy.linalg.cholesky(
-                       numpy.diag(stddev_intra[sites.sids]) @
-                       self._get_correlation_matrix(sites, imt) @
-                       numpy.diag(stddev_intra[sites.sids]))
-                self.cache[imt] = cormaLow
+                    self._get_correlation_matrix(sites, imt))
+                self.cache[key] = cormaLow
 
             # Apply correlation
-            return numpy.dot(cormaLow, residuals_norm)
+            return stddev * (cormaLow @ residuals_norm)
 
         else:   # Variability (uncertainty) is included
             nsim = len(residuals[1])
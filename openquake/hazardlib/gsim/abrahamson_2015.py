@@ -86,6 +86,9 @@ class AbrahamsonEtAl2015SInter(GMPE):
     #: interface events
     REQUIRES_DISTANCES = {'rrup'}
 
+    #: The rupture parameters can be arrays, see :meth:`get_mean_std`
+    vectorized = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.ergodic = kwargs.get('ergodic', True)
@@ -141,13 +144,9 @@ class AbrahamsonEtAl2015SInter(GMPE):
         """
         base = C['theta1'] + (self.CONSTS['theta4'] * dc1)
         dmag = self.CONSTS["C1"] + dc1
-        if mag > dmag:
-            f_mag = (self.CONSTS['theta5'] * (mag - dmag)) +\
-                C['theta13'] * ((10. - mag) ** 2.)
-
-        else:
-            f_mag = (self.CONSTS['theta4'] * (mag - dmag)) +\
-                C['theta13'] * ((10. - mag) ** 2.)
+        f_mag = np.where(mag > dmag, self.CONSTS['theta5'],
+                         self.CONSTS['theta4']) * (mag - dmag) +\
+            C['theta13'] * ((10. - mag) ** 2.)
 
         return base + f_mag
 
@@ -346,10 +345,7 @@ class AbrahamsonEtAl2015SSlab(AbrahamsonEtAl2015SInter):
         Computes the hypocentral depth scaling term - as indicated by
         equation (3)
         """
-        if rup.hypo_depth > 120.0:
-            z_h = 120.0
-        else:
-            z_h = rup.hypo_depth
+        z_h = np.minimum(rup.hypo_depth, 120.0)
         return C['theta11'] * (z_h - 60.)
 
     def _compute_distance_term(self, C, mag, dists):
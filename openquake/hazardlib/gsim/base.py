@@ -22,6 +22,7 @@ different kinds of :class:`ground shaking intensity models
 <GroundShakingIntensityModel>`.
 """
 import abc
+import copy
 import math
 import warnings
 import functools
@@ -47,6 +48,10 @@ ADMITTED_SET_PARAMETERS = ['DEFINED_FOR_INTENSITY_MEASURE_TYPES',
                            'REQUIRES_SITES_PARAMETERS',
                            'REQUIRES_RUPTURE_PARAMETERS']
 
+F64 = numpy.float64
+INT = numpy.intp
+# number of intervals used in the tabulated survival functions
+SF_STEPS = 10000
 registry = {}  # GSIM name -> GSIM class
 gsim_aliases = {}  # populated for instance in nbcc2015_AA13.py
 
@@ -84,8 +89,32 @@ def gsim_imt_dt(sorted_gsims, sorted_imts):
     return numpy.dtype([(str(gsim), imt_dt) for gsim in sorted_gsims])
 
 
+class Buffer(object):
+    """
+    Reusable memory, useful to avoid allocations in tight loops. Calling
+    the buffer with a name, a shape and a dtype returns an array built on
+    top of the memory associated to the name, which grows when needed.
+    NB: the content of the returned array is undefined.
+
+    >>> buf = Buffer()
+    >>> buf('poes', (2, 3)).shape
+    (2, 3)
+    >>> buf('poes', (3,)).base is buf.mem['poes']
+    True
+    """
+    def __init__(self):
+        self.mem = {}  # name -> 1D array
+
+    def __call__(self, name, shape, dtype=F64):
+        size = int(numpy.prod(shape))
+        arr = self.mem.get(name)
+        if arr is None or len(arr) < size or arr.dtype != dtype:
+            arr = self.mem[name] = numpy.empty(size, dtype)
+        return arr[:size].reshape(shape)
+
+
 def get_poes(mean_std, loglevels, truncation_level, gsims=(), af=None,
-             mag=None, sitecode=None, rrup=None):
+             mag=None, sitecode=None, rrup=None, buf=None, sf='exact'):
     """
     Calculate and return probabilities of exceedance (PoEs) of one or more
     intensity measure levels (IMLs) of one intensity measure type (IMT)
@@ -115,6 +144,11 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=(), af=None,
         value and is defined in units of sigmas. The resulting PoEs
         for that mode are values of complementary cumulative distribution
         function of that truncated Gaussian applied to IMLs.
+    :param buf:
+        If not None, a :class:`Buffer` instance; in the regular case the
+        PoEs are stored in its memory, which is reused across calls
+    :param sf:
+        The survival function to use, 'exact' or 'tabulated'
 
     :returns:
         array of PoEs of shape (N, L, G)
@@ -143,11 +177,11 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=(), af=None,
                     ms = numpy.array(mean_std[:, :, :, g])  # make a copy
                     for m in range(len(loglevels)):
                         ms[0, :, m] += s * gsim.adjustment
-                    outs.append(_get_poes(ms, loglevels, tl, squeeze=1))
+                    outs.append(_get_poes(ms, loglevels, tl, squeeze=1, sf=sf))
                 arr[:, :, g] = numpy.average(outs, weights=weights, axis=0)
             else:
                 ms = mean_std[:, :, :, g]
-                arr[:, :, g] = _get_poes(ms, loglevels, tl, squeeze=1)
+                arr[:, :, g] = _get_poes(ms, loglevels, tl, squeeze=1, sf=sf)
         return arr
     elif any("mixture_model" in gsim.kwargs for gsim in gsims):
         shp = list(mean_std[0].shape)  # (N, M, G)
@@ -161,10 +195,10 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=(), af=None,
                     mean_stdi = numpy.array(mean_std[:, :, :, g])  # a copy
                     mean_stdi[1] *= fact
                     arr[:, :, g] += (wgt * _get_poes(mean_stdi, loglevels, tl,
-                                                     squeeze=1))
+                                                     squeeze=1, sf=sf))
             else:
                 ms = mean_std[:, :, :, g]
-                arr[:, :, g] = _get_poes(ms, loglevels, tl, squeeze=1)
+                arr[:, :, g] = _get_poes(ms, loglevels, tl, squeeze=1, sf=sf)
         return arr
     elif af:
         # kernel amplification function
@@ -173,27 +207,34 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=(), af=None,
         return res
     else:
         # regular case
-        return _get_poes(mean_std, loglevels, truncation_level)
+        return _get_poes(mean_std, loglevels, truncation_level,
+                         buf=buf, sf=sf)
 
 
 # this is the critical function for the performance of the classical calculator
-# it is dominated by memory allocations (i.e. _truncnorm_sf is ultra-fast)
-# the only way to speedup is to reduce the maximum_distance, then the array
-# will become shorter in the N dimension (number of affected sites), or to
-# collapse the ruptures, then _get_poes will be called less times
-def _get_poes(mean_std, loglevels, truncation_level, squeeze=False):
+# it is dominated by memory allocations, therefore the PoEs are computed in
+# place, one IMT at the time, on the memory of the buffer, if any;
+# the only way to speedup further is to reduce the maximum_distance, then the
+# array will become shorter in the N dimension (number of affected sites), or
+# to collapse the ruptures, then _get_poes will be called less times
+def _get_poes(mean_std, loglevels, truncation_level, squeeze=False,
+              buf=None, sf='exact'):
     mean, stddev = mean_std  # shape (N, M, G) each
     N, L, G = len(mean), len(loglevels.array), mean.shape[-1]
-    out = numpy.zeros((N, L) if squeeze else (N, L, G))
-    lvl = 0
+    shp = (N, L) if squeeze else (N, L, G)
+    out = numpy.empty(shp) if buf is None else buf('poes', shp)
     for m, imt in enumerate(loglevels):
-        for iml in loglevels[imt]:
-            if truncation_level == 0:  # just compare imls to mean
-                out[:, lvl] = iml <= mean[:, m]
-            else:
-                out[:, lvl] = (iml - mean[:, m]) / stddev[:, m]
-            lvl += 1
-    return _truncnorm_sf(truncation_level, out)
+        # broadcast the levels of the IMT against the means and stddevs
+        imls = loglevels[imt].reshape((-1,) + (1,) * (out.ndim - 2))
+        arr = out[:, loglevels(imt)]  # a view
+        if truncation_level == 0:  # just compare imls to mean
+            numpy.less_equal(imls, mean[:, m, None], out=arr)
+        else:
+            numpy.subtract(imls, mean[:, m, None], out=arr)
+            arr /= stddev[:, m, None]
+    if sf == 'tabulated' and truncation_level != 0:
+        return _tabulated_sf(truncation_level, out, buf)
+    return _truncnorm_sf(truncation_level, out, out)
 
 
 def _get_poes_site(mean_std, loglevels, truncation_level, ampfun,
@@ -416,6 +457,14 @@ class GroundShakingIntensityModel(metaclass=MetaGSIM):
     non_verified = False
     experimental = False
     adapted = False
+    # if True the GSIM uses the geometry of the rupture and not only the
+    # rupture parameters; then ruptures with the same parameters cannot be
+    # evaluated together (see ContextMaker.get_mean_std)
+    uses_rupture_surface = False
+    # if True get_mean_and_stddevs accepts arrays of rupture parameters,
+    # one value per rupture-site pair, and get_mean_std calls it only once
+    # per IMT for the whole batch
+    vectorized = False
     get_poes = staticmethod(get_poes)
 
     @classmethod
@@ -504,6 +553,37 @@ class GroundShakingIntensityModel(metaclass=MetaGSIM):
         compute interim steps).
         """
 
+    def get_mean_std(self, ctx, imts):
+        """
+        Compute mean and total standard deviation for a batch of
+        rupture-site pairs, for all the given IMTs at once. If the GSIM
+        is not vectorized the batch is split in groups of pairs with the
+        same rupture parameters (rounded to 5 digits) and
+        :meth:`get_mean_and_stddevs` is called once per group and IMT.
+
+        :param ctx:
+            a :class:`openquake.hazardlib.contexts.RuptureContext` with
+            arrays of N elements for the site parameters, the distances
+            and (possibly) the rupture parameters
+        :param imts:
+            a list of M intensity measure types
+        :returns:
+            an array of shape (2, N, M) with means and stddevs
+        """
+        arr = numpy.zeros((2, len(ctx.sids), len(imts)))
+        if self.vectorized:
+            groups = [(slice(None), ctx)]
+        else:
+            groups = _split_by_params(ctx, self.REQUIRES_RUPTURE_PARAMETERS)
+        for idxs, sub in groups:
+            new = sub.roundup(self.minimum_distance)
+            for m, imt in enumerate(imts):
+                mean, [std] = self.get_mean_and_stddevs(
+                    sub, sub, new, imt, [const.StdDev.TOTAL])
+                arr[0, idxs, m] = mean
+                arr[1, idxs, m] = std
+        return arr
+
     def _check_imt(self, imt):
         """
         Make sure that ``imt`` is valid and is supported by this GSIM.
@@ -542,7 +622,36 @@ class GroundShakingIntensityModel(metaclass=MetaGSIM):
         return '[%s]' % self.__class__.__name__
 
 
-def _truncnorm_sf(truncation_level, values):
+def _split_by_params(ctx, params):
+    # yield pairs (indices, context) for each group of rupture-site pairs
+    # with the same rupture parameters; in the contexts the rupture
+    # parameters are scalars, the other arrays are restricted to the group
+    N = len(ctx.sids)
+    params = sorted(par for par in params if numpy.ndim(getattr(ctx, par)))
+    if not params:
+        yield slice(None), ctx
+        return
+    ridx = getattr(ctx, 'ridx', None)
+    if ridx is None:  # consider each row as a different rupture
+        ridx = numpy.arange(N)
+    # the parameters are the same for all the rows of a rupture
+    _, first, rinv = numpy.unique(ridx, return_index=True, return_inverse=True)
+    values = numpy.array([getattr(ctx, par)[first] for par in params]).T
+    _, inv = numpy.unique(numpy.round(values, 5), axis=0, return_inverse=True)
+    inv = inv.reshape(-1)[rinv.reshape(-1)]
+    order = inv.argsort(kind='stable')
+    arrays = [par for par, val in vars(ctx).items()
+              if isinstance(val, numpy.ndarray) and val.ndim and len(val) == N]
+    for idxs in numpy.split(order, numpy.cumsum(numpy.bincount(inv))[:-1]):
+        sub = copy.copy(ctx)
+        for par in arrays:
+            setattr(sub, par, getattr(ctx, par)[idxs])
+        for par in params:
+            setattr(sub, par, getattr(ctx, par)[idxs[0]])
+        yield idxs, sub
+
+
+def _truncnorm_sf(truncation_level, values, out=None):
     """
     Survival function for truncated normal distribution.
 
@@ -555,6 +664,9 @@ def _truncnorm_sf(truncation_level, values):
     :param values:
         Numpy array of values as input to a survival function for the given
         distribution.
+    :param out:
+        If given, an array of the same shape of ``values`` where to store
+        the result (it can be ``values`` itself)
     :returns:
         Numpy array of survival function results in a range between 0 and 1.
 
@@ -569,7 +681,9 @@ def _truncnorm_sf(truncation_level, values):
         return values
 
     if truncation_level is None:
-        return ndtr(- values)
+        if out is None:
+            return ndtr(- values)
+        return ndtr(numpy.negative(values, out=out), out=out)
 
     # notation from http://en.wikipedia.org/wiki/Truncated_normal_distribution.
     # given that mu = 0 and sigma = 1, we have alpha = a and beta = b.
@@ -595,7 +709,49 @@ def _truncnorm_sf(truncation_level, values):
     # ``SF(x) = (Z - CDF(x) + CDF(a)) / Z``,
     # ``SF(x) = (CDF(b) - CDF(a) - CDF(x) + CDF(a)) / Z``,
     # ``SF(x) = (CDF(b) - CDF(x)) / Z``.
-    return ((phi_b - ndtr(values)) / z).clip(0.0, 1.0)
+    if out is None:
+        return ((phi_b - ndtr(values)) / z).clip(0.0, 1.0)
+    ndtr(values, out=out)
+    numpy.subtract(phi_b, out, out=out)
+    out /= z
+    return numpy.clip(out, 0.0, 1.0, out=out)
+
+
+@functools.lru_cache()
+def _sf_table(truncation_level):
+    # returns the maximum abscissa, the values and the increments of the
+    # survival function on SF_STEPS intervals of the range [-xmax, xmax];
+    # outside the range the function is constant (up to 1E-15 if untruncated)
+    xmax = truncation_level or 8.
+    xs = numpy.linspace(-xmax, xmax, SF_STEPS + 1)
+    ys = _truncnorm_sf(truncation_level, xs)
+    return xmax, ys, numpy.append(numpy.diff(ys), 0.)
+
+
+def _tabulated_sf(truncation_level, values, buf=None):
+    """
+    Faster version of :func:`_truncnorm_sf`, interpolating linearly a
+    tabulated survival function, with an error below 1E-7. The values
+    are overwritten with the result.
+
+    :param truncation_level: positive float or None (not zero)
+    :param values: a numpy array of floats
+    :param buf: if not None, a :class:`Buffer` instance
+    :returns: the values array
+    """
+    xmax, ys, dys = _sf_table(truncation_level)
+    shp = values.shape
+    idx = numpy.empty(shp, INT) if buf is None else buf('sf_idx', shp, INT)
+    tmp = numpy.empty(shp) if buf is None else buf('sf_tmp', shp)
+    numpy.clip(values, -xmax, xmax, out=values)
+    values += xmax
+    values *= SF_STEPS / (2 * xmax)
+    idx[:] = values  # truncate to the left point of the interval
+    values -= idx  # position inside the interval, between 0 and 1
+    # NB: mode='clip' is required, otherwise numpy.take makes a copy
+    values *= numpy.take(dys, idx, out=tmp, mode='clip')
+    values += numpy.take(ys, idx, out=tmp, mode='clip')
+    return values
 
 
 def to_distribution_values(vals, imt):
@@ -82,6 +82,9 @@ class BooreEtAl2014(GMPE):
     #: Required distance measure is Rjb
     REQUIRES_DISTANCES = {'rjb'}
 
+    #: The rupture parameters can be arrays, see :meth:`get_mean_std`
+    vectorized = True
+
     def get_mean_and_stddevs(self, sites, rup, dists, imt, stddev_types):
         """
         See :meth:`superclass method
@@ -113,10 +116,9 @@ class BooreEtAl2014(GMPE):
         Returns the magnitude scling term defined in equation (2)
         """
         dmag = rup.mag - C["Mh"]
-        if rup.mag <= C["Mh"]:
-            mag_term = (C["e4"] * dmag) + (C["e5"] * (dmag ** 2.0))
-        else:
-            mag_term = C["e6"] * dmag
+        mag_term = np.where(rup.mag <= C["Mh"],
+                            C["e4"] * dmag + C["e5"] * (dmag ** 2.0),
+                            C["e6"] * dmag)
         return self._get_style_of_faulting_term(C, rup) + mag_term
 
     def _get_style_of_faulting_term(self, C, rup):
@@ -130,15 +132,11 @@ class BooreEtAl2014(GMPE):
         Note that the 'Unspecified' case is not considered here as
         rake is always given.
         """
-        if np.abs(rup.rake) <= 30.0 or (180.0 - np.abs(rup.rake)) <= 30.0:
-            # strike-slip
-            return C["e1"]
-        elif rup.rake > 30.0 and rup.rake < 150.0:
-            # reverse
-            return C["e3"]
-        else:
-            # normal
-            return C["e2"]
+        rake = rup.rake
+        strike_slip = (np.abs(rake) <= 30.0) | (180.0 - np.abs(rake) <= 30.0)
+        reverse = (rake > 30.0) & (rake < 150.0)
+        return np.where(strike_slip, C["e1"],
+                        np.where(reverse, C["e3"], C["e2"]))
 
     def _get_path_scaling(self, C, dists, mag):
         """
@@ -216,12 +214,10 @@ class BooreEtAl2014(GMPE):
         on magnitude
         """
         base_vals = np.zeros(num_sites)
-        if mag <= 4.5:
-            return base_vals + C["t1"]
-        elif mag >= 5.5:
-            return base_vals + C["t2"]
-        else:
-            return base_vals + C["t1"] + (C["t2"] - C["t1"]) * (mag - 4.5)
+        return base_vals + np.where(
+            mag <= 4.5, C["t1"], np.where(
+                mag >= 5.5, C["t2"],
+                C["t1"] + (C["t2"] - C["t1"]) * (mag - 4.5)))
 
     def _get_intra_event_phi(self, C, mag, rjb, vs30, num_sites):
         """
@@ -230,12 +226,10 @@ class BooreEtAl2014(GMPE):
         """
         base_vals = np.zeros(num_sites)
         # Magnitude Dependent phi (Equation 17)
-        if mag <= 4.5:
-            base_vals += C["f1"]
-        elif mag >= 5.5:
-            base_vals += C["f2"]
-        else:
-            base_vals += (C["f1"] + (C["f2"] - C["f1"]) * (mag - 4.5))
+        base_vals += np.where(
+            mag <= 4.5, C["f1"], np.where(
+                mag >= 5.5, C["f2"],
+                C["f1"] + (C["f2"] - C["f1"]) * (mag - 4.5)))
         # Distance dependent phi (Equation 16)
         idx1 = rjb > C["R2"]
         base_vals[idx1] += C["DfR"]
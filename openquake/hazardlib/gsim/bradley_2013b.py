@@ -62,6 +62,7 @@ class Bradley2013bChchCBD(Bradley2013LHC):
     """
 
     non_verified = True
+    uses_rupture_surface = True
 
     def get_mean_and_stddevs(self, sites, rup, dists, imt, stddev_types):
         """
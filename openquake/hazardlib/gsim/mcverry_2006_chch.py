@@ -37,6 +37,7 @@ class McVerry2006Chch(McVerry2006AscSC):
     #: This implementation is non-verified because the model has not been
     #: published, nor is independent code available.
     non_verified = True
+    uses_rupture_surface = True
 
     def get_mean_and_stddevs(self, sites, rup, dists, imt, stddev_types):
         """
@@ -78,13 +78,8 @@ class MontalvaEtAl2016SInter(AbrahamsonEtAl2015SInter):
         """
         base = C['theta1'] + (C['theta4'] * dc1)
         dmag = self.CONSTS["C1"] + dc1
-        if mag > dmag:
-            f_mag = (C['theta5'] * (mag - dmag)) +\
-                C['theta13'] * ((10. - mag) ** 2.)
-
-        else:
-            f_mag = (C['theta4'] * (mag - dmag)) +\
-                C['theta13'] * ((10. - mag) ** 2.)
+        f_mag = np.where(mag > dmag, C['theta5'], C['theta4']) * \
+            (mag - dmag) + C['theta13'] * ((10. - mag) ** 2.)
 
         return base + f_mag
 
@@ -179,13 +174,8 @@ class MontalvaEtAl2016SSlab(AbrahamsonEtAl2015SSlab):
         """
         base = C['theta1'] + (C['theta4'] * dc1)
         dmag = self.CONSTS["C1"] + dc1
-        if mag > dmag:
-            f_mag = (C['theta5'] * (mag - dmag)) +\
-                C['theta13'] * ((10. - mag) ** 2.)
-
-        else:
-            f_mag = (C['theta4'] * (mag - dmag)) +\
-                C['theta13'] * ((10. - mag) ** 2.)
+        f_mag = np.where(mag > dmag, C['theta5'], C['theta4']) * \
+            (mag - dmag) + C['theta13'] * ((10. - mag) ** 2.)
 
         return base + f_mag
 
@@ -50,11 +50,7 @@ class MontalvaEtAl2017SInter(AbrahamsonEtAl2015SInter):
         """
         base = C['theta1'] + (C['theta4'] * dc1)
         dmag = self.CONSTS["C1"] + dc1
-        if mag > dmag:
-            f_mag = C['theta5'] * (mag - dmag)
-
-        else:
-            f_mag = C['theta4'] * (mag - dmag)
+        f_mag = np.where(mag > dmag, C['theta5'], C['theta4']) * (mag - dmag)
 
         return base + f_mag
 
@@ -157,11 +153,7 @@ class MontalvaEtAl2017SSlab(AbrahamsonEtAl2015SSlab):
         """
         base = C['theta1'] + (C['theta4'] * dc1)
         dmag = self.CONSTS["C1"] + dc1
-        if mag > dmag:
-            f_mag = C['theta5'] * (mag - dmag)
-
-        else:
-            f_mag = C['theta4'] * (mag - dmag)
+        f_mag = np.where(mag > dmag, C['theta5'], C['theta4']) * (mag - dmag)
         return base + f_mag
 
     def _compute_distance_term(self, C, mag, dists):
@@ -41,15 +41,13 @@ def _compute_small_mag_correction_term(C, mag, rhypo):
     """
     small magnitude correction applied to the median values
     """
-    if mag >= 3.00 and mag < 5.5:
-        min_term = np.minimum(rhypo, C['Rm'])
-        max_term = np.maximum(min_term, 10)
-        term_ln = np.log(max_term / 20)
-        term_ratio = ((5.50 - mag) / C['a1'])
-        temp = (term_ratio) ** C['a2'] * (C['b1'] + C['b2'] * term_ln)
-        return 1 / np.exp(temp)
-    else:
-        return 1
+    min_term = np.minimum(rhypo, C['Rm'])
+    max_term = np.maximum(min_term, 10)
+    term_ln = np.log(max_term / 20)
+    # the magnitude is clipped to avoid nans outside of the validity range
+    term_ratio = ((5.50 - np.clip(mag, 3.00, 5.50)) / C['a1'])
+    temp = (term_ratio) ** C['a2'] * (C['b1'] + C['b2'] * term_ln)
+    return np.where((mag >= 3.00) & (mag < 5.5), 1 / np.exp(temp), 1)
 
 
 def _compute_phi_ss(C, mag, c1_dists, log_phi_ss, mean_phi_ss):
@@ -63,17 +61,10 @@ def _compute_phi_ss(C, mag, c1_dists, log_phi_ss, mean_phi_ss):
     the resulted phi_ss is in natural logarithm units
     """
 
-    phi_ss = 0
-
-    if mag < C['Mc1']:
-        phi_ss = c1_dists
-
-    elif mag >= C['Mc1'] and mag <= C['Mc2']:
-        phi_ss = c1_dists + \
-            (C['C2'] - c1_dists) * \
-            ((mag - C['Mc1']) / (C['Mc2'] - C['Mc1']))
-    elif mag > C['Mc2']:
-        phi_ss = C['C2']
+    phi_ss = np.select(
+        [mag < C['Mc1'], mag <= C['Mc2'], mag > C['Mc2']],
+        [c1_dists, c1_dists + (C['C2'] - c1_dists) *
+         ((mag - C['Mc1']) / (C['Mc2'] - C['Mc1'])), C['C2']])
 
     return (phi_ss * 0.50 + mean_phi_ss * 0.50) / log_phi_ss
 
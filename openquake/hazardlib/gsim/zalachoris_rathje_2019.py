@@ -158,12 +158,11 @@ class ZalachorisRathje2019(BooreEtAl2014):
         Returns the magnitude scaling term
         """
         Mb_ = C_ZR19["Mb"]
-        if mag < Mb_:
-            FM = C_ZR19["b0"] + C_ZR19["Cadj"]
-        elif mag > Mb_ and mag < 5.8:
-            FM = C_ZR19["b0"] + C_ZR19["b1"] * (mag - Mb_) + C_ZR19["Cadj"]
-        else:
-            FM = C_ZR19["b0"] + C_ZR19["b1"] * (5.8 - Mb_) + C_ZR19["Cadj"]
+        FM = np.where(
+            mag < Mb_, C_ZR19["b0"] + C_ZR19["Cadj"], np.where(
+                (mag > Mb_) & (mag < 5.8),
+                C_ZR19["b0"] + C_ZR19["b1"] * (mag - Mb_) + C_ZR19["Cadj"],
+                C_ZR19["b0"] + C_ZR19["b1"] * (5.8 - Mb_) + C_ZR19["Cadj"]))
         return FM
 
     def _get_ZR19_distance_term(self, C_ZR19, rhypo):
@@ -20,6 +20,7 @@ import numpy
 
 F32 = numpy.float32
 F64 = numpy.float64
+I64 = numpy.int64
 BYTES_PER_FLOAT = 8
 
 
@@ -123,7 +124,25 @@ class ProbabilityMap(dict):
     :class:`ProbabilityMap`. The map can be represented as 3D array of shape
     (shape_x, shape_y, shape_z) = (N, L, I), where N is the number of site IDs,
     L the total number of hazard levels and I the number of GSIMs.
+
+    The maps returned by `.build` and `.from_array` are *dense*, i.e. the
+    curves are views over the rows of a single array of shape (N, L, I),
+    so that operations like `|`, `~` and `.imul` are performed in bulk at
+    the numpy level. The maps instantiated directly with
+    `ProbabilityMap(shape_y, shape_z)` are *sparse*, i.e. plain dictionaries
+    of independent curves. The two kinds of maps have the same API, but
+    on dense maps assigning a curve copies its values into the
+    underlying array:
+
+    >>> pmap = ProbabilityMap.build(2, 1, sids=[5, 7], initvalue=1.)
+    >>> pmap.imul(numpy.array([7, 9]), numpy.full((2, 2, 1), .5))
+    >>> pmap.array[:, :, 0]
+    array([[1. , 1. ],
+           [0.5, 0.5],
+           [0.5, 0.5]])
     """
+    dense = None  # array of shape (capacity, L, I) for dense maps
+
     @classmethod
     def build(cls, shape_y, shape_z, sids, initvalue=0., dtype=F64):
         """
@@ -131,12 +150,12 @@ class ProbabilityMap(dict):
         :param shape_z: the number of inner levels
         :param sids: a set of site indices
         :param initvalue: the initial value of the probability (default 0)
-        :returns: a ProbabilityMap dictionary
+        :returns: a dense ProbabilityMap dictionary
         """
-        dic = cls(shape_y, shape_z)
-        for sid in sids:
-            dic.setdefault(sid, initvalue, dtype)
-        return dic
+        sids = numpy.fromiter(sids, I64)
+        array = numpy.empty((len(sids), shape_y, shape_z), dtype)
+        array.fill(initvalue)
+        return cls.from_array(array, sids)
 
     @classmethod
     def from_array(cls, array, sids):
@@ -152,14 +171,101 @@ class ProbabilityMap(dict):
         if len(array.shape) == 2:  # shape (N, L) -> (N, L, 1)
             array = array.reshape(array.shape + (1,))
         self = cls(*array.shape[1:])
-        for sid, poes in zip(sids, array):
-            self[sid] = ProbabilityCurve(poes)
+        self._set_dense(array, sids)
         return self
 
     def __init__(self, shape_y, shape_z=1):
         self.shape_y = shape_y
         self.shape_z = shape_z
 
+    def _set_dense(self, array, sids):
+        # the array is not copied: the curves are views over its rows
+        sids = numpy.asarray(sids)
+        self.dense = array
+        self.nrows = len(array)
+        self.sidx = numpy.zeros(0, I64)  # site ID -> row index, -1 if missing
+        if len(sids):
+            self._extend_sidx(numpy.max(sids))
+            self.sidx[sids] = numpy.arange(self.nrows)
+        for sid, poes in zip(sids, array):
+            dict.__setitem__(self, sid, ProbabilityCurve(poes))
+
+    def _extend_sidx(self, maxsid):
+        if maxsid >= len(self.sidx):
+            sidx = numpy.empty(maxsid + 1, I64)
+            sidx.fill(-1)
+            sidx[:len(self.sidx)] = self.sidx
+            self.sidx = sidx
+
+    def _rows(self, sids, initvalue):
+        # returns the row indices of the given site IDs in the dense array,
+        # adding the missing sites (initialized to `initvalue`) if needed
+        sids = numpy.asarray(sids, I64)
+        if len(sids) == 0:
+            return sids
+        self._extend_sidx(sids.max())
+        rows = self.sidx[sids]
+        if (rows >= 0).all():
+            return rows
+        missing = numpy.unique(sids[rows < 0])
+        start, stop = self.nrows, self.nrows + len(missing)
+        if stop > len(self.dense):  # double the capacity
+            dense = numpy.empty((max(stop, 2 * len(self.dense)),) +
+                                self.dense.shape[1:], self.dense.dtype)
+            dense[:start] = self.dense[:start]
+            self.dense = dense
+            for sid, pcurve in self.items():  # re-point the existing curves
+                pcurve.array = dense[self.sidx[sid]]
+        self.dense[start:stop] = initvalue
+        self.sidx[missing] = numpy.arange(start, stop)
+        self.nrows = stop
+        for sid, row in zip(missing, range(start, stop)):
+            dict.__setitem__(self, sid, ProbabilityCurve(self.dense[row]))
+        return self.sidx[sids]
+
+    def _keys(self):
+        # the site IDs in insertion order
+        return numpy.fromiter(self, I64, len(self))
+
+    def _dense_copy(self, func=None):
+        # a dense copy of self, possibly transformed by func
+        sids = self._keys()
+        array = self.dense[self.sidx[sids]]  # fancy indexing makes a copy
+        return self.from_array(array if func is None else func(array), sids)
+
+    def __setitem__(self, sid, pcurve):
+        if self.dense is None:
+            dict.__setitem__(self, sid, pcurve)
+        else:  # copy the values into the underlying array
+            [row] = self._rows([sid], 0.)
+            self.dense[row] = pcurve.array
+
+    def __delitem__(self, sid):
+        dict.__delitem__(self, sid)
+        if self.dense is not None:  # the row is not reused
+            self.sidx[sid] = -1
+
+    def pop(self, sid, *default):
+        if self.dense is not None and sid in self:
+            self.sidx[sid] = -1
+        return dict.pop(self, sid, *default)
+
+    def imul(self, sids, array):
+        """
+        Multiply in-place the curves associated to the given site IDs;
+        the missing curves are initialized to 1. For dense maps this is a
+        single fancy-indexed multiplication.
+
+        :param sids: an array of N distinct site IDs
+        :param array: an array of shape (N, L, I)
+        """
+        if self.dense is None:
+            for sid, arr in zip(sids, array):
+                self.setdefault(sid, 1.).array *= arr
+        else:
+            rows = self._rows(sids, 1.)  # may reallocate self.dense
+            self.dense[rows] *= array
+
     def setdefault(self, sid, value, dtype=F64):
         """
         Works like `dict.setdefault`: if the `sid` key is missing, it fills
@@ -172,6 +278,9 @@ class ProbabilityMap(dict):
         try:
             return self[sid]
         except KeyError:
+            if self.dense is not None:
+                self._rows([sid], value)
+                return self[sid]
             array = numpy.empty((self.shape_y, self.shape_z), dtype)
             array.fill(value)
             pc = ProbabilityCurve(array)
@@ -188,6 +297,8 @@ class ProbabilityMap(dict):
         """
         The underlying array of shape (N, L, I)
         """
+        if self.dense is not None:
+            return self.dense[self.sidx[self.sids]]
         return numpy.array([self[sid].array for sid in sorted(self)])
 
     @property
@@ -213,6 +324,12 @@ class ProbabilityMap(dict):
             index on the z-axis (default 0)
         """
         curves = numpy.zeros(nsites, imtls.dt)
+        if self.dense is not None:
+            sids = self._keys()
+            array = self.dense[self.sidx[sids], :, idx]
+            for imt in curves.dtype.names:
+                curves[imt][sids] = array[:, imtls(imt)]
+            return curves
         for imt in curves.dtype.names:
             curves_by_imt = curves[imt]
             for sid in self:
@@ -249,6 +366,15 @@ class ProbabilityMap(dict):
         if (other.shape_y, other.shape_z) != (self.shape_y, self.shape_z):
             raise ValueError('%s has inconsistent shape with %s' %
                              (other, self))
+        if self.dense is not None:
+            sids = other._keys()
+            if other.dense is not None:
+                array = other.dense[other.sidx[sids]]
+            else:
+                array = numpy.array([other[sid].array for sid in sids])
+            rows = self._rows(sids, 0.)
+            self.dense[rows] = 1. - (1. - self.dense[rows]) * (1. - array)
+            return self
         self_sids = set(self)
         other_sids = set(other)
         for sid in self_sids & other_sids:
@@ -258,8 +384,11 @@ class ProbabilityMap(dict):
         return self
 
     def __or__(self, other):
-        new = self.__class__(self.shape_y, self.shape_z)
-        new.update(self)
+        if self.dense is not None:
+            new = self._dense_copy()
+        else:
+            new = self.__class__(self.shape_y, self.shape_z)
+            new.update(self)
         new |= other
         return new
 
@@ -296,6 +425,8 @@ class ProbabilityMap(dict):
             is_pmap = False
             assert 0. <= other <= 1., other  # must be a probability
             sids = set(self)
+            if self.dense is not None:
+                return self._dense_copy(lambda array: array * other)
         new = self.__class__(self.shape_y, self.shape_z)
         for sid in sids:
             prob = other.get(sid, 1) if is_pmap else other
@@ -303,30 +434,59 @@ class ProbabilityMap(dict):
         return new
 
     def __ipow__(self, n):
+        if self.dense is not None:
+            self.dense[:self.nrows] **= n
+            return self
         for sid, pcurve in self.items():
             self[sid] = pcurve ** n
         return self
 
     def __pow__(self, n):
+        if self.dense is not None:
+            return self._dense_copy(lambda array: array ** n)
         new = self.__class__(self.shape_y, self.shape_z)
         for sid, pcurve in self.items():
             new[sid] = pcurve ** n
         return new
 
     def __invert__(self):
+        if self.dense is not None:
+            sids = self._keys()
+            array = self.dense[self.sidx[sids]]
+            ok = (array != 1.).any(axis=(1, 2))  # store only nonzero probs
+            array = array[ok]
+            numpy.subtract(1., array, out=array)
+            return self.from_array(array, sids[ok])
         new = self.__class__(self.shape_y, self.shape_z)
         for sid in self:
             if (self[sid].array != 1.).any():
                 new[sid] = ~self[sid]  # store only nonzero probabilities
         return new
 
+    def __copy__(self):
+        if self.dense is not None:
+            return self._dense_copy()
+        new = self.__class__(self.shape_y, self.shape_z)
+        new.update(self)
+        return new
+
+    def __reduce_ex__(self, protocol):
+        # dense maps are pickled as a single array, not curve by curve
+        if self.dense is not None:
+            sids = self._keys()
+            return self.from_array, (self.dense[self.sidx[sids]], sids)
+        return super().__reduce_ex__(protocol)
+
     def __getstate__(self):
         return dict(shape_y=self.shape_y, shape_z=self.shape_z)
 
     def __toh5__(self):
         # converts to an array of shape (num_sids, shape_y, shape_z)
-        size = len(self)
         sids = self.sids
+        if self.dense is not None:
+            array = self.dense[self.sidx[sids]].astype(F64, copy=False)
+            return dict(array=array, sids=sids), {}
+        size = len(self)
         shape = (size, self.shape_y, self.shape_z)
         array = numpy.zeros(shape, F64)
         for i, sid in numpy.ndenumerate(sids):
@@ -340,12 +500,11 @@ class ProbabilityMap(dict):
 
     def __fromh5__(self, dic, attrs):
         # rebuild the map from sids and probs arrays
-        array = dic['array']
-        sids = dic['sids']
+        array = dic['array'][()]  # read the datasets in memory
+        sids = dic['sids'][()]
         self.shape_y = array.shape[1]
         self.shape_z = array.shape[2]
-        for sid, prob in zip(sids, array):
-            self[sid] = ProbabilityCurve(prob)
+        self._set_dense(array, sids)
 
     def __repr__(self):
         return '<%s %d, %d, %d>' % (self.__class__.__name__, len(self),
@@ -372,7 +531,7 @@ def combine(pmaps):
     :returns: the combined map
     """
     shape = get_shape(pmaps)
-    res = ProbabilityMap(shape[1], shape[2])
+    res = ProbabilityMap.build(shape[1], shape[2], ())
     for pmap in pmaps:
         res |= pmap
     return res
@@ -69,6 +69,74 @@ def _get_rupture_dimensions(src, mag, rake, dip):
     return rup_length, rup_width
 
 
+def get_rupture_corners(msr, aspect_ratio, usd, lsd,
+                        mag, strike, dip, rake, hypo):
+    """
+    Vectorized version of :meth:`PointSource._get_rupture_surface`, computing
+    the corners of R planar ruptures at once.
+
+    :param msr: a magnitude scaling relationship
+    :param aspect_ratio: an array of R rupture aspect ratios
+    :param usd: an array of R upper seismogenic depths
+    :param lsd: an array of R lower seismogenic depths
+    :param mag: an array of R magnitudes
+    :param strike: an array of R strikes
+    :param dip: an array of R dips
+    :param rake: an array of R rakes
+    :param hypo: an array of shape (R, 3) with the hypocenters
+    :returns:
+        an array of shape (R, 4, 3) with longitude, latitude and depth of
+        the corners top left, top right, bottom left, bottom right
+    """
+    areas = {}  # (mag, rake) -> area
+    for m, r in zip(mag, rake):
+        if (m, r) not in areas:
+            areas[m, r] = msr.get_median_area(m, r)
+    area = numpy.array([areas[m, r] for m, r in zip(mag, rake)])
+    rdip = numpy.radians(dip)
+    rup_length = numpy.sqrt(area * aspect_ratio)
+    rup_width = area / rup_length
+    max_width = (lsd - usd) / numpy.sin(rdip)
+    big = rup_width > max_width
+    rup_width[big] = max_width[big]
+    rup_length[big] = area[big] / rup_width[big]
+    rup_proj_height = rup_width * numpy.sin(rdip)
+    rup_proj_width = rup_width * numpy.cos(rdip)
+    hheight = rup_proj_height / 2.
+
+    # move the rupture center to fit inside the seismogenic layer
+    lon, lat, depth = hypo[:, 0].copy(), hypo[:, 1].copy(), hypo[:, 2].copy()
+    vshift = usd - depth + hheight
+    below = vshift < 0
+    vshift[below] = (lsd - depth - hheight)[below]
+    vshift[below & (vshift > 0)] = 0
+    shift = vshift != 0
+    if shift.any():
+        azimuth_down = (strike[shift] + 90) % 360
+        azimuth_up = ((azimuth_down + 90) % 360 + 90) % 360
+        hshift = numpy.abs(vshift[shift] / numpy.tan(rdip[shift]))
+        lon[shift], lat[shift] = geodetic.point_at(
+            lon[shift], lat[shift],
+            numpy.where(vshift[shift] < 0, azimuth_up, azimuth_down), hshift)
+        depth[shift] += vshift[shift]
+
+    # move from the center along the diagonals of the plane
+    theta = numpy.degrees(
+        numpy.arctan((rup_proj_width / 2.) / (rup_length / 2.)))
+    hor_dist = numpy.sqrt(
+        (rup_length / 2.) ** 2 + (rup_proj_width / 2.) ** 2)
+    corners = numpy.zeros((len(mag), 4, 3))
+    for i, (azimuth, vinc) in enumerate([
+            ((strike + 180 + theta) % 360, -hheight),  # top left
+            ((strike - theta) % 360, -hheight),  # top right
+            ((strike + 180 - theta) % 360, hheight),  # bottom left
+            ((strike + theta) % 360, hheight)]):  # bottom right
+        corners[:, i, 0], corners[:, i, 1] = geodetic.point_at(
+            lon, lat, azimuth, hor_dist)
+        corners[:, i, 2] = depth + vinc
+    return corners
+
+
 class PointSource(ParametricSeismicSource):
     """
     Point source typology represents seismicity on a single geographical
@@ -16,14 +16,29 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import sys
+import pickle
+import shutil
+import subprocess
+import tempfile
 import unittest
+import numpy
 from numpy.testing import assert_almost_equal as aae
 from openquake.baselib.general import gettemp
 from openquake.hazardlib import nrml
+from openquake.hazardlib.sourceconverter import SourceConverter
 from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.utils import fix_lon
+from openquake.hazardlib.geo.nodalplane import NodalPlane
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.mfd import ArbitraryMFD
+from openquake.hazardlib.scalerel import WC1994
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.hazardlib.source import PointSource
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.calc.filters import (
-    MagDepDistance, SourceFilter, angular_distance, split_sources)
+    MagDepDistance, SourceFilter, angular_distance, split_sources,
+    SplitCache)
 
 
 class AngularDistanceTestCase(unittest.TestCase):
@@ -56,6 +71,77 @@ class SourceFilterTestCase(unittest.TestCase):
         sites = srcfilter.get_close_sites(src)
         self.assertIsNotNone(sites)
 
+    def test_kdt_vs_bbox(self):
+        # the KD-tree filtering must give the same sites as the bounding
+        # box filtering, also across the International Date Line
+        mfd = ArbitraryMFD([6.0], [.01])
+        npd = PMF([(1., NodalPlane(0., 90., 0.))])
+        hdd = PMF([(1., 10.)])
+        maxdist = MagDepDistance.new('200')
+        for lon0 in (10., 179.):
+            lons, lats = numpy.meshgrid(
+                numpy.linspace(lon0 - 20, lon0 + 20, 300),
+                numpy.linspace(-20, 20, 300))
+            sitecol = SiteCollection.from_points(lons.flat, lats.flat)
+            srcs = [PointSource('%d' % i, 'test', 'Active Shallow Crust',
+                                mfd, 2., WC1994(), 1.0, PoissonTOM(50.),
+                                0., 20., Point(fix_lon(lon0 - 5 + i * .5), .1 * i),
+                                npd, hdd) for i in range(21)]
+            srcfilter = SourceFilter(sitecol, maxdist)
+            srcfilter.kdt
+            # the index is not pickled, it is rebuilt in the workers
+            srcfilter = pickle.loads(pickle.dumps(srcfilter))
+            self.assertNotIn('_kdt', vars(srcfilter))
+            expected = [sitecol.within_bbox(maxdist.get_affected_box(src))
+                        for src in srcs]
+            got = [srcfilter._within_bbox(maxdist.get_affected_box(src))
+                   for src in srcs]
+            for exp, idxs in zip(expected, got):
+                numpy.testing.assert_equal(idxs, exp)
+            self.assertGreater(sum(map(len, got)), 0)
+
+            # splitting the sites around a hypocenter
+            sites = sitecol.filtered(got[10])
+            loc = Point(lon0, 0., 10.)
+            close, far = srcfilter.split(sites, loc, 50.)
+            close2, far2 = sites.split(loc, 50.)
+            numpy.testing.assert_equal(close.sids, close2.sids)
+            numpy.testing.assert_equal(far.sids, far2.sids)
+
+    def test_wide_boxes(self):
+        # boxes wider than 180 degrees, where the bounding sphere built
+        # from the corners would not enclose the box
+        lons, lats = numpy.meshgrid(numpy.linspace(-170, 170, 69),
+                                    numpy.linspace(-60, 60, 13))
+        sitecol = SiteCollection.from_points(lons.flat, lats.flat)
+        srcfilter = SourceFilter(sitecol, MagDepDistance.new('200'))
+        for box in [(-100., -10., 100., 10.), (-150., 20., 120., 50.),
+                    (100., -10., -100., 10.), (-10., 70., 10., 80.)]:
+            numpy.testing.assert_equal(srcfilter._within_bbox(box),
+                                       sitecol.within_bbox(box))
+
+    def test_close_ruptures(self):
+        # the vectorized rupture prefiltering must be consistent with
+        # close_sids, also across the International Date Line
+        sitecol = SiteCollection.from_points([179.5, -179.5, 10.], [0, 1, 0])
+        srcfilter = SourceFilter(sitecol, MagDepDistance.new('100'))
+        recs = numpy.zeros(6, [('minlon', numpy.float32),
+                               ('minlat', numpy.float32),
+                               ('maxlon', numpy.float32),
+                               ('maxlat', numpy.float32),
+                               ('hypo', (numpy.float32, 3))])
+        lons = numpy.array([179.9, -179.9, 12., 11., 50., 178.8])
+        recs['minlon'] = lons - .1
+        recs['maxlon'] = fix_lon(lons + .1)
+        recs['minlat'] = -.1
+        recs['maxlat'] = .1
+        recs['hypo'][:, 0] = lons
+        recs['hypo'][:, 2] = 10.
+        expected = [len(srcfilter.close_sids(rec, '*')) > 0 for rec in recs]
+        ok = srcfilter.close_ruptures(recs, '*')
+        numpy.testing.assert_equal(ok, expected)
+        numpy.testing.assert_equal(ok, [1, 1, 0, 1, 0, 1])
+
 
 # from https://groups.google.com/d/msg/openquake-users/P03SxJsfW_s/nCdcxj8WAAAJ
 characteric_source = '''\
@@ -120,3 +206,53 @@ class SplitSourcesTestCase(unittest.TestCase):
         self.assertEqual(char.id, src.id)
         self.assertEqual(char.source_id, src.source_id)
         self.assertEqual(char.grp_id, src.grp_id)
+
+    def test_cache(self):
+        fname = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'data', 'context', 'source_model.xml')
+        conv = SourceConverter(50., 1., 10, 0.1, 10.)
+        [[area]] = nrml.to_python(fname, conv)
+        area.id = 1
+        area.grp_id = 2
+        cachedir = tempfile.mkdtemp()
+        cache = SplitCache(cachedir, maxsize=10 ** 6)
+        expected, _ = split_sources([area])
+        splits, _ = split_sources([area], cache)  # miss
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        area.grp_id = 3  # does not change the key
+        splits, _ = split_sources([area], cache)  # hit
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual([s.source_id for s in splits],
+                         [s.source_id for s in expected])
+        self.assertEqual({s.grp_id for s in splits}, {3})
+        self.assertEqual(sum(s.num_ruptures for s in splits),
+                         sum(s.num_ruptures for s in expected))
+
+        # on a hit the number of ruptures of the source is restored
+        num_ruptures = area.num_ruptures
+        area.num_ruptures = 0
+        split_sources([area], cache)
+        self.assertEqual(area.num_ruptures, num_ruptures)
+
+        # the key does not depend on the process computing it
+        key = cache.get_key(area)
+        self.assertTrue(key.startswith(area.source_id + '-'))
+        code = ('import pickle, sys; from openquake.hazardlib.calc.filters '
+                'import SplitCache; src = pickle.load(sys.stdin.buffer); '
+                'print(SplitCache(%r, 0).get_key(src))' % cachedir)
+        out = subprocess.run([sys.executable, '-c', code],
+                             input=pickle.dumps(area), stdout=subprocess.PIPE,
+                             check=True).stdout
+        self.assertEqual(out.decode('utf8').strip(), key)
+
+        # changing the minimum magnitude changes the key
+        area.min_mag = 6.
+        split_sources([area], cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(len(os.listdir(cachedir)), 2)
+
+        # LRU eviction
+        cache.maxsize = 1
+        cache.evict()
+        self.assertEqual(os.listdir(cachedir), [])
+        shutil.rmtree(cachedir)
@@ -0,0 +1,205 @@
+# The Hazard Library
+# Copyright (C) 2020 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+from unittest import mock
+import numpy
+from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.nodalplane import NodalPlane
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.mfd import ArbitraryMFD
+from openquake.hazardlib.scalerel import WC1994
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.hazardlib.source import PointSource
+from openquake.hazardlib.source.rupture import EBRupture
+from openquake.hazardlib.site import SiteCollection
+from openquake.hazardlib.gsim.base import ContextMaker
+from openquake.hazardlib.calc.filters import MagDepDistance
+from openquake.hazardlib.gsim.boore_atkinson_2008 import BooreAtkinson2008
+from openquake.hazardlib.gsim.akkar_bommer_2010 import AkkarBommer2010
+from openquake.hazardlib.calc import gmf
+from openquake.hazardlib.calc.gmf import GmfComputer, U32, F32
+from openquake.sep.classes import _FakePeril
+
+
+def compute_all_rows(computer, min_iml, rlzs_by_gsim, sig_eps):
+    # reference implementation building the records one by one
+    sids = computer.sids
+    eids_by_rlz = computer.ebrupture.get_eids_by_rlz(rlzs_by_gsim)
+    mag = computer.ebrupture.rupture.mag
+    data = []
+    No = sum(len(sp.outputs) for sp in computer.sec_perils)
+    for gs, rlzs in rlzs_by_gsim.items():
+        num_events = sum(len(eids_by_rlz[rlz]) for rlz in rlzs)
+        array, sig, eps = computer.compute(gs, num_events)
+        array = array.transpose(1, 0, 2)
+        for i, miniml in enumerate(min_iml):
+            arr = array[:, i, :]
+            arr[arr < miniml] = 0
+        n = 0
+        for rlz in rlzs:
+            eids = eids_by_rlz[rlz]
+            for ei, eid in enumerate(eids):
+                gmfa = array[:, :, n + ei]
+                if not gmfa.sum(axis=0).sum():
+                    continue
+                sig_eps.append(tuple([eid, rlz] + list(sig[:, n + ei]) +
+                                     list(eps[:, n + ei])))
+                sp_out = numpy.zeros((No,) + gmfa.shape)
+                for m, imt in enumerate(computer.imts):
+                    o = 0
+                    for sp in computer.sec_perils:
+                        o1 = o + len(sp.outputs)
+                        sp_out[o:o1, :, m] = sp.compute(
+                            mag, imt, gmfa[:, m], computer.sctx)
+                        o = o1
+                for i, gmv in enumerate(gmfa):
+                    if gmv.sum():
+                        data.append((sids[i], eid, rlz, gmv) +
+                                    tuple(sp_out[:, i, :]))
+            n += len(eids)
+    dt = F32, (len(min_iml),)
+    dtlist = [('sid', U32), ('eid', U32), ('rlz', U32), ('gmv', dt)] + [
+        (out, dt) for sp in computer.sec_perils for out in sp.outputs]
+    return numpy.array(data, dtlist)
+
+
+class GmfComputerTestCase(unittest.TestCase):
+    def make_computer(self, num_sites, n_occ, sec_perils=(),
+                      precision='float64', master_seed=None,
+                      truncation_level=3):
+        npd = PMF([(1., NodalPlane(0., 90., 0.))])
+        hdd = PMF([(1., 10.)])
+        src = PointSource('0', 'test', 'Active Shallow Crust',
+                          ArbitraryMFD([6.5], [.01]), 2., WC1994(), 1.0,
+                          PoissonTOM(50.), 0., 20., Point(0., 0.), npd, hdd)
+        [rup] = src.iter_ruptures()
+        rup.rup_id = 42
+        ebr = EBRupture(rup, '0', 0, n_occ)
+        ebr.id = 0
+        lons = numpy.linspace(-1., 1., num_sites)
+        lats = numpy.linspace(-1., 1., num_sites)[::-1]
+        sitemodel = numpy.zeros(num_sites, [('vs30', float)])
+        sitemodel['vs30'] = 760.
+        sitecol = SiteCollection.from_points(lons, lats, sitemodel=sitemodel)
+        gsims = [AkkarBommer2010(), BooreAtkinson2008()]
+        imtls = {'PGA': [.1], 'SA(1.0)': [.1]}
+        param = dict(imtls=imtls, maximum_distance=MagDepDistance.new('300'))
+        cmaker = ContextMaker('Active Shallow Crust', gsims, param)
+        return GmfComputer(ebr, sitecol, list(imtls), cmaker,
+                           truncation_level=truncation_level,
+                           sec_perils=sec_perils,
+                           precision=precision, master_seed=master_seed)
+
+    def check(self, computer, min_iml, rlzs_by_gsim):
+        sig_eps1, sig_eps2 = [], []
+        expected = compute_all_rows(computer, min_iml, rlzs_by_gsim, sig_eps1)
+        data, _dt = computer.compute_all(min_iml, rlzs_by_gsim, sig_eps2)
+        self.assertEqual(data.dtype, expected.dtype)
+        for name in expected.dtype.names:
+            numpy.testing.assert_array_equal(data[name], expected[name])
+        self.assertEqual(sig_eps1, sig_eps2)
+
+    def test_compute_all(self):
+        computer = self.make_computer(200, 100)
+        gsims = sorted(computer.gsims)
+        rlzs_by_gsim = {gsims[0]: U32([0, 2]), gsims[1]: U32([1])}
+        # a minimum intensity discarding some sites
+        self.check(computer, numpy.array([.05, .02]), rlzs_by_gsim)
+
+    def test_sec_perils(self):
+        computer = self.make_computer(50, 20, [_FakePeril()])
+        rlzs_by_gsim = {gsim: U32([r]) for r, gsim in enumerate(
+            computer.gsims)}
+        self.check(computer, numpy.array([.01, .01]), rlzs_by_gsim)
+
+    def test_float32(self):
+        comp64 = self.make_computer(200, 100)
+        comp32 = self.make_computer(200, 100, precision='float32')
+        # the GSIMs receive float32 contexts
+        self.assertEqual(comp32.gsim_sctx.vs30.dtype, F32)
+        self.assertEqual(comp32.dctx.rjb.dtype, F32)
+        self.assertEqual(comp64.dctx.rjb.dtype, numpy.float64)
+        for gsim in comp32.gsims:
+            gmf64, sig64, eps64 = comp64.compute(gsim, 100)
+            gmf32, sig32, eps32 = comp32.compute(gsim, 100)
+            numpy.testing.assert_allclose(gmf32, gmf64, rtol=1E-5)
+            numpy.testing.assert_allclose(sig32, sig64, rtol=1E-5)
+            numpy.testing.assert_allclose(eps32, eps64, rtol=1E-5)
+
+    def test_philox(self):
+        eids = numpy.arange(100, 110)
+        for precision in ('float64', 'float32'):
+            computer = self.make_computer(
+                20, 10, precision=precision, master_seed=42)
+            for gsim in computer.gsims:
+                gmf, sig, eps = computer.compute(gsim, 10, eids)
+                # a subset of the events, with runs of consecutive
+                # events and isolated events, gives the same numbers
+                idx = [3, 4, 5, 9]
+                gmf4, sig4, eps4 = computer.compute(gsim, 4, eids[idx])
+                numpy.testing.assert_array_equal(gmf4, gmf[:, :, idx])
+                numpy.testing.assert_array_equal(sig4, sig[:, idx])
+                numpy.testing.assert_array_equal(eps4, eps[:, idx])
+                # and the events are sampled in any order
+                gmf_, _, _ = computer.compute(gsim, 10, eids[::-1])
+                numpy.testing.assert_array_equal(gmf_, gmf[:, :, ::-1])
+        # the streams depend on the master seed
+        other = self.make_computer(20, 10, master_seed=43)
+        gmf_, _, _ = other.compute(gsim, 10, eids)
+        self.assertFalse((gmf_ == gmf).any())
+
+    def test_philox_golden(self):
+        # pinned numbers, to avoid silent changes to the random streams
+        expected = {
+            'float64': ([[.014603461, .030419832, .004063895, .018568158],
+                         [.0101630995, .026305383, .014293619, .007594009]],
+                        [[.29128712, -.43603763, -1.3398709, 1.1633],
+                         [-1.374869, 1.0622251, -1.0259194, 1.5999193]]),
+            'float32': ([[.03579757, .10096591, .0112120025, .028954066],
+                         [.015071494, .010127564, .0049477885, .00720613]],
+                        [[.8333216, 1.2982559, -1.1664525, -.73550713],
+                         [.73267394, -.84502435, -.59756607, -.9702978]])}
+        for precision, (gmf0, eps) in expected.items():
+            computer = self.make_computer(
+                3, 4, precision=precision, master_seed=42)
+            gmf, _sig, eps_ = computer.compute(
+                computer.gsims[0], 4, numpy.arange(4))
+            numpy.testing.assert_allclose(gmf[:, 0], gmf0, rtol=1E-6)
+            numpy.testing.assert_allclose(eps_, eps, rtol=1E-6)
+
+    def test_zero_uniforms(self):
+        # the uniform numbers can be zero, but the epsilons are finite
+        # even without truncation level
+        class ZeroRNG:
+            def random(self, size, dtype):
+                return numpy.zeros(size, dtype)
+        for precision in ('float64', 'float32'):
+            computer = self.make_computer(
+                3, 4, precision=precision, master_seed=42,
+                truncation_level=None)
+            with mock.patch.object(gmf, 'get_rng',
+                                   lambda *args: ZeroRNG()):
+                gmfs, sig, eps = computer.compute(
+                    computer.gsims[0], 4, numpy.arange(4))
+            self.assertTrue(numpy.isfinite(gmfs).all())
+            self.assertTrue(numpy.isfinite(eps).all())
+            self.assertTrue((eps < 0).all())
+
+    def test_many_sites(self):
+        computer = self.make_computer(5000, 200)
+        rlzs_by_gsim = {gsim: U32([r]) for r, gsim in enumerate(
+            computer.gsims)}
+        self.check(computer, numpy.array([.01, .01]), rlzs_by_gsim)
@@ -16,9 +16,18 @@
 import os
 import unittest
 import numpy
-from openquake.hazardlib import nrml, calc
+from openquake.hazardlib import nrml, calc, sourceconverter
 from openquake.hazardlib.calc.stochastic import (
-    stochastic_event_set, sample_ruptures)
+    stochastic_event_set, sample_ruptures, sample_point_ruptures,
+    get_rup_array)
+from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.nodalplane import NodalPlane
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.scalerel import WC1994
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.hazardlib.source import PointSource
+from openquake.hazardlib.source.rupture import EBRupture
 from openquake.hazardlib.gsim.si_midorikawa_1999 import SiMidorikawa1999SInter
 
 aae = numpy.testing.assert_almost_equal
@@ -55,3 +64,50 @@ class StochasticEventSetTestCase(unittest.TestCase):
         # test no filtering 2
         ruptures = sum(sample_ruptures(group, sf, param), {})['rup_array']
         self.assertEqual(len(ruptures), 6)
+
+
+
+def sample_rup_array(src, eff_num_ses):
+    # reference implementation building the rupture objects
+    ebrs = [EBRupture(rup, src.source_id, grp_id, n_occ)
+            for rup, grp_id, n_occ in src.sample_ruptures(eff_num_ses)]
+    return get_rup_array(ebrs)
+
+
+class SamplePointRupturesTestCase(unittest.TestCase):
+    def check(self, src, eff_num_ses, decimal=14):
+        expected = sample_rup_array(src, eff_num_ses)
+        rup_array = sample_point_ruptures(src, eff_num_ses)
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(len(rup_array), len(expected))
+        for name in expected.dtype.names:
+            if expected[name].dtype.kind == 'f':
+                aae(rup_array[name], expected[name], decimal=6)
+            else:
+                numpy.testing.assert_array_equal(
+                    rup_array[name], expected[name])
+        aae(rup_array.geom, expected.geom, decimal=decimal)
+
+    def test_point(self):
+        npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+                   (.3, NodalPlane(45., 30., 90.)),
+                   (.2, NodalPlane(120., 60., -90.))])
+        hdd = PMF([(.4, 5.), (.6, 15.)])
+        src = PointSource('0', 'test', 'Active Shallow Crust',
+                          TruncatedGRMFD(4.5, 7.5, .1, 4., 1.), 2., WC1994(),
+                          1.5, PoissonTOM(50.), 0., 20., Point(10., 45.),
+                          npd, hdd)
+        src.serial = 42
+        src.grp_id = [0, 1]  # the ruptures are sampled twice
+        src.min_mag = 5.
+        self.check(src, 10)
+
+    def test_multi_point(self):
+        fname = os.path.join(os.path.dirname(__file__), os.pardir,
+                             'source_model', 'multi-point-source.xml')
+        conv = sourceconverter.SourceConverter(50., 2., 10., 10., 10.)
+        [[src, _]] = nrml.to_python(fname, conv)
+        src.serial = 1
+        src.grp_id = 0
+        # the multipoint locations are stored in single precision
+        self.check(src, 1000, decimal=6)
@@ -21,10 +21,13 @@ import numpy
 import pytest
 from openquake.hazardlib.pmf import PMF
 from openquake.hazardlib.const import TRT
-from openquake.baselib.general import DictArray
+from openquake.baselib.general import DictArray, AccumDict
+from openquake.hazardlib.probability_map import ProbabilityMap
+from openquake.hazardlib.calc.filters import SourceFilter, MagDepDistance
 from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.contexts import (
-    Effect, RuptureContext, _collapse, make_pmap, get_distances)
+    Effect, RuptureContext, ContextMaker, PmapMaker, GsimTables, _collapse,
+    make_pmap, get_distances)
 from openquake.hazardlib import valid
 from openquake.hazardlib.geo.surface import SimpleFaultSurface as SFS
 from openquake.hazardlib.source.rupture import \
@@ -225,3 +228,113 @@ class CollapseTestCase(unittest.TestCase):
             ctxs.append(ctx)
         pmap = make_pmap(ctxs, gsims, imtls, trunclevel, 50.)
         numpy.testing.assert_almost_equal(pmap[0].array, 0.066381)
+
+
+class BatchTestCase(unittest.TestCase):
+    # compare the batched computation of the PoEs with the computation
+    # rupture by rupture
+    def test_batch_vs_ctx(self):
+        trt = TRT.ACTIVE_SHALLOW_CRUST
+        mfd = ArbitraryMFD([5.5, 6.0, 6.5], [.01, .005, .001])
+        npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+                   (.5, NodalPlane(90., 45., 90.))])
+        hdd = PMF([(.5, 5.), (.5, 10.)])
+        srcs = []
+        for i, lon in enumerate([0., .1, .2, .3]):
+            src = PointSource('src%d' % i, 'test', trt, mfd, 2., WC1994(),
+                              1.0, PoissonTOM(50.), 0., 20., Point(lon, 0.),
+                              npd, hdd)
+            srcs.append(src)
+        sites = [Site(Point(-.5 + .05 * i, .1), 400. + i, 100., 2.)
+                 for i in range(30)]
+        sitecol = SiteCollection(sites)
+        imtls = DictArray({'PGA': [.01, .05, .1, .2, .5],
+                           'SA(0.5)': [.01, .05, .1, .2, .5]})
+        gsims = [valid.gsim('BooreEtAl2014'),
+                 valid.gsim('CampbellBozorgnia2014')]
+        param = dict(imtls=imtls, truncation_level=3,
+                     maximum_distance=MagDepDistance.new('200'))
+        cmaker = ContextMaker(trt, gsims, param)
+        srcfilter = SourceFilter(sitecol, cmaker.maximum_distance)
+        pmaker = PmapMaker(cmaker, srcfilter, srcs)
+        rups = [rup for src in srcs for rup in src.iter_ruptures()]
+        ctxs = cmaker.make_ctxs(rups, sitecol, 0, numpy.array([0]), False)
+        self.assertEqual(len(ctxs), 48)
+        L, G = len(imtls.array), len(gsims)
+
+        pmap1 = AccumDict(accum=ProbabilityMap(L, G))
+        pmaker._update_pmap_by_ctx(ctxs, pmap1)
+
+        pmap2 = AccumDict(accum=ProbabilityMap(L, G))
+        for batch, rec in cmaker.gen_batches(ctxs):
+            pmaker._update_pmap_by_batch(batch, rec, pmap2)
+
+        self.assertEqual(sorted(pmap1[0]), sorted(pmap2[0]))
+        for sid in pmap1[0]:
+            aac(pmap1[0][sid].array, pmap2[0][sid].array, rtol=1E-10)
+
+        # small batches give the same results
+        batches = list(cmaker.gen_batches(ctxs, max_elements=L * G * 60))
+        self.assertGreater(len(batches), 3)
+        pmap3 = AccumDict(accum=ProbabilityMap(L, G))
+        for batch, rec in batches:
+            pmaker._update_pmap_by_batch(batch, rec, pmap3)
+        for sid in pmap1[0]:
+            aac(pmap1[0][sid].array, pmap3[0][sid].array, rtol=1E-10)
+
+
+class GsimTablesTestCase(unittest.TestCase):
+    # compare the tabulated means and stddevs for point ruptures with the
+    # exact ones
+    def test_tables_vs_exact(self):
+        trt = TRT.ACTIVE_SHALLOW_CRUST
+        mfd = ArbitraryMFD([5.0, 5.5, 6.0, 6.5], [.02, .01, .005, .001])
+        npd = PMF([(1., NodalPlane(0., 90., 0.))])
+        hdd = PMF([(.5, 5.), (.5, 10.)])
+        srcs = [PointSource('src%d' % i, 'test', trt, mfd, 2., WC1994(),
+                            1.0, PoissonTOM(50.), 0., 20., Point(lon, 0.),
+                            npd, hdd)
+                for i, lon in enumerate([0., .2, .4])]
+        sites = [Site(Point(-.5 + .02 * i, .1), [400., 760.][i % 2],
+                      100., 2.) for i in range(100)]
+        sitecol = SiteCollection(sites)
+        imtls = DictArray({'PGA': [.01, .05, .1, .2, .5],
+                           'SA(0.5)': [.01, .05, .1, .2, .5]})
+        gsims = [valid.gsim('BooreEtAl2014'),
+                 valid.gsim('CampbellBozorgnia2014')]
+        param = dict(imtls=imtls, truncation_level=3,
+                     maximum_distance=MagDepDistance.new('200'))
+        cmaker = ContextMaker(trt, gsims, param)
+        tab = GsimTables(cmaker, sitecol, mfd.magnitudes, [7.5], .01)
+        self.assertEqual(len(tab.classes), 2)  # two values of vs30
+        self.assertEqual(sorted(tab.tables), [0, 1])
+        self.assertEqual(len(tab.report), 4)  # 2 GSIMs x 2 IMTs
+        for trt_, gsim, imt, ndists, err_mean, err_std, err_poe in tab.report:
+            if ndists:
+                self.assertLess(max(err_mean, err_std), .01)
+                self.assertLess(err_poe, .01)
+
+        rups = [rup for src in srcs for rup in src.point_ruptures()]
+        ctxs = cmaker.make_ctxs(rups, sitecol, 0, numpy.array([0]), False)
+        exact = [cmaker.get_mean_std(batch, rec)
+                 for batch, rec in cmaker.gen_batches(ctxs)]
+        cmaker.gsim_tables = tab
+        for (batch, rec), mean_std in zip(cmaker.gen_batches(ctxs), exact):
+            ok, idxs = tab.get_indices(batch, rec)
+            self.assertTrue(ok.all())
+            aac(cmaker.get_mean_std(batch, rec), mean_std, atol=.01)
+
+        # the finite ruptures are not tabulated, even if mixed with
+        # point ruptures in the same batch
+        rups = list(srcs[0].iter_ruptures()) + list(srcs[1].point_ruptures())
+        ctxs = cmaker.make_ctxs(rups, sitecol, 0, numpy.array([0]), False)
+        for batch, rec in cmaker.gen_batches(ctxs):
+            ok, idxs = tab.get_indices(batch, rec)
+            self.assertTrue(ok.any())
+            self.assertFalse(ok.all())
+            approx = cmaker.get_mean_std(batch, rec)
+            cmaker.gsim_tables = None
+            exact = cmaker.get_mean_std(batch, rec)
+            cmaker.gsim_tables = tab
+            aac(approx[:, ~ok], exact[:, ~ok])
+            aac(approx[:, ok], exact[:, ok], atol=.01)
@@ -14,12 +14,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import unittest
+from unittest import mock
 
 import numpy
 
+from openquake.hazardlib import correlation
 from openquake.hazardlib.imt import SA, PGA
 from openquake.hazardlib.correlation import JB2009CorrelationModel, \
-                                            HM2018CorrelationModel
+                                            HM2018CorrelationModel, wendland
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.geo import Point
 
@@ -148,6 +150,47 @@ class JB2009ApplyCorrelationTestCase(unittest.TestCase):
              decimal=6)
 
 
+class JB2009TaperedCorrelationTestCase(unittest.TestCase):
+    # a grid of 20x20 sites spaced by ~1.1 km
+    lons, lats = numpy.meshgrid(numpy.arange(20) * .01,
+                                numpy.arange(20) * .01)
+    SITECOL = SiteCollection.from_points(lons.flatten(), lats.flatten())
+
+    def test_tapered_matrix(self):
+        cormo = JB2009CorrelationModel(vs30_clustering=False,
+                                       taper_distance=5)
+        corma = cormo.get_tapered_correlation_matrix(self.SITECOL, PGA())
+        dist = self.SITECOL.mesh.get_distance_matrix()
+        expected = cormo._get_correlation_matrix(dist, PGA()) * wendland(
+            dist / 5)
+        aaae(corma.toarray(), expected)
+        self.assertLess(corma.nnz, len(self.SITECOL) ** 2 / 5)
+
+    def test_sparse_factor(self):
+        cormo = JB2009CorrelationModel(vs30_clustering=False,
+                                       taper_distance=5)
+        corma = cormo.get_tapered_correlation_matrix(self.SITECOL, PGA())
+        # applying the correlation to the identity gives the factor of
+        # the tapered correlation matrix
+        N = len(self.SITECOL)
+        low = cormo.apply_correlation(self.SITECOL, PGA(), numpy.eye(N))
+        aaae(low @ low.T, corma.toarray())
+
+    def test_filtered_sitecol(self):
+        cormo = JB2009CorrelationModel(vs30_clustering=False,
+                                       taper_distance=5)
+        filtered = self.SITECOL.filtered(numpy.arange(0, 400, 3))
+        res = numpy.random.normal(size=(len(filtered), 5))
+        corr1 = cormo.apply_correlation(filtered, PGA(), res)
+        corr2 = cormo.apply_correlation(filtered, PGA(), res)
+        self.assertEqual(len(cormo.cache), 1)
+        aaae(corr1, corr2)
+        n = len(filtered)
+        low = cormo.apply_correlation(filtered, PGA(), numpy.eye(n))
+        corma = cormo.get_tapered_correlation_matrix(filtered, PGA())
+        aaae(low @ low.T, corma.toarray())
+
+
 class HM2018CorrelationMatrixTestCase(unittest.TestCase):
     SITECOL = SiteCollection([Site(Point(2, -40), 1, 1, 1),
                               Site(Point(2, -40.1), 1, 1, 1),
@@ -298,3 +341,39 @@ class HM2018ApplyCorrelationTestCase(unittest.TestCase):
              [[1.        , 0.3807, 0.5066],
               [0.3807, 1.        , 0.3075],
               [0.5066, 0.3075, 1.        ]], 2)
+
+    def test_filtered_sitecol(self):
+        # the Cholesky factor is cached per subset of sites
+        imt = SA(period=2.0, damping=5)
+        stddev_intra = numpy.array([0.5, 0.6, 0.7])
+        cormo = HM2018CorrelationModel(uncertainty_multiplier=0)
+        for sids in ([0, 1, 2], [0, 2]):
+            sites = self.SITECOL.filtered(sids)
+            low = cormo.apply_correlation(
+                sites, imt, numpy.eye(len(sites)) * stddev_intra[sids, None],
+                stddev_intra)
+            cov = (numpy.diag(stddev_intra[sids]) @
+                   cormo._get_correlation_matrix(sites, imt) @
+                   numpy.diag(stddev_intra[sids]))
+            aaae(low @ low.T, cov)
+        self.assertEqual(len(cormo.cache), 2)
+
+        # the cache does not grow beyond MAX_CACHED factors
+        with mock.patch.object(correlation, 'MAX_CACHED', 2):
+            cormo.apply_correlation(
+                self.SITECOL.filtered([1, 2]), imt, numpy.eye(2),
+                stddev_intra)
+        self.assertEqual(len(cormo.cache), 1)
+
+    def test_tapered(self):
+        imt = SA(period=2.0, damping=5)
+        stddev_intra = numpy.array([0.5, 0.6, 0.7])
+        cormo = HM2018CorrelationModel(taper_distance=20)
+        low = cormo.apply_correlation(
+            self.SITECOL, imt, numpy.diag(stddev_intra), stddev_intra)
+        corma = cormo.get_tapered_correlation_matrix(self.SITECOL, imt)
+        aaae(low @ low.T, numpy.diag(stddev_intra) @ corma.toarray() @
+             numpy.diag(stddev_intra))
+        with self.assertRaises(ValueError):
+            HM2018CorrelationModel(uncertainty_multiplier=1,
+                                   taper_distance=20)
@@ -17,11 +17,14 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import warnings
+import tracemalloc
 import collections
 import unittest.mock as mock
 
 import numpy
 from copy import deepcopy
+from scipy.stats import norm, truncnorm
 
 from openquake.hazardlib import const
 from openquake.hazardlib.gsim.base import (
@@ -31,7 +34,10 @@ from openquake.hazardlib.geo.point import Point
 from openquake.hazardlib.imt import PGA, PGV, SA
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.source.rupture import BaseRupture
-from openquake.hazardlib.gsim.base import ContextMaker, to_distribution_values
+from openquake.hazardlib.gsim.base import (
+    ContextMaker, to_distribution_values, Buffer, _get_poes)
+from openquake.baselib.general import DictArray
+from openquake.hazardlib.gsim import get_available_gsims
 
 aac = numpy.testing.assert_allclose
 
@@ -356,3 +362,129 @@ class CoeffsTableTestCase(unittest.TestCase):
         self.assertEqual(str(te.exception),
                          "CoeffsTable cannot be constructed with "
                          "inputs of the form 'int'")
+
+
+def _random_ctx(gsim, nrups=20, nsites=5, seed=42):
+    # build a batch context with nrups * nsites rupture-site pairs
+    rng = numpy.random.RandomState(seed)
+    N = nrups * nsites
+    ctx = RuptureContext()
+    ctx.sids = numpy.tile(numpy.arange(nsites), nrups)
+    ctx.ridx = numpy.repeat(numpy.arange(nrups), nsites)
+    rup = dict(mag=rng.uniform(4.5, 8.5, nrups),
+               rake=rng.choice([-150, -90, -30, 0, 45, 90, 135, 180], nrups),
+               dip=rng.uniform(20, 90, nrups),
+               strike=rng.uniform(0, 360, nrups),
+               ztor=rng.uniform(0, 15, nrups),
+               width=rng.uniform(2, 30, nrups),
+               hypo_depth=rng.uniform(5, 100, nrups),
+               hypo_lon=rng.uniform(-1, 1, nrups),
+               hypo_lat=rng.uniform(-1, 1, nrups))
+    for par in gsim.REQUIRES_RUPTURE_PARAMETERS:
+        # the first two ruptures have the same parameters
+        values = rup[par]
+        values[1] = values[0]
+        setattr(ctx, par, values[ctx.ridx])
+    rjb = rng.uniform(0, 200, N)
+    dist = dict(rjb=rjb, rrup=rjb + rng.uniform(0, 10, N),
+                rx=rng.uniform(-100, 100, N), ry0=rng.uniform(0, 50, N),
+                rhypo=rjb + rng.uniform(5, 20, N),
+                repi=rjb + rng.uniform(0, 5, N), rvolc=numpy.zeros(N))
+    for par in gsim.REQUIRES_DISTANCES | {'rrup'}:
+        setattr(ctx, par, dist[par])
+    site = dict(vs30=rng.uniform(150, 1500, N),
+                vs30measured=rng.randint(0, 2, N).astype(bool),
+                z1pt0=rng.uniform(10, 800, N), z2pt5=rng.uniform(.3, 5, N),
+                backarc=rng.randint(0, 2, N).astype(bool),
+                backarc_distance=rng.uniform(-50, 50, N),
+                lon=rng.uniform(-1, 1, N), lat=rng.uniform(-1, 1, N))
+    for par in gsim.REQUIRES_SITES_PARAMETERS:
+        setattr(ctx, par, site[par])
+    return ctx
+
+
+class GetMeanStdTestCase(unittest.TestCase):
+    # check that the vectorized GSIMs give the same results as the
+    # computation by groups of pairs with the same rupture parameters
+    def test_vectorized(self):
+        imts = [PGA(), SA(0.1), SA(1.0)]
+        checked = []
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for name, cls in get_available_gsims().items():
+                if not cls.vectorized:
+                    continue
+                gsim = cls()
+                ctx = _random_ctx(gsim)
+                mean_std = gsim.get_mean_std(ctx, imts)
+                gsim.vectorized = False
+                expected = gsim.get_mean_std(ctx, imts)
+                aac(mean_std, expected, rtol=1E-6, err_msg=name)
+                checked.append(name)
+        self.assertIn('BooreEtAl2014', checked)
+
+
+class GetPoesTestCase(unittest.TestCase):
+    # compare the PoEs with scipy
+    @classmethod
+    def setUpClass(cls):
+        imls = numpy.log(numpy.logspace(-3, 0, 20))
+        cls.loglevels = DictArray({'PGA': imls, 'SA(1.0)': imls[:10]})
+        rng = numpy.random.RandomState(42)
+        N, M, G = 1000, 2, 3
+        cls.mean_std = numpy.array([rng.normal(-2, 1, (N, M, G)),
+                                    rng.uniform(.3, .9, (N, M, G))])
+
+    def expected(self, truncation_level):
+        mean, std = self.mean_std
+        out = []
+        for m, imt in enumerate(self.loglevels):
+            imls = self.loglevels[imt][:, None]
+            if truncation_level == 0:
+                out.append(imls <= mean[:, m, None])
+                continue
+            x = (imls - mean[:, m, None]) / std[:, m, None]
+            if truncation_level is None:
+                out.append(norm.sf(x))
+            else:
+                out.append(truncnorm.sf(x, -truncation_level,
+                                        truncation_level))
+        return numpy.concatenate(out, axis=1)  # shape (N, L, G)
+
+    def test_exact(self):
+        buf = Buffer()
+        for tl in (None, 0, 3):
+            poes = _get_poes(self.mean_std, self.loglevels, tl, buf=buf)
+            aac(poes, self.expected(tl), rtol=1E-7, atol=1E-12)
+            self.assertIs(poes.base, buf.mem['poes'])
+
+    def test_tabulated(self):
+        for tl in (None, 2, 3):
+            poes = _get_poes(self.mean_std, self.loglevels, tl,
+                             sf='tabulated')
+            aac(poes, self.expected(tl), atol=1E-7)
+
+    def test_buffer(self):
+        buf = Buffer()
+        big = buf('poes', (10, 3))
+        small = buf('poes', (2, 3))  # reuse the same memory
+        self.assertIs(small.base, big.base)
+        bigger = buf('poes', (20, 3))  # grow the memory
+        self.assertEqual(len(buf.mem['poes']), 60)
+        self.assertIsNot(bigger.base, big.base)
+
+    def test_no_allocation(self):
+        # with a buffer the kernel must not allocate arrays of shape (N, L, G)
+        # (numpy allocates only small internal buffers for the ufuncs)
+        mean_std = numpy.tile(self.mean_std, (1, 10, 1, 1))
+        N, M, G = mean_std[0].shape
+        L = len(self.loglevels.array)
+        size = N * L * G * 8  # bytes
+        for sf in ('exact', 'tabulated'):
+            buf = Buffer()
+            _get_poes(mean_std, self.loglevels, 3, buf=buf, sf=sf)
+            tracemalloc.start()
+            _get_poes(mean_std, self.loglevels, 3, buf=buf, sf=sf)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertLess(peak, size / 10)
@@ -16,9 +16,15 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+import pickle
+import tempfile
 import unittest
 import numpy
-from openquake.hazardlib.probability_map import ProbabilityMap
+from openquake.baselib import hdf5
+from openquake.hazardlib.probability_map import (
+    ProbabilityMap, ProbabilityCurve)
+from openquake.baselib.general import DictArray
 
 
 class ProbabilityMapTestCase(unittest.TestCase):
@@ -40,3 +46,86 @@ class ProbabilityMapTestCase(unittest.TestCase):
         # test pmap power
         pmap = pmap1 ** 2
         numpy.testing.assert_almost_equal(pmap[0].array, [[.16], [0], [0]])
+
+    def test_dense_vs_sparse(self):
+        # the dense and sparse implementations must give the same results
+        L, I = 4, 2
+        rng = numpy.random.default_rng(42)
+        arr1 = rng.random((3, L, I))
+        arr2 = rng.random((3, L, I))
+        dense1 = ProbabilityMap.from_array(arr1.copy(), [0, 2, 5])
+        dense2 = ProbabilityMap.from_array(arr2.copy(), [2, 5, 9])
+        sparse1 = ProbabilityMap(L, I)
+        for sid, arr in zip([0, 2, 5], arr1.copy()):
+            sparse1[sid] = ProbabilityCurve(arr)
+        sparse2 = ProbabilityMap(L, I)
+        for sid, arr in zip([2, 5, 9], arr2.copy()):
+            sparse2[sid] = ProbabilityCurve(arr)
+        self.assertIsNone(sparse1.dense)
+        self.assertIsNotNone(dense1.dense)
+        aac = numpy.testing.assert_allclose
+        aac((dense1 | dense2).array, (sparse1 | sparse2).array)
+        aac((dense1 | sparse2).array, (sparse1 | sparse2).array)
+        aac((~dense1).array, (~sparse1).array)
+        aac((dense1 * .5).array, (sparse1 * .5).array)
+        aac((dense1 ** 2).array, (sparse1 ** 2).array)
+        aac(dense1.array, arr1)  # the operators above did not change dense1
+
+        # in-place operations, growing the underlying array
+        dense1 |= dense2
+        sparse1 |= sparse2
+        aac(dense1.array, sparse1.array)
+        self.assertEqual(list(dense1.sids), [0, 2, 5, 9])
+        pnes = rng.random((3, L, I))
+        dense1.imul(numpy.array([9, 11, 0]), pnes)
+        sparse1.imul(numpy.array([9, 11, 0]), pnes)
+        aac(dense1.array, sparse1.array)
+        for sid in dense1:  # the curves are views over the dense array
+            aac(dense1[sid].array, sparse1[sid].array)
+
+    def test_dense_copy_pickle_h5(self):
+        pmap = ProbabilityMap.build(3, 2, sids=[1, 4], initvalue=.1)
+        pmap[4].array[0] = .5
+
+        # copies do not share the underlying array
+        new = copy.copy(pmap)
+        new |= pmap
+        numpy.testing.assert_allclose(pmap[4].array[0], [.5, .5])
+        numpy.testing.assert_allclose(new[4].array[0], [.75, .75])
+        for pm in (copy.deepcopy(pmap), pickle.loads(pickle.dumps(pmap))):
+            self.assertIsNotNone(pm.dense)
+            numpy.testing.assert_equal(pm.array, pmap.array)
+
+        # conversion and storage
+        imtls = DictArray({'PGA': [.1, .2], 'SA(0.1)': [.3]})
+        curves = pmap.convert(imtls, 5, idx=1)
+        numpy.testing.assert_allclose(curves['PGA'][4], [.5, .1])
+        numpy.testing.assert_allclose(curves['PGA'][0], [0, 0])
+        with tempfile.NamedTemporaryFile(suffix='.hdf5') as f:
+            with hdf5.File(f.name, 'w') as h5:
+                h5['pmap'] = pmap
+            with hdf5.File(f.name, 'r') as h5:
+                pm = h5['pmap']
+        self.assertIsNotNone(pm.dense)
+        self.assertEqual(list(pm.sids), [1, 4])
+        numpy.testing.assert_equal(pm.array, pmap.array)
+
+    def test_dense_pop(self):
+        pmap = ProbabilityMap.build(2, 1, sids=[1, 4], initvalue=.1)
+        pmap[7] = ProbabilityCurve(numpy.full((2, 1), .3))
+        self.assertEqual(pmap.pop(4).array[0, 0], .1)
+        del pmap[1]
+        self.assertNotIn(4, pmap)
+        self.assertNotIn(1, pmap)
+        self.assertEqual(list(pmap), [7])
+        self.assertEqual(list(pmap.sids), [7])
+        numpy.testing.assert_equal(pmap.array, [[[.3], [.3]]])
+
+        # the popped sites are added again with new values
+        pmap.imul(numpy.array([4]), numpy.full((1, 2, 1), .5))
+        pmap[1] = ProbabilityCurve(numpy.full((2, 1), .2))
+        self.assertEqual(sorted(pmap), [1, 4, 7])
+        numpy.testing.assert_equal(pmap.array[:, 0, 0], [.2, .5, .3])
+        self.assertIsNotNone(pmap.pop(4, None))
+        self.assertIsNone(pmap.pop(4, None))
+        self.assertNotIn(4, pmap)
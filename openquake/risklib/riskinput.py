@@ -89,7 +89,22 @@ def get_output(crmodel, assets_by_taxo, haz, rlzi=None):
                loss_types=crmodel.loss_types)
     if rlzi is not None:
         dic['rlzi'] = rlzi
+    tables = crmodel.vulnerability_tables if len(eids) and len(data) else {}
+    if tables:
+        # all the assets on the site, ordered as the output
+        taxos = numpy.concatenate(
+            [[taxo] * len(assets_) for taxo, assets_ in assets_by_taxo.items()]
+        )[assets_by_taxo.idxs]
+        if len(assets_by_taxo.eps) and not crmodel.oqparam.ignore_covs:
+            eps = numpy.concatenate(
+                [assets_by_taxo.eps[taxo][:, eids] for taxo in assets_by_taxo]
+            )[assets_by_taxo.idxs]
+        else:  # no CoVs
+            eps = None
     for l, lt in enumerate(crmodel.loss_types):
+        if lt in tables:
+            dic[lt] = tables[lt](taxos, data, eps)
+            continue
         ls = []
         for taxonomy, assets_ in assets_by_taxo.items():
             if len(assets_by_taxo.eps):
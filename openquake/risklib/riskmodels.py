@@ -677,6 +677,42 @@ class CompositeRiskModel(collections.abc.Mapping):
         tdict = {taxo: idx for idx, taxo in enumerate(self.taxonomy)}
         return tdict
 
+    @cached_property
+    def vulnerability_tables(self):
+        """
+        :returns: a dict loss_type -> VulnerabilityTable for the loss types
+                  having only lognormal vulnerability functions, used to
+                  compute the event based loss ratios of all the assets
+                  on a site at once
+        """
+        tables = {}
+        tmap = getattr(self, 'tmap', None)
+        if not tmap or self.oqparam.calculation_mode not in (
+                'event_based_risk', 'ebrisk'):
+            return tables
+        K = max(len(pairs) for pairs in tmap)
+        for lt in self.loss_types:
+            vfs, imtis, fidx = [], [], {}
+            for riskid, rm in self._riskmodels.items():
+                vf = rm.risk_functions.get((lt, 'vulnerability'))
+                if (type(vf) is not scientific.VulnerabilityFunction or
+                        vf.distribution_name != 'LN'):
+                    break  # the beta and PMF distributions need the seeds
+                fidx[riskid] = len(vfs)
+                vfs.append(vf)
+                imtis.append(rm.imti[lt])
+            else:
+                fidxs = numpy.zeros((len(tmap), K), int)
+                weights = numpy.zeros((len(tmap), K))
+                for t, pairs in enumerate(tmap):
+                    for k, (riskid, weight) in enumerate(pairs):
+                        if riskid in fidx:  # else not in the reduced model
+                            fidxs[t, k] = fidx[riskid]
+                            weights[t, k] = weight
+                tables[lt] = scientific.VulnerabilityTable(
+                    vfs, imtis, fidxs, weights)
+        return tables
+
     def get_consequences(self):
         """
         :returns: the list of available consequences
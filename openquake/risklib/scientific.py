@@ -472,6 +472,124 @@ class VulnerabilityFunctionWithPMF(VulnerabilityFunction):
         return '<VulnerabilityFunctionWithPMF(%s, %s)>' % (self.id, self.imt)
 
 
+class VulnerabilityTable(object):
+    """
+    The lognormal vulnerability functions of a loss type stacked into
+    padded arrays, to compute the loss ratios of assets with different
+    taxonomies with a single vectorized interpolation.
+
+    :param vfs: a list of F VulnerabilityFunctions
+    :param imtis: a list of F IMT indices, one per function
+    :param fidxs: an array (T, K) of function indices by taxonomy index
+    :param weights: an array (T, K) of weights by taxonomy index
+    """
+    def __init__(self, vfs, imtis, fidxs, weights):
+        F = len(vfs)
+        N = max(len(vf.imls) for vf in vfs)
+        self.imls = numpy.full((F, N), numpy.inf)  # padding for searchsorted
+        self.mean_loss_ratios = numpy.zeros((F, N))
+        self.covs = numpy.zeros((F, N))
+        self.sizes = numpy.array([len(vf.imls) for vf in vfs])
+        for f, vf in enumerate(vfs):
+            n = self.sizes[f]
+            self.imls[f, :n] = vf.imls
+            self.mean_loss_ratios[f, :n] = vf.mean_loss_ratios
+            self.covs[f, :n] = vf.covs
+        self.imtis = numpy.array(imtis)
+        self.fidxs = fidxs
+        self.weights = weights
+
+    def interpolate(self, fs, gmvs):
+        """
+        :param fs: an array of F' function indices
+        :param gmvs: an array of ground motion values of shape (E, M)
+        :returns: means and covs of shape (F', E) and the boolean array
+                  of the gmvs over the minimum IML
+        """
+        return self._interp(fs, gmvs[:, self.imtis[fs]].T)
+
+    def _interp(self, fs, x):
+        # x is an array of shape (F', E) with the IMLs for each function
+        imls = self.imls[fs]  # shape (F', N)
+        sizes = self.sizes[fs, None]
+        min_iml = imls[:, :1]
+        max_iml = numpy.take_along_axis(imls, sizes - 1, 1)
+        # gmvs are clipped to max(iml), with the same dtype as the gmvs
+        x = numpy.where(x > max_iml, max_iml.astype(x.dtype), x)
+        ok = x >= min_iml
+        x = numpy.where(ok, x, min_iml.astype(x.dtype))
+        # linear interpolation as in numpy.interp, used by interp1d
+        lo = (imls[:, None, :] <= x[:, :, None]).sum(axis=2) - 1
+        last = lo >= sizes - 1  # x >= max_iml
+        lo = numpy.clip(lo, 0, sizes - 2)
+        hi = lo + 1
+        x_lo = numpy.take_along_axis(imls, lo, 1)
+        x_hi = numpy.take_along_axis(imls, hi, 1)
+        out = []
+        for ys in (self.mean_loss_ratios[fs], self.covs[fs]):
+            y_lo = numpy.take_along_axis(ys, lo, 1)
+            y_hi = numpy.take_along_axis(ys, hi, 1)
+            y = (y_hi - y_lo) / (x_hi - x_lo) * (x - x_lo) + y_lo
+            out.append(numpy.where(last, y_hi, y))
+        return out[0], out[1], ok
+
+    def __call__(self, taxonomies, gmvs, epsilons=None):
+        """
+        :param taxonomies: an array of A taxonomy indices
+        :param gmvs: an array of ground motion values of shape (E, M)
+        :param epsilons: an array of shape (A, E) or None
+        :returns: an array of loss ratios of shape (A, E)
+        """
+        fidxs = self.fidxs[taxonomies]  # shape (A, K)
+        fs, inv = numpy.unique(fidxs, return_inverse=True)
+        inv = inv.reshape(fidxs.shape)
+        means, covs, ok = self.interpolate(fs, gmvs)
+        if epsilons is None:
+            ratios = means[inv]  # shape (A, K, E)
+        else:  # as in LogNormalDistribution.sample
+            sigma = numpy.sqrt(numpy.log(covs ** 2.0 + 1.0))
+            ratios = (means[inv] / numpy.sqrt(1 + covs[inv] ** 2) *
+                      numpy.exp(epsilons[:, None] * sigma[inv]))
+        ratios = numpy.where(ok[inv], ratios, 0).astype(F32)
+        ws = self.weights[taxonomies]
+        if (ws[:, 1:] == 0).all():  # one function per taxonomy
+            return ratios[:, 0]
+        ws = ws[:, :, None]  # as in numpy.average
+        return (ratios * ws).sum(axis=1) / ws.sum(axis=1)
+
+    def ratios_by_pair(self, taxonomies, gmvs, epsilons=None):
+        """
+        :param taxonomies: an array of P taxonomy indices, one per
+                           (asset, event) pair
+        :param gmvs: an array of ground motion values of shape (P, M)
+        :param epsilons: an array of P epsilons or None
+        :returns: an array of P loss ratios
+        """
+        fidxs = self.fidxs[taxonomies]  # shape (P, K)
+        ws = self.weights[taxonomies]
+        ratios = numpy.zeros(fidxs.shape, F32)
+        # sort the (pair, k) indices by function, then interpolate each
+        # function on its contiguous run of indices
+        pp, kk = (ws > 0).nonzero()
+        fs = fidxs[pp, kk]
+        order = numpy.argsort(fs, kind='stable')
+        pp, kk, fs = pp[order], kk[order], fs[order]
+        uniq, starts = numpy.unique(fs, return_index=True)
+        stops = numpy.append(starts[1:], len(fs))
+        for f, start, stop in zip(uniq, starts, stops):
+            p, k = pp[start:stop], kk[start:stop]
+            [means], [covs], [ok] = self._interp(
+                [f], gmvs[p, self.imtis[f]][None])
+            if epsilons is not None:  # as in LogNormalDistribution.sample
+                sigma = numpy.sqrt(numpy.log(covs ** 2.0 + 1.0))
+                means = (means / numpy.sqrt(1 + covs ** 2) *
+                         numpy.exp(epsilons[p] * sigma))
+            ratios[p, k] = numpy.where(ok, means, 0)
+        if (ws[:, 1:] == 0).all():  # one function per taxonomy
+            return ratios[:, 0]
+        return (ratios * ws).sum(axis=1) / ws.sum(axis=1)
+
+
 # this is meant to be instantiated by riskmodels.get_risk_functions
 class VulnerabilityModel(dict):
     """
@@ -1034,7 +1152,8 @@ def conditional_loss_ratio(loss_ratios, poes, probability):
          defined it returns zero.
 
     :param loss_ratios: an iterable over non-decreasing loss ratio
-                        values (float)
+                        values (float), or an array of shape (P, N)
+                        to interpolate N loss curves at once
     :param poes: an iterable over non-increasing probability of
                  exceedance values (float)
     :param float probability: the probability value used to
@@ -1047,9 +1166,9 @@ def conditional_loss_ratio(loss_ratios, poes, probability):
     elif probability < poes[-1]:  # min PoE
         return loss_ratios[-1]
     if probability in poes:
-        return max([loss
-                    for i, loss in enumerate(loss_ratios)
-                    if probability == poes[i]])
+        return numpy.max(
+            numpy.asarray(loss_ratios)[numpy.asarray(poes) == probability],
+            axis=0)
     else:
         interval_index = bisect.bisect_right(rpoes, probability)
 
@@ -1084,11 +1203,13 @@ def insured_losses(losses, deductible, insured_limit):
     - if the loss is 3 (< 5) the company does not pay anything
     - if the loss is 20 the company pays 20 - 5 = 15
     - if the loss is 101 the company pays 100 - 5 = 95
+
+    The deductible and the limit can also be arrays, one per loss.
     """
-    return numpy.piecewise(
-        losses,
-        [losses < deductible, losses > insured_limit],
-        [0, insured_limit - deductible, lambda x: x - deductible])
+    return numpy.where(
+        losses < deductible, 0, numpy.where(
+            losses > insured_limit, insured_limit - deductible,
+            losses - deductible))
 
 
 def insured_loss_curve(curve, deductible, insured_limit):
@@ -1349,6 +1470,138 @@ def losses_by_period(losses, return_periods, num_events=None, eff_time=None):
     return curve
 
 
+def _interp_top(top, return_periods, num_events, eff_time):
+    # `top` is a function rank -> losses returning the m-th largest loss
+    # (m >= 1) for each curve, or zero if there are less than m losses;
+    # this is the interpolation performed by losses_by_period, in a form
+    # which does not require to sort or pad all the losses
+    rps = numpy.asarray(return_periods, F64)
+    maxrank = numpy.max(num_events) + 1  # the ranks above are zeros
+    curves = []
+    for rp in rps:
+        with numpy.errstate(divide='ignore'):
+            m = int(numpy.clip(numpy.ceil(eff_time / rp), 1, maxrank))
+        fp0 = top(m)
+        if m == maxrank:  # on the left of all the curves
+            curve = fp0 * 0.
+        elif m == 1:  # rp == eff_time, the last point of the curve
+            curve = fp0 * 1.
+        else:
+            xp0 = numpy.log(eff_time / m)
+            xp1 = numpy.log(eff_time / (m - 1))
+            fp1 = top(m - 1)
+            curve = (fp1 - fp0) / (xp1 - xp0) * (numpy.log(rp) - xp0) + fp0
+        curve[rp < eff_time / num_events] = 0  # on the left of the curve
+        curve[rp > eff_time] = numpy.nan  # on the right of the curve
+        curves.append(curve)
+    return numpy.array(curves)
+
+
+def build_loss_curves(losses, return_periods, num_events, eff_time):
+    """
+    Vectorized version of :func:`losses_by_period` computing K curves at
+    once, with a single sort along the event axis.
+
+    :param losses: an array of shape (E, K) with E <= num_events
+    :param return_periods: return periods of interest
+    :param num_events: the number of events (the missing ones have losses 0)
+    :param eff_time: investigation_time * ses_per_logic_tree_path
+    :returns: an array of shape (P, K), possibly with NaNs
+
+    >>> losses = [3, 2, 3.5, 4, 3, 23, 11, 2, 1, 4, 5, 7, 8, 9, 13]
+    >>> build_loss_curves(numpy.array([losses]).T,
+    ...                   [1, 2, 5, 10, 20, 50, 100], 20, 100)[:, 0]
+    array([ 0. ,  0. ,  0. ,  3.5,  8. , 13. , 23. ])
+    """
+    losses = numpy.asarray(losses)
+    E, K = losses.shape
+    if num_events < E:
+        raise ValueError(
+            'There are not enough events (%d) to compute the loss curve'
+            % num_events)
+    # sorted in descending order, with an extra row of zeros
+    top = numpy.zeros((E + 1, K))
+    top[:E] = -numpy.sort(-losses, axis=0)
+    return _interp_top(lambda m: top[min(m, E + 1) - 1],
+                       return_periods, num_events, eff_time)
+
+
+def build_grouped_curves(groups, losses, num_events, return_periods,
+                         eff_time):
+    """
+    Version of :func:`build_loss_curves` for sparse losses, each one
+    belonging to a group, computing the curves of all the groups with a
+    single sort. The groups have different numbers of events and the
+    events without losses are not stored.
+
+    :param groups: an array of N group indices in the range 0 .. G-1
+    :param losses: an array of N losses
+    :param num_events: an array of G numbers of events, one per group
+    :param return_periods: return periods of interest
+    :param eff_time: investigation_time * ses_per_logic_tree_path
+    :returns: an array of shape (P, G), possibly with NaNs
+    """
+    num_events = numpy.asarray(num_events)
+    G = len(num_events)
+    sizes = numpy.bincount(groups, minlength=G)
+    if (sizes > num_events).any():
+        raise ValueError('There are not enough events to compute the '
+                         'loss curves')
+    order = numpy.lexsort((-losses, groups))  # descending in each group
+    top = numpy.append(losses[order], 0.)  # the last element is a zero
+    starts = numpy.cumsum(sizes) - sizes
+    zero = len(top) - 1
+
+    def top_(m):
+        return top[numpy.where(m <= sizes, starts + m - 1, zero)]
+    with numpy.errstate(divide='ignore'):
+        return _interp_top(top_, return_periods, num_events, eff_time)
+
+
+class TopLosses(object):
+    """
+    Streaming accumulator for K loss curves, to be used when the event
+    loss table is too large to be kept in memory. Only the largest losses
+    of each curve are stored, which are all it is needed to compute the
+    curves for the given return periods.
+
+    :param K: number of curves
+    :param return_periods: return periods of interest (>= 1)
+    :param eff_time: investigation_time * ses_per_logic_tree_path
+    """
+    def __init__(self, K, return_periods, eff_time):
+        self.return_periods = return_periods
+        self.eff_time = eff_time
+        with numpy.errstate(divide='ignore'):
+            size = numpy.ceil(eff_time / numpy.min(return_periods))
+        # with a zero return period all the losses are needed
+        self.size = max(int(size), 1) if numpy.isfinite(size) else None
+        self.top = numpy.zeros((0, K))
+        self.num_losses = 0
+
+    def add(self, losses):
+        """
+        :param losses: an array of shape (E', K)
+        """
+        self.num_losses += len(losses)
+        top = numpy.concatenate([self.top, losses])
+        if self.size and len(top) > self.size:
+            top = -numpy.partition(-top, self.size - 1, axis=0)[:self.size]
+        self.top = top
+
+    def get_curves(self, num_events):
+        """
+        :param num_events: the total number of events
+        :returns: an array of shape (P, K), possibly with NaNs
+        """
+        if num_events < self.num_losses:
+            raise ValueError(
+                'There are not enough events (%d) to compute the loss curve'
+                % num_events)
+        return build_loss_curves(self.top, self.return_periods, num_events,
+                                 self.eff_time)
+
+
 class LossCurvesMapsBuilder(object):
     """
     Build losses curves and maps for all loss types at the same time.
@@ -1414,9 +1667,20 @@ class LossCurvesMapsBuilder(object):
 
     # used in event_based_risk
     def build_curve(self, asset_value, loss_ratios, rlzi):
-        return asset_value * losses_by_period(
-            loss_ratios, self.return_periods,
-            self.num_events.get(rlzi, 0), self.eff_time)
+        """
+        :param asset_value: an asset value or an array of A values
+        :param loss_ratios: an array of E loss ratios or of shape (A, E)
+        :param rlzi: the realization index
+        :returns: an array of shape (P,) or (A, P)
+        """
+        loss_ratios = numpy.asarray(loss_ratios)
+        E = loss_ratios.shape[-1]
+        curves = build_loss_curves(
+            loss_ratios.reshape(-1, E).T, self.return_periods,
+            self.num_events.get(rlzi, 0), self.eff_time)  # shape (P, A)
+        P = len(self.return_periods)
+        return numpy.asarray(asset_value)[..., None] * curves.T.reshape(
+            loss_ratios.shape[:-1] + (P,))
 
     # used in event_based_risk
     def build_maps(self, curves, clp, stats=()):
@@ -1426,32 +1690,48 @@ class LossCurvesMapsBuilder(object):
         :param stats: list of pairs [(statname, statfunc), ...]
         :returns: an array of loss_maps of shape (A, R, C, LI)
         """
-        shp = curves.shape[:2] + (len(clp), len(curves.dtype))  # (A, R, C, LI)
+        A, R, P = curves.shape
+        shp = (A, R, len(clp), len(curves.dtype))  # (A, R, C, LI)
         array = numpy.zeros(shp, F32)
         for lti, lt in enumerate(curves.dtype.names):
-            for a, curves_ in enumerate(curves[lt]):
-                for r, ls in enumerate(curves_):
-                    for c, poe in enumerate(clp):
-                        clratio = conditional_loss_ratio(ls, self.poes, poe)
-                        array[a, r, c, lti] = clratio
+            ls = curves[lt].reshape(A * R, P).T  # shape (P, A * R)
+            for c, poe in enumerate(clp):
+                clratios = conditional_loss_ratio(ls, self.poes, poe)
+                array[:, :, c, lti] = numpy.broadcast_to(
+                    clratios, (A * R,)).reshape(A, R)
         return self.pair(array, stats)
 
     # used in ebrisk
     def build_curves(self, loss_arrays, rlzi):
+        """
+        :param loss_arrays: an array of shape (E, L, T...)
+        :param rlzi: the realization index
+        :returns: an array of curves of shape (P, L, T...)
+        """
         if len(loss_arrays) == 0:
             return ()
         shp = loss_arrays[0].shape  # (L, T...)
         P = len(self.return_periods)
-        curves = numpy.zeros((P,) + shp, F32)
-        num_events = self.num_events.get(rlzi, 0)
-        acc = collections.defaultdict(list)
-        for loss_array in loss_arrays:
-            for idx, loss in numpy.ndenumerate(loss_array):
-                acc[idx].append(loss)
-        for idx, losses in acc.items():
-            curves[(slice(None),) + idx] = losses_by_period(
-                losses, self.return_periods, num_events, self.eff_time)
-        return curves
+        curves = build_loss_curves(
+            numpy.reshape(loss_arrays, (len(loss_arrays), -1)),
+            self.return_periods, self.num_events.get(rlzi, 0), self.eff_time)
+        return curves.reshape((P,) + shp).astype(F32)
+
+
+def sum_by_key(keys, lnis, losses, L):
+    """
+    Grouped sums of the losses by key and loss type index, computed with
+    a single call to numpy.bincount.
+
+    :param keys: an array of N integer keys
+    :param lnis: an array of N loss type indices
+    :param losses: an array of N losses
+    :param L: the number of loss types
+    :returns: the K unique keys and an array of shape (K, L) with the sums
+    """
+    ukeys, inv = numpy.unique(keys, return_inverse=True)
+    sums = numpy.bincount(inv * L + lnis, losses, len(ukeys) * L)
+    return ukeys, sums.reshape(len(ukeys), L)
 
 
 class LossesByAsset(object):
@@ -1462,8 +1742,8 @@ class LossesByAsset(object):
     :param policy_name: the name of the policy field (can be empty)
     :param policy_dict: dict loss_type -> array(deduct, limit) (can be empty)
     """
-    alt = None  # set by the ebrisk calculator
-    losses_by_E = None  # set by the ebrisk calculator
+    alt = None  # list of columns (aggkey, eid, lni, loss), set by ebrisk
+    losses_by_E = None  # list of columns (eid, lni, loss), set by ebrisk
 
     @cached_property
     def losses_by_A(self):
@@ -1499,32 +1779,119 @@ class LossesByAsset(object):
                         losses[a], ded * avalues[a], lim * avalues[a])
                 yield self.lni[lt + '_ins'], ins_losses
 
-    def aggregate(self, out, eids, minimum_loss, tagidxs, ws):
+    def aggregate(self, out, eids, minimum_loss, aggkeys, ws):
         """
-        Populate .losses_by_A, .losses_by_E and .alt
+        Populate .losses_by_A, .losses_by_E and .alt; the losses by event
+        and by aggregation key are collected as columns, to be reduced
+        by .get_losses_by_E and .get_alt
+
+        :param out: an output with the loss ratios of shape (A, E)
+        :param eids: the E event IDs
+        :param minimum_loss: the minimum loss for each loss type index
+        :param aggkeys: A integer aggregation keys or None
+        :param ws: the weights of the events or None
+        :returns: the number of losses kept in the alt and the total
         """
         numlosses = numpy.zeros(2, int)
         for lni, losses in self.gen_losses(out):
             if ws is not None:  # compute avg_losses, really fast
                 aids = out.assets['ordinal']
                 self.losses_by_A[aids, lni] += losses @ ws
-            for eid, loss in zip(eids, losses.sum(axis=0)):
-                self.losses_by_E[eid][lni] += loss
-            if tagidxs is not None:
-                # this is the slow part, depending on minimum_loss
-                for a, asset in enumerate(out.assets):
-                    ls = losses[a]
-                    ok = ls > minimum_loss[lni]
-                    if not ok.sum():
-                        continue
-                    idx = ','.join(map(str, tagidxs[a])) + ','
-                    kept = 0
-                    for loss, eid in zip(ls[ok], out.eids[ok]):
-                        self.alt[idx][eid][lni] += loss
-                        kept += 1
-                    numlosses += numpy.array([kept, len(losses[a])])
+            self.losses_by_E.append(
+                (eids, numpy.full(len(eids), lni), losses.sum(axis=0)))
+            if aggkeys is not None:
+                ok = losses > minimum_loss[lni]  # shape (A, E)
+                a, e = ok.nonzero()
+                if len(a) == 0:
+                    continue
+                self.alt.append((aggkeys[a], out.eids[e],
+                                 numpy.full(len(a), lni), losses[a, e]))
+                numlosses += numpy.array(
+                    [len(a), ok.any(axis=1).sum() * ok.shape[1]])
+        return numlosses
+
+    def gen_pair_losses(self, assets, lratios):
+        """
+        :param assets: an array of P assets, one per (asset, event) pair
+        :param lratios: a dictionary loss_type -> array of P loss ratios
+        :yields: pairs (loss_name_index, array of P losses)
+        """
+        for lt, ratios in lratios.items():
+            avalues = (assets['occupants_None'] if lt == 'occupants'
+                       else assets['value-' + lt])
+            losses = (avalues * ratios).astype(ratios.dtype)
+            yield self.lni[lt], losses
+            if lt in self.policy_dict:
+                ded, lim = self.policy_dict[lt][assets[self.policy_name]].T
+                ins_losses = insured_losses(
+                    losses, ded * avalues, lim * avalues)
+                yield self.lni[lt + '_ins'], ins_losses.astype(ratios.dtype)
+
+    def aggregate_pairs(self, assets, eids, lratios, minimum_loss, aggkeys,
+                        ws, num_events):
+        """
+        Same as .aggregate, but for a block of (asset, event) pairs
+        coming from many sites; each asset must be entirely in the block.
+
+        :param assets: an array of P assets, one per pair
+        :param eids: an array of P event IDs
+        :param lratios: a dictionary loss_type -> array of P loss ratios
+        :param minimum_loss: the minimum loss for each loss type index
+        :param aggkeys: P integer aggregation keys or None
+        :param ws: the P weights of the events or None
+        :param num_events: the P numbers of events on the site of the asset
+        :returns: the number of losses kept in the alt and the total
+        """
+        numlosses = numpy.zeros(2, int)
+        aids, ainv = numpy.unique(assets['ordinal'], return_inverse=True)
+        ueids, einv = numpy.unique(eids, return_inverse=True)
+        for lni, losses in self.gen_pair_losses(assets, lratios):
+            if ws is not None:  # compute avg_losses
+                self.losses_by_A[aids, lni] += numpy.bincount(
+                    ainv, losses * ws, len(aids))
+            self.losses_by_E.append(
+                (ueids, numpy.full(len(ueids), lni),
+                 numpy.bincount(einv, losses, len(ueids))))
+            if aggkeys is not None:
+                ok = losses > minimum_loss[lni]
+                if not ok.any():
+                    continue
+                self.alt.append((aggkeys[ok], eids[ok],
+                                 numpy.full(ok.sum(), lni), losses[ok]))
+                _, first = numpy.unique(ainv[ok], return_index=True)
+                numlosses += numpy.array(
+                    [ok.sum(), num_events[ok][first].sum()])
         return numlosses
 
+    def get_losses_by_E(self):
+        """
+        :returns: the unique event IDs and an array of losses of shape (E, L)
+        """
+        L = len(self.loss_names)
+        if not self.losses_by_E:
+            return numpy.zeros(0, U32), numpy.zeros((0, L), F32)
+        eids, lnis, losses = map(numpy.concatenate, zip(*self.losses_by_E))
+        eids, losses = sum_by_key(eids, lnis, losses, L)
+        return eids.astype(U32), losses.astype(F32)
+
+    def get_alt(self):
+        """
+        :returns:
+            a dictionary with the columns agg_id, event_id and loss of the
+            aggregate loss table, ordered by agg_id and then event_id
+        """
+        L = len(self.loss_names)
+        if not self.alt:
+            return dict(agg_id=numpy.zeros(0, U32),
+                        event_id=numpy.zeros(0, U32),
+                        loss=numpy.zeros((0, L), F32))
+        aggkeys, eids, lnis, losses = map(numpy.concatenate, zip(*self.alt))
+        keys = (aggkeys.astype(numpy.int64) << 32) + eids
+        ukeys, losses = sum_by_key(keys, lnis, losses, L)
+        return dict(agg_id=(ukeys >> 32).astype(U32),
+                    event_id=(ukeys & 0xFFFFFFFF).astype(U32),
+                    loss=losses.astype(F32))
+
 
 # ####################### Consequences ##################################### #
 
@@ -705,3 +705,200 @@ class ClassicalDamageTestCase(unittest.TestCase):
             fragility_functions, hazard_imls, hazard_poes,
             investigation_time, risk_investigation_time)
         aaae(poos, [0.56652127, 0.12513401, 0.1709355, 0.06555033, 0.07185889])
+
+
+class FakeOutput(dict):
+    loss_types = ['structural']
+
+    def __init__(self, assets, eids, lratios):
+        self.assets = assets
+        self.eids = eids
+        self['structural'] = lratios
+
+
+class LossesByAssetTestCase(unittest.TestCase):
+    def test_aggregate(self):
+        A, E = 5, 6
+        rng = numpy.random.default_rng(42)
+        assets = numpy.zeros(A, [('ordinal', numpy.uint32),
+                                 ('value-structural', float)])
+        assets['ordinal'] = numpy.arange(A)
+        assets['value-structural'] = [100, 200, 300, 400, 500]
+        eids = numpy.array([3, 5, 8, 13, 21, 34], numpy.uint32)
+        lratios = rng.random((A, E)) * (rng.random((A, E)) > .3)
+        aggkeys = numpy.array([2, 0, 2, 1, 0])
+        lba = scientific.LossesByAsset(assets, ['structural'])
+        lba.alt, lba.losses_by_E = [], []
+        out = FakeOutput(assets, eids, lratios)
+        # aggregating twice to check the grouped sums
+        for _ in range(2):
+            kept, tot = lba.aggregate(out, eids, [50.], aggkeys, None)
+        losses = lratios * assets['value-structural'][:, None]
+
+        # losses by event
+        eids_, losses_by_E = lba.get_losses_by_E()
+        numpy.testing.assert_equal(eids_, eids)
+        numpy.testing.assert_allclose(
+            losses_by_E[:, 0], 2 * losses.sum(axis=0), rtol=1E-6)
+
+        # aggregate loss table, computed with a reference implementation
+        expected = {}
+        for a in range(A):
+            for e in range(E):
+                if losses[a, e] > 50.:
+                    key = aggkeys[a], eids[e]
+                    expected[key] = expected.get(key, 0) + 2 * losses[a, e]
+        alt = lba.get_alt()
+        self.assertEqual(list(zip(alt['agg_id'], alt['event_id'])),
+                         sorted(expected))
+        numpy.testing.assert_allclose(
+            alt['loss'][:, 0], [expected[k] for k in sorted(expected)],
+            rtol=1E-6)
+        self.assertEqual(kept, (losses > 50.).sum())
+        self.assertEqual(tot, (losses > 50.).any(axis=1).sum() * E)
+
+    def test_aggregate_pairs(self):
+        A, E = 5, 6
+        rng = numpy.random.default_rng(42)
+        assets = numpy.zeros(A, [('ordinal', numpy.uint32),
+                                 ('value-structural', float),
+                                 ('policy', numpy.uint16)])
+        assets['ordinal'] = numpy.arange(A)
+        assets['value-structural'] = [100, 200, 300, 400, 500]
+        assets['policy'] = [1, 2, 1, 2, 1]
+        policy_dict = {'structural': numpy.array([[0, 0], [.1, .4], [0, .2]])}
+        names = ['structural', 'structural_ins']
+        eids = numpy.array([3, 5, 8, 13, 21, 34], numpy.uint32)
+        lratios = (rng.random((A, E)) * (rng.random((A, E)) > .3)).astype(
+            numpy.float32)
+        aggkeys = numpy.array([2, 0, 2, 1, 0])
+        ws = rng.random(E)
+        lba1 = scientific.LossesByAsset(assets, names, 'policy', policy_dict)
+        lba2 = scientific.LossesByAsset(assets, names, 'policy', policy_dict)
+        for lba in (lba1, lba2):
+            lba.alt, lba.losses_by_E = [], []
+        num1 = lba1.aggregate(FakeOutput(assets, eids, lratios), eids,
+                              [50., 10.], aggkeys, ws)
+        # the same losses as (asset, event) pairs, in no particular order
+        aidx, eidx = numpy.nonzero(numpy.ones((A, E)))
+        idx = rng.permutation(len(aidx))
+        aidx, eidx = aidx[idx], eidx[idx]
+        num2 = lba2.aggregate_pairs(
+            assets[aidx], eids[eidx], {'structural': lratios[aidx, eidx]},
+            [50., 10.], aggkeys[aidx], ws[eidx], numpy.full(len(aidx), E))
+        numpy.testing.assert_equal(num1, num2)
+        numpy.testing.assert_allclose(
+            lba1.losses_by_A, lba2.losses_by_A, rtol=1E-6)
+        for arr1, arr2 in zip(lba1.get_losses_by_E(), lba2.get_losses_by_E()):
+            numpy.testing.assert_allclose(arr1, arr2, rtol=1E-6)
+        alt1, alt2 = lba1.get_alt(), lba2.get_alt()
+        for col in alt1:
+            numpy.testing.assert_allclose(alt1[col], alt2[col], rtol=1E-6)
+
+
+class LossCurvesTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(42)
+        self.E, self.K = 150, 5
+        # losses with many zeros, i.e. events not affecting the curves
+        self.losses = rng.random((self.E, self.K)) * (
+            rng.random((self.E, self.K)) > .5)
+        self.rps = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+        self.expected = numpy.array([
+            scientific.losses_by_period(losses, self.rps, 200, 100.)
+            for losses in self.losses.T]).T  # shape (P, K)
+
+    def test_build_loss_curves(self):
+        curves = scientific.build_loss_curves(
+            self.losses, self.rps, 200, 100.)
+        numpy.testing.assert_allclose(curves, self.expected)
+        with self.assertRaises(ValueError):
+            scientific.build_loss_curves(self.losses, self.rps, 100, 100.)
+
+    def test_build_grouped_curves(self):
+        # only the nonzero losses are passed, in no particular order
+        groups, eids = numpy.nonzero(self.losses.T)
+        idx = numpy.random.default_rng(0).permutation(len(groups))
+        curves = scientific.build_grouped_curves(
+            groups[idx], self.losses.T[groups, eids][idx],
+            [200] * self.K, self.rps, 100.)
+        numpy.testing.assert_allclose(curves, self.expected)
+
+    def test_top_losses(self):
+        top = scientific.TopLosses(self.K, self.rps, 100.)
+        for losses in numpy.array_split(self.losses, 7):
+            top.add(losses)
+        self.assertEqual(len(top.top), 100)  # ceil(eff_time / rps[0])
+        numpy.testing.assert_allclose(top.get_curves(200), self.expected)
+
+
+class VulnerabilityTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.vfs = [
+            scientific.VulnerabilityFunction(
+                'vf1', 'PGA', [0.005, 0.007, 0.0098, 0.0137, 0.0192, 0.0269],
+                [0.01, 0.1, 0.3, 0.5, 0.6, 1.0], [0.3, 0.1, 0.3, 0., 0.3, 10]),
+            scientific.VulnerabilityFunction(
+                'vf2', 'SA(0.3)', [0.001, 0.01, 0.1],
+                [0.05, 0.2, 0.8], [0.2, 0.2, 0.1])]
+        for vf in self.vfs:
+            vf.seed = 42
+            vf.init()
+        rng = numpy.random.default_rng(42)
+        E = 50
+        self.gmvs = rng.random((E, 2)).astype(numpy.float32) * 0.04
+        self.taxonomies = numpy.array([0, 1, 1, 0, 2])
+        self.eps = rng.normal(size=(len(self.taxonomies), E))
+
+    def expected(self, fidxs, weights, eps):
+        # the ratios computed by the single vulnerability functions
+        out = []
+        for a, taxo in enumerate(self.taxonomies):
+            arrays = [self.vfs[f](self.gmvs[:, f], None if eps is None
+                                  else eps[a]) for f in fidxs[taxo]]
+            out.append(numpy.average(numpy.float32(arrays), axis=0,
+                                     weights=weights[taxo]))
+        return numpy.array(out)
+
+    def test_one_function_per_taxonomy(self):
+        fidxs, weights = numpy.array([[0], [1], [0]]), numpy.ones((3, 1))
+        table = scientific.VulnerabilityTable(
+            self.vfs, [0, 1], fidxs, weights)
+        for eps in (None, self.eps):
+            ratios = table(self.taxonomies, self.gmvs, eps)
+            self.assertEqual(ratios.dtype, numpy.float32)
+            numpy.testing.assert_array_equal(
+                ratios, self.expected(fidxs, weights, eps))
+
+    def test_weighted_functions(self):
+        fidxs = numpy.array([[0, 1], [1, 0], [0, 0]])
+        weights = numpy.array([[.3, .7], [.6, .4], [1., 0.]])
+        table = scientific.VulnerabilityTable(
+            self.vfs, [0, 1], fidxs, weights)
+        for eps in (None, self.eps):
+            numpy.testing.assert_allclose(
+                table(self.taxonomies, self.gmvs, eps),
+                self.expected(fidxs, weights, eps), rtol=1E-12)
+
+    def test_ratios_by_pair(self):
+        fidxs = numpy.array([[0, 1], [1, 0], [0, 0]])
+        weights = numpy.array([[.3, .7], [.6, .4], [1., 0.]])
+        table = scientific.VulnerabilityTable(
+            self.vfs, [0, 1], fidxs, weights)
+        # all the (asset, event) pairs, flattened
+        aidx, eidx = numpy.nonzero(numpy.ones(self.eps.shape))
+        for eps in (None, self.eps):
+            ratios = table.ratios_by_pair(
+                self.taxonomies[aidx], self.gmvs[eidx],
+                None if eps is None else eps[aidx, eidx])
+            numpy.testing.assert_allclose(
+                ratios, table(self.taxonomies, self.gmvs, eps).flatten(),
+                rtol=1E-12)
+        # with one function per taxonomy the ratios are float32
+        table = scientific.VulnerabilityTable(
+            self.vfs, [0, 1], fidxs[:, :1], weights[:, :1])
+        ratios = table.ratios_by_pair(
+            self.taxonomies[aidx], self.gmvs[eidx], self.eps[aidx, eidx])
+        self.assertEqual(ratios.dtype, numpy.float32)
+        numpy.testing.assert_array_equal(
+            ratios, table(self.taxonomies, self.gmvs, self.eps).flatten())